@@ -0,0 +1,10 @@
+# coding: utf-8
+"""Benchmarks of lu_dj_utils.
+
+Run them from the project root directory (results are written as JSON)::
+
+    python -m benchmarks.run --output results.json
+
+See ``python -m benchmarks.run --help``.
+
+"""
@@ -0,0 +1,135 @@
+# coding: utf-8
+"""Benchmark runner primitives.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import gc
+import os
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
+
+from django.conf import settings
+import django
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_now = getattr(time, 'perf_counter', time.time)
+
+
+def setup_django():
+    """Configure Django settings for the benchmarks (if not configured yet)."""
+    if settings.configured:
+        return
+    settings.configure(
+        INSTALLED_APPS=('lu_dj_utils', 'benchmarks'),
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        TEMPLATE_DIRS=(os.path.join(ROOT_DIR, 'templates'), ),
+        EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+    )
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+class Benchmark(object):
+
+    """A function measured by calling it ``number`` times.
+
+    ``func`` is called with the index of the call; each call processes
+    ``items`` items of ``unit`` (e.g. a call that sends 100 messages), which
+    is taken into account for the throughput (``per_second``). ``setup`` (optional) is
+    called before the measurement and its result, if not None, is a
+    context manager entered around it (e.g. to start a server). ``params``
+    describe the case, for the report.
+
+    """
+
+    def __init__(self, name, func, number, params=None, setup=None, unit='call', items=1):
+        self.name = name
+        self.func = func
+        self.number = number
+        self.params = params or {}
+        self.setup = setup
+        self.unit = unit
+        self.items = items
+
+    def run(self, memory_number=50):
+        """Run the benchmark.
+
+        Latencies and throughput are measured without memory tracing; peak
+        memory (allocated by Python, if :mod:`tracemalloc` is available) is
+        measured in a second run of at most ``memory_number`` calls.
+
+        :rtype: dict
+
+        """
+        context = self.setup() if self.setup is not None else None
+        if context is not None:
+            context.__enter__()
+        try:
+            latencies = self._time(self.number)
+            peak_memory = self._measure_memory(min(self.number, memory_number))
+        finally:
+            if context is not None:
+                context.__exit__(None, None, None)
+
+        total = sum(latencies)
+        return {
+            'name': self.name,
+            'params': self.params,
+            'number': self.number,
+            'unit': self.unit,
+            'items': self.number * self.items,
+            'seconds': total,
+            'per_second': self.number * self.items / total if total else None,
+            'latency': get_percentiles(latencies),
+            'peak_memory_bytes': peak_memory,
+        }
+
+    def _time(self, number):
+        func = self.func
+        latencies = []
+        gc.collect()
+        for i in range(number):
+            start = _now()
+            func(i)
+            latencies.append(_now() - start)
+        return latencies
+
+    def _measure_memory(self, number):
+        if tracemalloc is None or not number:
+            return None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            for i in range(number):
+                self.func(i)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+
+def get_percentiles(values, percents=(50, 90, 99)):
+    """Return the ``min``, ``max``, ``mean`` and percentiles (``'p50'``, etc.)
+    of ``values``.
+
+    :rtype: dict
+
+    """
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {
+        'min': values[0],
+        'max': values[-1],
+        'mean': sum(values) / len(values),
+    }
+    for percent in percents:
+        index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+        result['p%s' % percent] = values[index]
+    return result
@@ -0,0 +1,143 @@
+# coding: utf-8
+"""Benchmarks of sending email over SMTP (to a sink on loopback).
+
+Cases vary message size, number of attachments, number of recipients and
+template complexity.
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import contextlib
+import os
+import shutil
+import tempfile
+
+from django.test.utils import override_settings
+
+from benchmarks.base import Benchmark
+
+
+ATTACHMENT_SIZE = 64 * 1024
+
+
+@contextlib.contextmanager
+def smtp_sink():
+    """Start an SMTP sink and make it the email host."""
+    from lu_dj_utils.test import SMTPSink
+
+    with SMTPSink(keep_messages=False) as sink:
+        with override_settings(EMAIL_HOST=sink.host, EMAIL_PORT=sink.port):
+            yield sink
+
+
+@contextlib.contextmanager
+def smtp_sink_and_file(size):
+    """Like :func:`smtp_sink`, also creating a file of ``size`` bytes (at
+    ``_file_path``, while the context is active).
+
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'report.pdf')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    _file_path[:] = [path]
+    try:
+        with smtp_sink() as sink:
+            yield sink
+    finally:
+        shutil.rmtree(directory)
+
+
+_file_path = []
+
+
+def get_context(i, sections=5, products=10):
+    return {
+        'campaign': {'name': 'spring sale'},
+        'user': {'id': i, 'first_name': 'User%s' % i, 'last_name': 'Doe'},
+        'order': {'id': 1000 + i},
+        'sections': [
+            {
+                'title': 'section %s' % s,
+                'products': [
+                    {
+                        'id': p, 'name': 'Product number %s of section %s' % (p, s),
+                        'price': 10.5 * p, 'sale_price': 9.5 * p, 'discount': p % 2,
+                        'description': 'Line one\nline two',
+                    }
+                    for p in range(products)],
+            }
+            for s in range(sections)],
+        'footer': '<a href="https://example.com/unsubscribe">Unsubscribe</a>',
+    }
+
+
+def get_benchmarks(quick=False):
+    from lu_dj_utils.email import (
+        FileAttachment, PlainEmail, send_mail2, send_templated_mail, send_templated_mass_mail,
+    )
+
+    scale = 10 if quick else 1
+    benchmarks = []
+
+    for body_size in (1024, 100 * 1024):
+        body = ('x' * 75 + '\n') * (body_size // 76)
+        benchmarks.append(Benchmark(
+            'PlainEmail.send[body=%s]' % body_size,
+            lambda i, body=body: PlainEmail(
+                subject='s', body=body, from_email='a@a.cl', to=['b@b.cl']).send(),
+            number=500 // scale, params={'body_size': body_size}, setup=smtp_sink,
+            unit='message'))
+
+    for recipients in (1, 10, 100):
+        to = ['user%s@example.com' % r for r in range(recipients)]
+        benchmarks.append(Benchmark(
+            'send_mail2[recipients=%s]' % recipients,
+            lambda i, to=to: send_mail2(subject='s', body='b', from_email='a@a.cl', to=to),
+            number=300 // scale, params={'recipients': recipients}, setup=smtp_sink,
+            unit='message'))
+
+    for count in (0, 1, 5):
+        attachments = [('file%s.bin' % a, os.urandom(ATTACHMENT_SIZE), None)
+                       for a in range(count)]
+        benchmarks.append(Benchmark(
+            'PlainEmail.send[attachments=%s]' % count,
+            lambda i, attachments=attachments: PlainEmail(
+                subject='s', body='b', from_email='a@a.cl', to=['b@b.cl'],
+                attachments=attachments).send(),
+            number=200 // scale,
+            params={'attachments': count, 'attachment_size': ATTACHMENT_SIZE},
+            setup=smtp_sink, unit='message'))
+
+    file_size = 4 * 1024 * 1024
+    benchmarks.append(Benchmark(
+        'PlainEmail.send[file_attachment=%s]' % file_size,
+        lambda i: PlainEmail(
+            subject='s', body='b', from_email='a@a.cl', to=['b@b.cl'],
+            attachments=[FileAttachment(_file_path[0])]).send(),
+        number=50 // scale, params={'file_attachment_size': file_size},
+        setup=lambda: smtp_sink_and_file(file_size), unit='message'))
+
+    for name, body_template, html_template in (
+            ('simple', 'bench_simple.txt', None),
+            ('complex', 'bench_simple.txt', 'bench_complex.html')):
+        benchmarks.append(Benchmark(
+            'send_templated_mail[template=%s]' % name,
+            lambda i, body_template=body_template, html_template=html_template:
+                send_templated_mail(
+                    get_context(i), 'bench_subject.txt', body_template, html_template,
+                    from_email='a@a.cl', to=['user%s@example.com' % i]),
+            number=300 // scale, params={'template': name}, setup=smtp_sink,
+            unit='message'))
+
+    batch = 100
+    benchmarks.append(Benchmark(
+        'send_templated_mass_mail[template=complex]',
+        lambda i: send_templated_mass_mail(
+            ((get_context(j), ['user%s@example.com' % j]) for j in range(batch)),
+            'bench_subject.txt', 'bench_simple.txt', 'bench_complex.html',
+            from_email='a@a.cl'),
+        number=max(1, 10 // scale), params={'template': 'complex', 'batch': batch},
+        setup=smtp_sink, unit='message', items=batch))
+
+    return benchmarks
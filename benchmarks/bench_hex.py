@@ -0,0 +1,176 @@
+# coding: utf-8
+"""Benchmarks of :mod:`lu_dj_utils.hex`.
+
+* hashing: :func:`~lu_dj_utils.hex.hex_sha1` called per value compared with
+  :func:`~lu_dj_utils.hex.hex_sha1_many`.
+* inserting rows with a unique 32-hex-digit key (like
+  :class:`~lu_dj_utils.model_fields.Hex32Field`) in a SQLite table, with
+  random (:func:`~lu_dj_utils.hex.random_hex_32`) or time-ordered
+  (:func:`~lu_dj_utils.hex.time_hex_32`) keys.
+* looking up objects by key (an ``in`` lookup through the ORM) in an
+  in-memory SQLite database, with keys stored as text
+  (:class:`~lu_dj_utils.model_fields.Hex32Field` and
+  :class:`~lu_dj_utils.model_fields.Hex6Field`) or in compact form
+  (:class:`~lu_dj_utils.model_fields.BinaryHex32Field` and
+  :class:`~lu_dj_utils.model_fields.IntegerHex6Field`), so the conversion of
+  the values by the fields is measured too; the size of the table and its
+  indexes is reported in the params.
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import contextlib
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from benchmarks.base import Benchmark
+
+
+SALT = b'x' * 40
+
+INSERT_BATCH = 1000
+LOOKUP_ROWS = 200000
+LOOKUP_BATCH = 100
+
+# storage of keys: (name of the model in ``benchmarks.models``, key field)
+STORAGES = {
+    'hex32_char': ('CharKeysItem', 'key'),
+    'hex32_binary': ('CompactKeysItem', 'key'),
+    'hex6_char': ('CharKeysItem', 'code'),
+    'hex6_integer': ('CompactKeysItem', 'code'),
+}
+
+
+@contextlib.contextmanager
+def sqlite_table():
+    """Create a SQLite database (in a file, with a small page cache) with a
+    table with a unique key column, available at ``_db`` while the context is
+    active.
+
+    """
+    directory = tempfile.mkdtemp()
+    db = sqlite3.connect(os.path.join(directory, 'bench.sqlite3'))
+    db.execute('PRAGMA cache_size = -2000')  # KiB
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute(
+        'CREATE TABLE item (id INTEGER PRIMARY KEY, key CHAR(32) NOT NULL UNIQUE, '
+        'name VARCHAR(50))')
+    _db[:] = [db]
+    try:
+        yield db
+    finally:
+        db.close()
+        shutil.rmtree(directory)
+
+
+_db = []
+
+
+def get_storage_model(storage):
+    from benchmarks import models
+
+    model_name, field_name = STORAGES[storage]
+    return getattr(models, model_name), field_name
+
+
+def get_db_bytes(connection):
+    """Return the size of the pages in use of the SQLite database."""
+    cursor = connection.cursor()
+    sizes = []
+    for pragma in ('page_count', 'freelist_count', 'page_size'):
+        cursor.execute('PRAGMA %s' % pragma)
+        sizes.append(cursor.fetchone()[0])
+    page_count, freelist_count, page_size = sizes
+    return (page_count - freelist_count) * page_size
+
+
+@contextlib.contextmanager
+def lookup_table(storage, keys, params):
+    """Create the table of the model of ``storage`` (see ``STORAGES``) with
+    an object per value of ``keys`` (hex values) while the context is active;
+    the size of the table and its indexes is set to ``params['db_bytes']``.
+
+    """
+    from django.db import connection
+
+    model, field_name = get_storage_model(storage)
+    db_bytes = get_db_bytes(connection)
+    with connection.schema_editor() as editor:
+        editor.create_model(model)
+    try:
+        # the other key is set to distinct values of the right length
+        other_name, template = (('code', '%06x') if field_name == 'key' else ('key', '%032x'))
+        model.objects.bulk_create(
+            model(**{field_name: key, other_name: template % i})
+            for i, key in enumerate(keys))
+        params['db_bytes'] = get_db_bytes(connection) - db_bytes
+        yield
+    finally:
+        with connection.schema_editor() as editor:
+            editor.delete_model(model)
+
+
+def insert_rows(generate):
+    db = _db[0]
+    with db:
+        db.executemany(
+            'INSERT INTO item (key, name) VALUES (?, ?)',
+            [(generate(), 'name') for _ in range(INSERT_BATCH)])
+
+
+def lookup_objects(storage, keys):
+    model, field_name = get_storage_model(storage)
+    objects = list(model.objects.filter(**{str('%s__in' % field_name): keys}))
+    assert len(objects) == len(keys)
+
+
+def get_benchmarks(quick=False):
+    from lu_dj_utils.hex import (
+        hex_sha1, hex_sha1_many, random_hex_32, random_hex_32_many, time_hex_32,
+    )
+
+    scale = 10 if quick else 1
+    benchmarks = []
+
+    for value_size, count, number in ((32, 10000, 50), (1024 * 1024, 32, 10)):
+        values = [os.urandom(value_size) for _ in range(count)]
+        params = {'value_size': value_size, 'batch': count}
+        benchmarks.append(Benchmark(
+            'hex_sha1[value=%s]' % value_size,
+            lambda i, values=values: [hex_sha1(SALT, value) for value in values],
+            number=max(1, number // scale), params=params, unit='hash', items=count))
+        for threads in (0, 4):
+            benchmarks.append(Benchmark(
+                'hex_sha1_many[value=%s,threads=%s]' % (value_size, threads),
+                lambda i, values=values, threads=threads:
+                    list(hex_sha1_many(SALT, values, threads=threads)),
+                number=max(1, number // scale), params=dict(params, threads=threads),
+                unit='hash', items=count))
+
+    # the table grows up to 500,000 rows, so the index doesn't fit in the cache
+    for name, generate in (('random', random_hex_32), ('ordered', time_hex_32)):
+        benchmarks.append(Benchmark(
+            'sqlite_insert[key=%s]' % name,
+            lambda i, generate=generate: insert_rows(generate),
+            number=max(1, 500 // scale), params={'key': name, 'batch': INSERT_BATCH},
+            setup=sqlite_table, unit='row', items=INSERT_BATCH))
+
+    rows = LOOKUP_ROWS // scale
+    hex32_keys = random_hex_32_many(rows)
+    hex6_keys = ['%06x' % i for i in range(0, 16 ** 6, 16 ** 6 // rows)][:rows]
+    for storage, keys in (
+            ('hex32_char', hex32_keys), ('hex32_binary', hex32_keys),
+            ('hex6_char', hex6_keys), ('hex6_integer', hex6_keys)):
+        params = {'storage': storage, 'rows': rows, 'batch': LOOKUP_BATCH}
+        benchmarks.append(Benchmark(
+            'orm_lookup[storage=%s]' % storage,
+            lambda i, storage=storage, keys=keys: lookup_objects(
+                storage, keys[i * LOOKUP_BATCH % rows:][:LOOKUP_BATCH]),
+            number=max(1, 1000 // scale), params=params,
+            setup=lambda storage=storage, keys=keys, params=params:
+                lookup_table(storage, keys, params),
+            unit='object', items=LOOKUP_BATCH))
+
+    return benchmarks
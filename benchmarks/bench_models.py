@@ -0,0 +1,88 @@
+# coding: utf-8
+"""Benchmarks of model validation, comparing Django's ``full_clean`` with
+the one of :class:`~lu_dj_utils.models.ValidateModelMixin`, which uses a
+cached :class:`~lu_dj_utils.models.ValidationPlan` of the model.
+
+* validate: cleaning the fields and gathering the unique checks, without
+  queries (the per-instance overhead of the introspection);
+* save: validating (``full_clean``) and inserting new objects in an
+  in-memory SQLite database.
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import contextlib
+import datetime
+import decimal
+import itertools
+
+from benchmarks.base import Benchmark
+
+
+@contextlib.contextmanager
+def items_table():
+    """Create the table of the benchmark models while the context is active."""
+    from django.db import connection
+    from benchmarks.models import PlainItem
+
+    with connection.schema_editor() as editor:
+        editor.create_model(PlainItem)
+    try:
+        yield
+    finally:
+        with connection.schema_editor() as editor:
+            editor.delete_model(PlainItem)
+
+
+def get_item(model, i):
+    return model(
+        key='%032x' % i, code='%06x' % i, email='user%s@example.com' % i,
+        url='https://example.com/%s' % i, name='Item %s' % i, kind='a', group='g',
+        position=i, price=decimal.Decimal('9.99'),
+        created=datetime.datetime(2015, 1, 1))
+
+
+def validate(item):
+    item.clean_fields()
+    item.clean()
+    item._get_unique_checks()
+
+
+# keys of the saved objects (functions are called again to measure memory)
+_ids = itertools.count()
+
+
+def save_plain(i):
+    from benchmarks.models import PlainItem
+
+    item = get_item(PlainItem, next(_ids))
+    item.full_clean()
+    item.save()
+
+
+def save_validated(i):
+    from benchmarks.models import ValidatedItem
+
+    get_item(ValidatedItem, next(_ids)).save()
+
+
+def get_benchmarks(quick=False):
+    from benchmarks.models import PlainItem, ValidatedItem
+
+    scale = 10 if quick else 1
+    plain_item = get_item(PlainItem, 0)
+    validated_item = get_item(ValidatedItem, 0)
+    return [
+        Benchmark(
+            'validate[plan=no]', lambda i: validate(plain_item),
+            number=20000 // scale, params={'plan': False}, unit='object'),
+        Benchmark(
+            'validate[plan=yes]', lambda i: validate(validated_item),
+            number=20000 // scale, params={'plan': True}, unit='object'),
+        Benchmark(
+            'save[plan=no]', save_plain, number=2000 // scale, params={'plan': False},
+            setup=items_table, unit='object'),
+        Benchmark(
+            'save[plan=yes]', save_validated, number=2000 // scale, params={'plan': True},
+            setup=items_table, unit='object'),
+    ]
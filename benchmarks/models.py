@@ -0,0 +1,45 @@
+# coding: utf-8
+"""Models used by the benchmarks.
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+from django.db import models
+
+from lu_dj_utils.model_fields import BinaryHex32Field, Hex32Field, Hex6Field, IntegerHex6Field
+from lu_dj_utils.models import ValidateModelMixin
+
+
+class PlainItem(models.Model):
+
+    key = models.CharField(max_length=32, unique=True)
+    code = models.CharField(max_length=6, unique=True)
+    email = models.EmailField()
+    url = models.URLField(blank=True)
+    name = models.CharField(max_length=50)
+    kind = models.CharField(max_length=10, choices=[('a', 'A'), ('b', 'B')])
+    group = models.CharField(max_length=10)
+    position = models.PositiveIntegerField()
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    created = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('group', 'position'), )
+
+
+class ValidatedItem(ValidateModelMixin, PlainItem):
+
+    class Meta:
+        proxy = True
+
+
+class CharKeysItem(models.Model):
+
+    key = Hex32Field(unique=True)
+    code = Hex6Field(unique=True)
+
+
+class CompactKeysItem(models.Model):
+
+    key = BinaryHex32Field(unique=True)
+    code = IntegerHex6Field(unique=True)
@@ -0,0 +1,72 @@
+# coding: utf-8
+"""Run the benchmarks and write the results as JSON.
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import datetime
+import importlib
+import json
+import platform
+import sys
+
+from benchmarks.base import setup_django
+
+
+MODULES = [
+    'benchmarks.bench_email',
+    'benchmarks.bench_hex',
+    'benchmarks.bench_models',
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '-o', '--output', help="file to write the results to (default: standard output)")
+    parser.add_argument(
+        '-k', '--filter', default='',
+        help="run only the benchmarks whose name contains this string")
+    parser.add_argument(
+        '--quick', action='store_true', help="fewer iterations, e.g. to check that they run")
+    args = parser.parse_args(argv)
+
+    setup_django()
+    import django
+    import lu_dj_utils
+
+    results = []
+    for module_name in MODULES:
+        module = importlib.import_module(module_name)
+        for benchmark in module.get_benchmarks(quick=args.quick):
+            if args.filter not in benchmark.name:
+                continue
+            result = benchmark.run()
+            results.append(result)
+            print('%-50s %10.1f %s/s  p50=%.6fs  p99=%.6fs' % (
+                benchmark.name, result['per_second'] or 0, result['unit'],
+                result['latency']['p50'], result['latency']['p99']), file=sys.stderr)
+
+    report = {
+        'meta': {
+            'date': datetime.datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'django': django.get_version(),
+            'lu_dj_utils': lu_dj_utils.__version__,
+            'quick': args.quick,
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
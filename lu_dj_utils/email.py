@@ -6,19 +6,101 @@ Source: lookup_www.common.utils.mail (with some edition).
 """
 from __future__ import absolute_import, print_function, unicode_literals
 
+import atexit
+import base64
+import contextlib
+import hashlib
+import itertools
+import json
 import logging
+import mimetypes
+import multiprocessing
+import os
+import random
+import re
+import smtplib
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from email import encoders
+from email import message_from_string
+from email.message import Message
+from email.utils import parseaddr
 
+import django
+from django.conf import settings
 import django.core.mail
-from django.template.loader import render_to_string
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+from django.core.mail.message import (
+    DEFAULT_ATTACHMENT_MIME_TYPE, MIMEBase, SafeMIMEMessage, SafeMIMEText, sanitize_address,
+)
+from django.core.validators import validate_ipv46_address
+import django.db
+from django.db import close_old_connections
+from django.dispatch import Signal
+from django.template import Context
+# ``render_to_string`` is not used anymore, but kept: it's imported from this module
+from django.template.loader import get_template, render_to_string
+from django.utils import six
+from django.utils.six.moves import cPickle as pickle
+
+from lu_dj_utils.lru import LRUCache
+from lu_dj_utils.normalization import normalize_email
+from lu_dj_utils.stats import Histogram
 
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MASS_MAIL_BATCH_SIZE = 100
+DEFAULT_MASS_MAIL_SENDERS = 2
+DEFAULT_FAN_OUT_CHUNK_SIZE = 100
+DEFAULT_FAN_OUT_CONNECTIONS = 4
+DEFAULT_RENDER_CACHE_SIZE = 1024
+DEFAULT_ATTACHMENT_CACHE_BYTES = 32 * 1024 * 1024
+
+_now = getattr(time, 'monotonic', time.time)
+_BARE_LF_RE = re.compile(br'(?<!\r)\n')
+# same rules as `django.core.validators.EmailValidator`
+_EMAIL_USER_RE = re.compile(
+    r"(^[-!#$%&'*+/=?^_`{}|~0-9a-z]+(\.[-!#$%&'*+/=?^_`{}|~0-9a-z]+)*\Z"  # dot-atom
+    r'|^"([\001-\010\013\014\016-\037!#-\[\]-\177]|\\[\001-\011\013\014\016-\177])*"\Z)',  # quoted
+    re.IGNORECASE)
+_EMAIL_DOMAIN_RE = re.compile(
+    r'(?:[a-z0-9](?:[a-z0-9-]{0,247}[a-z0-9])?\.)+(?:[a-z]{2,6}|[a-z0-9-]{2,}(?<!-))\Z',
+    re.IGNORECASE)
+_EMAIL_LITERAL_RE = re.compile(r'\[([a-f0-9:\.]+)\]\Z', re.IGNORECASE)
+_streaming = threading.local()
+
+
+email_phase_finished = Signal(providing_args=['duration', 'size', 'error'])
+"""Sent after each phase of creating and sending an email message, only if
+there are receivers (otherwise, phases are not even timed).
+
+The sender is the name of the phase:
+
+* ``'render_subject'``, ``'render_body'`` and ``'render_html_body'``:
+  rendering the templates in :func:`render_templated_mail`
+* ``'create_message'``: creating the Django message of a :class:`PlainEmail`
+* ``'connect'``: opening the connection in :func:`send_message`
+* ``'send'``: sending the message in :func:`send_message`
+
+Arguments: ``duration`` (seconds), ``size`` (of the message data written
+over SMTP, in bytes, for phase ``'send'``; None for the others and for other
+email backends) and ``error`` (the exception raised by the phase, or None).
+
+"""
+
 
 class PlainEmail(object):
 
     """Friendly wrapper over :class:`django.core.mail.EmailMessage`
 
+    ``attachments`` may include :class:`FileAttachment` objects, to attach
+    big files without reading them into memory.
+
     .. note::
         The only public attribute is :attr:`connection` because it can be
         changed safely after instantiation.
@@ -71,8 +153,58 @@ class PlainEmail(object):
         :rtype: int
 
         """
-        message = self.create_message()
-        return message.send()
+        with _time_phase('create_message'):
+            message = self.create_message()
+        if self.connection is None and message.recipients():
+            pool = get_connection_pool()
+            if pool is not None:
+                with pool.connection() as connection:
+                    message.connection = connection
+                    return send_message(message)
+        return send_message(message)
+
+    def to_spec(self):
+        """Return the :class:`EmailSpec` of this email (without :attr:`connection`).
+
+        :rtype: :class:`EmailSpec`
+
+        """
+        return EmailSpec(**self._get_spec_kwargs())
+
+    @classmethod
+    def from_spec(cls, spec, connection=None):
+        """Create an email from an :class:`EmailSpec` (see :meth:`EmailSpec.to_email`)."""
+        return spec.to_email(connection)
+
+    def _get_spec_kwargs(self):
+        return dict(
+            subject=self._subject, body=self._body, from_email=self._from_email,
+            to=self._to, cc=self._cc, bcc=self._bcc, attachments=self._attachments,
+            headers=self._headers)
+
+    def send_fan_out(self, chunk_size=DEFAULT_FAN_OUT_CHUNK_SIZE,
+                     connections=DEFAULT_FAN_OUT_CONNECTIONS):
+        """Create the email message and send it in envelopes of at most
+        ``chunk_size`` recipients, over ``connections`` concurrent connections
+        (see :func:`send_fan_out`). :attr:`connection` is not used.
+
+        :return: delivery report of all the recipients
+        :rtype: :class:`DeliveryReport`
+
+        """
+        return send_fan_out(self.create_message(), chunk_size, connections)
+
+    def asend(self, pool=None):
+        """Asynchronous version of :meth:`send` (requires Python 3.5+).
+
+        The message is sent with :func:`lu_dj_utils.email_async.send_message`
+        over ``pool``; :attr:`connection` is not used for SMTP.
+
+        :return: coroutine whose result is the number of email messages sent
+
+        """
+        from lu_dj_utils.email_async import send_message
+        return send_message(self.create_message(), pool)
 
 
 class HTMLEmail(PlainEmail):
@@ -86,16 +218,1491 @@ class HTMLEmail(PlainEmail):
         super(HTMLEmail, self).__init__(*args, **kwargs)
         self._html_body = html_body
 
+    def _get_spec_kwargs(self):
+        kwargs = super(HTMLEmail, self)._get_spec_kwargs()
+        kwargs['html_body'] = self._html_body
+        return kwargs
+
     def create_message(self):
         message = super(HTMLEmail, self).create_message()
         message.attach_alternative(self._html_body, self._EMAIL_ALTERNATIVE_MIME_TYPE)
         return message
 
 
+class FileAttachment(MIMEBase, object):  # `object`: MIMEBase is an old-style class in Python 2
+
+    """Attachment whose content is read from the file at ``path`` only when
+    the message is sent.
+
+    Use it as an item of the ``attachments`` of :class:`PlainEmail` or
+    :class:`HTMLEmail` (or of a :class:`django.core.mail.EmailMessage`). When
+    the message is sent over SMTP by :func:`send_message`, the file is read
+    in chunks and base64-encoded while it's written to the socket, so memory
+    usage doesn't depend on the size of the file. Otherwise (e.g. other email
+    backends) the file is read and encoded when the message is serialized.
+
+    ``mimetype`` is guessed from ``filename`` (by default the base name of
+    ``path``) if not given.
+
+    """
+
+    chunk_size = 57 * 1024  # multiple of 57 bytes: base64 lines of 76 chars
+
+    def __init__(self, path, filename=None, mimetype=None):
+        filename = filename or os.path.basename(path)
+        if mimetype is None:
+            mimetype = mimetypes.guess_type(filename)[0] or DEFAULT_ATTACHMENT_MIME_TYPE
+        maintype, subtype = mimetype.split('/', 1)
+        MIMEBase.__init__(self, maintype, subtype)
+        self.path = path
+        self.marker = 'lu-dj-utils-file-attachment-%s' % uuid.uuid4().hex
+        self['Content-Transfer-Encoding'] = 'base64'
+        _add_content_disposition(self, filename)
+
+    @property
+    def _payload(self):
+        if getattr(_streaming, 'active', False):
+            return self.marker
+        if self._set_payload is not None:
+            return self._set_payload
+        return b''.join(self.iter_encoded(linesep=b'\n')).decode('ascii')
+
+    @_payload.setter
+    def _payload(self, value):
+        self._set_payload = value
+
+    def iter_encoded(self, linesep=b'\r\n'):
+        """Yield the base64-encoded content of the file, in chunks of lines
+        separated by ``linesep`` (without trailing line separator).
+
+        """
+        previous = None
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                if previous is not None:
+                    yield previous + linesep
+                previous = _encode_base64_lines(chunk, linesep)
+        if previous is not None:
+            yield previous
+
+
+class EmailSpec(object):
+
+    """Immutable, compact specification of an email message.
+
+    It holds the same data as a :class:`PlainEmail` or :class:`HTMLEmail`
+    (see :meth:`PlainEmail.to_spec` and :meth:`to_email`) but no connection:
+    address lists are stored as tuples, headers as a sorted tuple of
+    ``(name, value)`` pairs (``reply_to`` is stored as header ``'Reply-To'``),
+    attachments as a tuple and there's no
+    instance dict, so it's cheap to keep by the hundred-thousand, to hash (e.g.
+    to de-duplicate messages) and to pickle.
+
+    ``attachments`` items are ``(filename, content, mimetype)`` tuples or
+    :class:`FileAttachment` objects (other MIME parts are accepted but can't
+    be serialized by :meth:`to_dict`).
+
+    :meth:`to_dict` and :meth:`dumps` serialize it in a stable format (a
+    JSON-compatible dict, with a format version) that :meth:`from_dict` and
+    :meth:`loads` read back.
+
+    """
+
+    __slots__ = (
+        'subject', 'body', 'html_body', 'from_email', 'to', 'cc', 'bcc', 'headers',
+        'attachments')
+
+    FORMAT_VERSION = 1
+
+    def __init__(
+            self, subject='', body='', from_email=None, to=None, cc=None, bcc=None,
+            reply_to=None, attachments=None, headers=None, html_body=None):
+        headers = dict(headers or ())
+        if reply_to is not None:
+            headers['Reply-To'] = reply_to
+        _set = super(EmailSpec, self).__setattr__
+        _set('subject', subject)
+        _set('body', body)
+        _set('html_body', html_body)
+        _set('from_email', from_email)
+        _set('to', tuple(to or ()))
+        _set('cc', tuple(cc or ()))
+        _set('bcc', tuple(bcc or ()))
+        _set('headers', tuple(sorted(headers.items())))
+        _set('attachments', tuple(
+            tuple(attachment) if isinstance(attachment, (list, tuple)) else attachment
+            for attachment in attachments or ()))
+
+    def to_email(self, connection=None):
+        """Create an :class:`HTMLEmail` (if :attr:`html_body` is not None) or a
+        :class:`PlainEmail` with this specification.
+
+        :rtype: :class:`PlainEmail`
+
+        """
+        kwargs = dict(
+            subject=self.subject, body=self.body, from_email=self.from_email,
+            to=list(self.to), cc=list(self.cc), bcc=list(self.bcc), connection=connection,
+            attachments=list(self.attachments), headers=dict(self.headers))
+        if self.html_body is None:
+            return PlainEmail(**kwargs)
+        return HTMLEmail(self.html_body, **kwargs)
+
+    def replace(self, **kwargs):
+        """Return a copy with some fields replaced (e.g. ``to``).
+
+        :rtype: :class:`EmailSpec`
+
+        """
+        values = dict((name, getattr(self, name)) for name in self.__slots__)
+        values.update(kwargs)
+        return EmailSpec(**values)
+
+    def to_dict(self):
+        """Serialize as a JSON-compatible dict.
+
+        Binary attachment contents are base64-encoded and file attachments
+        are serialized by path.
+
+        :rtype: dict
+        :raises: ValueError if an attachment can't be serialized
+
+        """
+        return {
+            'version': self.FORMAT_VERSION,
+            'subject': self.subject,
+            'body': self.body,
+            'html_body': self.html_body,
+            'from_email': self.from_email,
+            'to': list(self.to),
+            'cc': list(self.cc),
+            'bcc': list(self.bcc),
+            'headers': [list(header) for header in self.headers],
+            'attachments': [_attachment_to_dict(attachment) for attachment in self.attachments],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Read a dict created by :meth:`to_dict`.
+
+        :rtype: :class:`EmailSpec`
+        :raises: ValueError if the format version is not supported
+
+        """
+        if data.get('version') != cls.FORMAT_VERSION:
+            raise ValueError("Unsupported email spec format version: %r" % data.get('version'))
+        return cls(
+            subject=data['subject'], body=data['body'], html_body=data['html_body'],
+            from_email=data['from_email'], to=data['to'], cc=data['cc'], bcc=data['bcc'],
+            headers=data['headers'],
+            attachments=[_attachment_from_dict(item) for item in data['attachments']])
+
+    def dumps(self):
+        """Serialize :meth:`to_dict` as JSON (with sorted keys, so equal specs
+        are serialized equally).
+
+        :rtype: string
+
+        """
+        return json.dumps(self.to_dict(), sort_keys=True, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, data):
+        """Read a JSON string created by :meth:`dumps`.
+
+        :rtype: :class:`EmailSpec`
+
+        """
+        return cls.from_dict(json.loads(data))
+
+    def _astuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("EmailSpec objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("EmailSpec objects are immutable")
+
+    def __reduce__(self):
+        return _email_spec_from_tuple, (self._astuple(), )
+
+    def __eq__(self, other):
+        return isinstance(other, EmailSpec) and self._astuple() == other._astuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._astuple())
+
+    def __repr__(self):
+        return '<EmailSpec subject=%r to=%r>' % (self.subject, self.to)
+
+
+def _email_spec_from_tuple(values):
+    return EmailSpec(**dict(zip(EmailSpec.__slots__, values)))
+
+
+def _attachment_to_dict(attachment):
+    if isinstance(attachment, FileAttachment):
+        return {
+            'path': attachment.path,
+            'filename': attachment.get_filename(),
+            'mimetype': attachment.get_content_type(),
+        }
+    if not isinstance(attachment, tuple):
+        raise ValueError("Attachment can't be serialized: %r" % attachment)
+    filename, content, mimetype = attachment
+    if isinstance(content, six.binary_type):
+        return {
+            'filename': filename,
+            'content_base64': base64.b64encode(content).decode('ascii'),
+            'mimetype': mimetype,
+        }
+    return {'filename': filename, 'content': content, 'mimetype': mimetype}
+
+
+def _attachment_from_dict(data):
+    if 'path' in data:
+        return FileAttachment(data['path'], data['filename'], data['mimetype'])
+    if 'content_base64' in data:
+        return data['filename'], base64.b64decode(data['content_base64']), data['mimetype']
+    return data['filename'], data['content'], data['mimetype']
+
+
+def _get_part_size(part):
+    payload = part.get_payload()
+    if isinstance(payload, six.string_types):
+        return len(payload)
+    return len(message_bytes(part))
+
+
+def create_attachment_part(filename, content, mimetype=None):
+    """Return the MIME part of an attachment, like the one Django creates
+    for :meth:`django.core.mail.EmailMessage.attach` arguments.
+
+    ``mimetype`` is guessed from ``filename`` if not given. Text content is
+    encoded with the ``DEFAULT_CHARSET`` (if it's bytes that are not UTF-8,
+    it's attached as ``application/octet-stream`` instead), messages
+    (``message/rfc822``) are not encoded and the rest is base64-encoded.
+
+    :rtype: :class:`email.mime.base.MIMEBase`
+
+    """
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(filename)[0] if filename else None
+        mimetype = mimetype or DEFAULT_ATTACHMENT_MIME_TYPE
+    basetype, subtype = mimetype.split('/', 1)
+    if basetype == 'text' and isinstance(content, six.binary_type):
+        try:
+            content = content.decode('utf-8')
+        except UnicodeDecodeError:
+            basetype, subtype = DEFAULT_ATTACHMENT_MIME_TYPE.split('/', 1)
+
+    if basetype == 'text':
+        part = SafeMIMEText(content, subtype, settings.DEFAULT_CHARSET)
+    elif basetype == 'message' and subtype == 'rfc822':
+        if isinstance(content, django.core.mail.EmailMessage):
+            content = content.message()
+        elif not isinstance(content, Message):
+            content = message_from_string(content)
+        part = SafeMIMEMessage(content, subtype)
+    else:
+        part = MIMEBase(basetype, subtype)
+        part.set_payload(content)
+        encoders.encode_base64(part)
+    if filename:
+        _add_content_disposition(part, filename)
+    return part
+
+
+def _add_content_disposition(part, filename):
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        if six.PY2:
+            filename = filename.encode('utf-8')
+        filename = ('utf-8', '', filename)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+
+
+class AttachmentCache(object):
+
+    """Cache of encoded attachment MIME parts.
+
+    Creating the MIME part of an attachment means encoding its content
+    (e.g. to base64). When the same attachment is sent with many messages,
+    :meth:`get_part` returns the same already-encoded part for all of them,
+    and it's serialized byte-for-byte in each message.
+
+    Parts are identified by filename, mimetype and a hash of the content.
+    The cache keeps at most ``maxbytes`` of encoded content, evicting the
+    least recently used parts.
+
+    """
+
+    def __init__(self, maxbytes=DEFAULT_ATTACHMENT_CACHE_BYTES):
+        self._cache = LRUCache(maxsize=None, maxbytes=maxbytes, sizeof=_get_part_size)
+
+    def get_part(self, filename, content, mimetype=None):
+        """Return the MIME part of an attachment; arguments as in
+        :meth:`django.core.mail.EmailMessage.attach`.
+
+        :rtype: :class:`email.mime.base.MIMEBase`
+
+        """
+        data = content.encode('utf-8') if isinstance(content, six.text_type) else content
+        key = (filename, mimetype, hashlib.sha1(data).hexdigest())
+        part = self._cache.get(key)
+        if part is None:
+            part = create_attachment_part(filename, content, mimetype)
+            self._cache.set(key, part)
+        return part
+
+    def get_parts(self, attachments):
+        """Replace the ``(filename, content, mimetype)`` tuples of ``attachments``
+        by their MIME parts; other items (e.g. MIME parts) are kept as they are.
+
+        :rtype: list
+
+        """
+        return [
+            self.get_part(*attachment) if isinstance(attachment, tuple) else attachment
+            for attachment in attachments]
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        """Return the cache counters (see :meth:`lu_dj_utils.lru.LRUCache.stats`).
+
+        :rtype: dict
+
+        """
+        return self._cache.stats()
+
+
+attachment_cache = AttachmentCache()
+"""Attachments cache used by :func:`send_templated_mass_mail`."""
+
+
+class EmailPhaseStats(object):
+
+    """Aggregation of the durations and message sizes sent by
+    :data:`email_phase_finished`, per phase.
+
+    Use :meth:`connect` to start collecting and :meth:`stats` or :meth:`dump`
+    to get the results.
+
+    """
+
+    def __init__(self):
+        self._durations = {}
+        self._sizes = Histogram()
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def connect(self):
+        email_phase_finished.connect(self._receive, dispatch_uid=id(self))
+
+    def disconnect(self):
+        email_phase_finished.disconnect(dispatch_uid=id(self))
+
+    def clear(self):
+        with self._lock:
+            self._durations.clear()
+            self._errors.clear()
+        self._sizes.clear()
+
+    def stats(self):
+        """Return the statistics of the durations of each phase (see
+        :meth:`lu_dj_utils.stats.Histogram.stats`) plus its number of
+        ``errors``, and the statistics of the message ``sizes``.
+
+        :return: ``{'phases': {phase: stats}, 'sizes': stats}``
+        :rtype: dict
+
+        """
+        with self._lock:
+            durations = list(self._durations.items())
+            errors = dict(self._errors)
+        phases = {}
+        for phase, histogram in durations:
+            phases[phase] = histogram.stats()
+            phases[phase]['errors'] = errors.get(phase, 0)
+        return {'phases': phases, 'sizes': self._sizes.stats()}
+
+    def dump(self):
+        """Return the statistics as text, one line per phase.
+
+        :rtype: string
+
+        """
+        stats = self.stats()
+        lines = []
+        for phase, phase_stats in sorted(stats['phases'].items()):
+            lines.append(
+                '%s: count=%s errors=%s mean=%.6f p50=%.6f p90=%.6f p99=%.6f max=%.6f' % (
+                    phase, phase_stats['count'], phase_stats['errors'], phase_stats['mean'],
+                    phase_stats['p50'], phase_stats['p90'], phase_stats['p99'],
+                    phase_stats['max']))
+        sizes = stats['sizes']
+        if sizes['count']:
+            lines.append('size: count=%s mean=%d p50=%d p90=%d p99=%d max=%d' % (
+                sizes['count'], sizes['mean'], sizes['p50'], sizes['p90'], sizes['p99'],
+                sizes['max']))
+        return '\n'.join(lines)
+
+    def _receive(self, sender, duration, size=None, error=None, **kwargs):
+        histogram = self._durations.get(sender)
+        if histogram is None:
+            with self._lock:
+                histogram = self._durations.setdefault(sender, Histogram())
+        histogram.add(duration)
+        if error is not None:
+            with self._lock:
+                self._errors[sender] = self._errors.get(sender, 0) + 1
+        if size is not None:
+            self._sizes.add(size)
+
+
+phase_stats = EmailPhaseStats()
+"""Default aggregator of :data:`email_phase_finished` (it must be connected)."""
+
+
+def _time_phase(phase):
+    """Return a context manager that sends :data:`email_phase_finished` for
+    ``phase`` when it exits, or a no-op one if there are no receivers.
+
+    Its ``active`` attribute tells which one it is; ``size`` may be set
+    before it exits if it's active.
+
+    """
+    if not email_phase_finished.receivers:
+        return _NULL_PHASE_TIMER
+    return _PhaseTimer(phase)
+
+
+class _PhaseTimer(object):
+
+    __slots__ = ('phase', 'size', '_start')
+    active = True
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.size = None
+
+    def __enter__(self):
+        self._start = _now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        email_phase_finished.send(
+            sender=self.phase, duration=_now() - self._start, size=self.size,
+            error=exc_value)
+
+
+class _NullPhaseTimer(object):
+
+    __slots__ = ()
+    active = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_PHASE_TIMER = _NullPhaseTimer()
+
+
+# ``get_connection`` kwargs that are part of the key of pooled connections
+# (with their default settings); the rest are compared by ``repr``
+_POOL_KEY_KWARGS = ('host', 'port', 'username', 'password', 'use_tls', 'use_ssl')
+
+
+class EmailConnectionPool(object):
+
+    """Thread-safe pool of open email backend connections.
+
+    Connections are grouped by their settings (backend, host, port, user,
+    password, TLS/SSL, ``fail_silently`` and any other kwarg) and at most
+    ``max_size`` connections per group are open at the same time; when all of
+    them are in use, :meth:`acquire` waits up to ``wait_timeout`` seconds
+    (forever if None) for one to be released.
+
+    Idle connections are closed after ``idle_timeout`` seconds without use and
+    every connection is closed after ``max_lifetime`` seconds. An SMTP
+    connection that has been idle for more than ``health_check_after`` seconds
+    is checked with a ``NOOP`` command before being handed out.
+
+    Use it through :meth:`connection`::
+
+        with pool.connection() as connection:
+            connection.send_messages(messages)
+
+    """
+
+    def __init__(
+            self, max_size=4, idle_timeout=60, max_lifetime=600,
+            health_check_after=5, wait_timeout=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.wait_timeout = wait_timeout
+
+        self._cond = threading.Condition()
+        self._idle = {}  # key -> list of (connection, created, last_used)
+        self._open = {}  # key -> number of open connections (idle or in use)
+        self._in_use = {}  # id(connection) -> (key, created)
+        self._hits = 0
+        self._misses = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._discarded = 0
+
+    def acquire(self, backend=None, fail_silently=False, **kwargs):
+        """Return an open connection; ``kwargs`` as in :func:`django.core.mail.get_connection`.
+
+        :raises: :class:`RuntimeError` if no connection became available
+            within ``wait_timeout`` seconds
+
+        """
+        key = self._key(backend, fail_silently, kwargs)
+        start = _now()
+        waited = False
+        to_close = []
+
+        with self._cond:
+            while True:
+                entry = self._pop_idle(key, to_close)
+                if entry is not None:
+                    self._hits += 1
+                    break
+                if self._open.get(key, 0) < self.max_size:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    self._misses += 1
+                    break
+                remaining = None
+                if self.wait_timeout is not None:
+                    remaining = self.wait_timeout - (_now() - start)
+                    if remaining <= 0:
+                        self._waits += 1
+                        self._wait_time += _now() - start
+                        raise RuntimeError(
+                            "No email connection available for %s after %s seconds" %
+                            (key, self.wait_timeout))
+                waited = True
+                self._cond.wait(remaining)
+            if waited:
+                self._waits += 1
+                self._wait_time += _now() - start
+
+        for connection in to_close:
+            _close_quietly(connection)
+
+        if entry is not None:
+            connection, created, last_used = entry
+            if _now() - last_used <= self.health_check_after or _is_healthy(connection):
+                with self._cond:
+                    self._in_use[id(connection)] = (key, created)
+                return connection
+            # broken: close it and open a new one in its place
+            _close_quietly(connection)
+            with self._cond:
+                self._discarded += 1
+
+        try:
+            connection = django.core.mail.get_connection(
+                backend, fail_silently=fail_silently, **kwargs)
+            connection.open()
+        except Exception:
+            with self._cond:
+                self._open[key] -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._in_use[id(connection)] = (key, _now())
+        return connection
+
+    def release(self, connection, discard=False):
+        """Give ``connection`` back to the pool, closing it if ``discard`` is True
+        or if it reached its maximum lifetime.
+
+        """
+        now = _now()
+        with self._cond:
+            key, created = self._in_use.pop(id(connection))
+            if not discard and now - created <= self.max_lifetime:
+                self._idle.setdefault(key, []).append((connection, created, now))
+                self._cond.notify()
+                return
+        self._discard(key, connection)
+
+    @contextlib.contextmanager
+    def connection(self, backend=None, fail_silently=False, **kwargs):
+        """Context manager to borrow a connection; it's discarded if an
+        exception is raised while in use.
+
+        """
+        connection = self.acquire(backend, fail_silently=fail_silently, **kwargs)
+        try:
+            yield connection
+        except Exception:
+            self.release(connection, discard=True)
+            raise
+        self.release(connection)
+
+    def close_all(self):
+        """Close all the idle connections."""
+        with self._cond:
+            idle, self._idle = self._idle, {}
+            for key, entries in idle.items():
+                self._open[key] -= len(entries)
+            self._cond.notify_all()
+        for entries in idle.values():
+            for connection, created, last_used in entries:
+                _close_quietly(connection)
+
+    def stats(self):
+        """Return the pool counters.
+
+        * ``hits``: connections handed out from the idle ones
+        * ``misses``: connections that had to be opened
+        * ``waits`` and ``wait_time``: number of times and total seconds
+          :meth:`acquire` had to wait for a connection to be released
+        * ``discarded``: connections closed because they were broken or expired
+        * ``open`` and ``idle``: current number of open and idle connections
+
+        :rtype: dict
+
+        """
+        with self._cond:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'waits': self._waits,
+                'wait_time': self._wait_time,
+                'discarded': self._discarded,
+                'open': sum(self._open.values()),
+                'idle': sum(len(entries) for entries in self._idle.values()),
+            }
+
+    def _key(self, backend, fail_silently, kwargs):
+        def get(name, setting_name):
+            value = kwargs.get(name)
+            return getattr(settings, setting_name, None) if value is None else value
+
+        # don't keep the password itself in the key (it's in error messages)
+        password = get('password', 'EMAIL_HOST_PASSWORD') or ''
+        if isinstance(password, six.text_type):
+            password = password.encode('utf-8')
+        others = tuple(sorted(
+            (name, repr(value)) for name, value in kwargs.items()
+            if name not in _POOL_KEY_KWARGS))
+        return (
+            backend or settings.EMAIL_BACKEND,
+            get('host', 'EMAIL_HOST'),
+            get('port', 'EMAIL_PORT'),
+            get('username', 'EMAIL_HOST_USER'),
+            hashlib.sha1(password).hexdigest(),
+            bool(get('use_tls', 'EMAIL_USE_TLS')),
+            bool(get('use_ssl', 'EMAIL_USE_SSL')),
+            bool(fail_silently),
+            others)
+
+    def _pop_idle(self, key, to_close):
+        """Pop the most recently used idle connection of ``key`` that hasn't
+        expired, appending the expired ones to ``to_close``.
+
+        Must be called with the lock held.
+
+        """
+        entries = self._idle.get(key)
+        now = _now()
+        while entries:
+            entry = entries.pop()
+            connection, created, last_used = entry
+            if (now - last_used > self.idle_timeout or
+                    now - created > self.max_lifetime):
+                self._open[key] -= 1
+                self._discarded += 1
+                to_close.append(connection)
+                continue
+            return entry
+        return None
+
+    def _discard(self, key, connection):
+        _close_quietly(connection)
+        with self._cond:
+            self._open[key] -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """Return the shared :class:`EmailConnectionPool`, or None if disabled.
+
+    The pool is enabled by the setting ``LU_EMAIL_CONNECTION_POOL``, a dict of
+    :class:`EmailConnectionPool` constructor kwargs (it may be empty). When
+    enabled, :meth:`PlainEmail.send` and :func:`send_mail2` borrow their
+    connection from it if none was given.
+
+    """
+    global _connection_pool
+    options = getattr(settings, 'LU_EMAIL_CONNECTION_POOL', None)
+    if options is None:
+        return None
+    if _connection_pool is None:
+        with _connection_pool_lock:
+            if _connection_pool is None:
+                _connection_pool = EmailConnectionPool(**options)
+    return _connection_pool
+
+
+def _is_healthy(connection):
+    """Check that an open backend connection is still usable.
+
+    Only SMTP connections can be checked (with a ``NOOP`` command); other
+    backends are assumed to be healthy.
+
+    """
+    if not hasattr(connection, 'connection'):
+        return True
+    if connection.connection is None:
+        return False
+    try:
+        return connection.connection.noop()[0] == 250
+    except (smtplib.SMTPException, socket.error):
+        return False
+
+
+def _close_quietly(connection):
+    #noinspection PyBroadException
+    try:
+        connection.close()
+    except Exception:
+        logger.warning("Failed to close email connection.", exc_info=True)
+
+
+class RateLimiter(object):
+
+    """Scheduler of sends that keeps within the quotas of an email provider.
+
+    ``quotas`` is a list of ``(count, period)`` pairs: at most ``count``
+    sends every ``period`` seconds (e.g. ``[(10, 1), (5000, 3600)]``). Each
+    quota is a leaky bucket (GCRA): sends are spaced ``period / count``
+    seconds apart, allowing bursts of ``burst`` sends. The cost of a send is
+    1, or its number of recipients if ``per_recipient`` is True.
+
+    Callers don't poll: :meth:`reserve` books the earliest time slot allowed
+    by all the quotas and returns how long to wait for it, so waiting callers
+    are served in order and the sending rate stays right at the quota. It's
+    safe to use from threads (:meth:`acquire`) and from asyncio
+    (:func:`lu_dj_utils.email_async.wait_rate_limit`).
+
+    When the server replies that it's overloaded (SMTP codes 421 and 451, see
+    :meth:`notify_error`) the rate is multiplied by ``decrease``, down to
+    ``min_factor`` times the quota; it's increased again by ``increase``
+    times the quota on each successful send (see :meth:`notify_success`).
+
+    """
+
+    THROTTLE_CODES = (421, 451)
+
+    def __init__(self, quotas, burst=1, per_recipient=False, decrease=0.5, increase=0.01,
+                 min_factor=0.1):
+        self.quotas = [(count, float(period)) for count, period in quotas]
+        self.burst = burst
+        self.per_recipient = per_recipient
+        self.decrease = decrease
+        self.increase = increase
+        self.min_factor = min_factor
+        self.factor = 1.0
+        self._arrivals = [None] * len(self.quotas)
+        self._lock = threading.Lock()
+        self._waits = Histogram()
+        self._throttled = 0
+
+    def get_cost(self, message):
+        return len(message.recipients()) if self.per_recipient else 1
+
+    def reserve(self, cost=1):
+        """Book the earliest time to send something of ``cost``.
+
+        :return: seconds to wait before sending
+        :rtype: float
+
+        """
+        with self._lock:
+            now = _now()
+            start = now
+            intervals = []
+            for i, (count, period) in enumerate(self.quotas):
+                interval = period / count / self.factor
+                arrival = self._arrivals[i]
+                if arrival is not None:
+                    start = max(start, arrival - (self.burst - 1) * interval)
+                intervals.append(interval)
+            for i, interval in enumerate(intervals):
+                arrival = self._arrivals[i]
+                arrival = start if arrival is None else max(start, arrival)
+                self._arrivals[i] = arrival + cost * interval
+        delay = start - now
+        self._waits.add(delay)
+        return delay
+
+    def acquire(self, cost=1):
+        """Block the current thread until something of ``cost`` can be sent.
+
+        :return: seconds waited
+        :rtype: float
+
+        """
+        delay = self.reserve(cost)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def notify_error(self, error):
+        """Slow down if ``error`` (raised when sending) tells that the server
+        is overloaded.
+
+        :return: whether the rate was decreased
+        :rtype: bool
+
+        """
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            codes = [code for code, _ in error.recipients.values()]
+        else:
+            codes = [getattr(error, 'smtp_code', None)]
+        if not any(code in self.THROTTLE_CODES for code in codes):
+            return False
+        with self._lock:
+            self.factor = max(self.min_factor, self.factor * self.decrease)
+            self._throttled += 1
+        logger.warning("Email server is throttling; rate decreased to %.0f%% of the quota." %
+                       (self.factor * 100))
+        return True
+
+    def notify_success(self):
+        if self.factor < 1:
+            with self._lock:
+                self.factor = min(1.0, self.factor + self.increase)
+
+    def stats(self):
+        """Return how long sends waited (``waits``, see
+        :meth:`lu_dj_utils.stats.Histogram.stats`), the number of times the
+        server was ``throttled`` and the current rate ``factor``.
+
+        :rtype: dict
+
+        """
+        return {
+            'waits': self._waits.stats(),
+            'throttled': self._throttled,
+            'factor': self.factor,
+        }
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key):
+    """Return the shared :class:`RateLimiter` of ``key``, or None if disabled.
+
+    Rate limiters are configured by the setting ``LU_EMAIL_RATE_LIMITS``, a
+    dict that maps keys to :class:`RateLimiter` constructor kwargs. Keys are
+    SMTP hosts (relays) or, for other email backends, their import paths;
+    key ``'*'`` matches the rest.
+
+    :param key: SMTP host or email backend path (see :func:`get_rate_limit_key`)
+
+    """
+    limits = getattr(settings, 'LU_EMAIL_RATE_LIMITS', None)
+    if not limits:
+        return None
+    if key not in limits:
+        key = '*'
+    options = limits.get(key)
+    if options is None:
+        return None
+    entry = _rate_limiters.get(key)
+    if entry is None or entry[0] != options:
+        with _rate_limiters_lock:
+            entry = _rate_limiters.get(key)
+            if entry is None or entry[0] != options:
+                entry = (options, RateLimiter(**options))
+                _rate_limiters[key] = entry
+    return entry[1]
+
+
+def get_rate_limit_key(connection):
+    """Return the key of the rate limiter of an email backend ``connection``:
+    its host, if it's SMTP, or its import path.
+
+    """
+    if isinstance(connection, SMTPEmailBackend):
+        return connection.host
+    return '%s.%s' % (connection.__class__.__module__, connection.__class__.__name__)
+
+
+class DispatchHandle(object):
+
+    """Handle to the result of a call submitted to an :class:`EmailDispatcher`."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        """Whether the call has finished."""
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Wait (at most ``timeout`` seconds) for the call to finish and return
+        its result, or raise its exception.
+
+        :raises: :class:`RuntimeError` if the call didn't finish in time
+
+        """
+        if not self._event.wait(timeout):
+            raise RuntimeError("Dispatched call did not finish in %s seconds" % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def _set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def _set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+
+class EmailDispatcher(object):
+
+    """Run email-sending calls in background threads.
+
+    Calls are put in a work queue of at most ``queue_size`` items drained by
+    ``workers`` threads, started on the first :meth:`submit`. When the queue
+    is full, :meth:`submit` blocks for at most ``put_timeout`` seconds
+    (forever if None) before giving up.
+
+    The queue is drained when the process exits (see :meth:`shutdown`).
+
+    """
+
+    def __init__(self, workers=2, queue_size=1000, put_timeout=None):
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self._queue = six.moves.queue.Queue(queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shut_down = False
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule ``func(*args, **kwargs)`` to be run by a worker thread.
+
+        :rtype: :class:`DispatchHandle`
+        :raises: :class:`six.moves.queue.Full` if the queue is still full after
+            ``put_timeout`` seconds
+        :raises: :class:`RuntimeError` if the dispatcher was shut down
+
+        """
+        if self._shut_down:
+            raise RuntimeError("Can't submit to a dispatcher that was shut down")
+        if not self._threads:
+            self._start()
+        handle = DispatchHandle()
+        self._queue.put((handle, func, args, kwargs), timeout=self.put_timeout)
+        return handle
+
+    def shutdown(self, wait=True):
+        """Stop accepting calls and stop the workers once the queue is drained.
+
+        :param wait: whether to block until all the queued calls are done
+
+        """
+        with self._lock:
+            if self._shut_down:
+                return
+            self._shut_down = True
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def qsize(self):
+        """Return the approximate number of calls waiting in the queue."""
+        return self._queue.qsize()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name='EmailDispatcher-%s' % i)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        atexit.register(self.shutdown)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            handle, func, args, kwargs = item
+            #noinspection PyBroadException
+            try:
+                handle._set_result(func(*args, **kwargs))
+            except Exception as e:
+                logger.exception("Dispatched email call failed: %s" % func)
+                handle._set_exception(e)
+            finally:
+                close_old_connections()
+
+
+_email_dispatcher = None
+_email_dispatcher_lock = threading.Lock()
+
+
+def get_email_dispatcher():
+    """Return the shared :class:`EmailDispatcher`.
+
+    It is configured by the setting ``LU_EMAIL_DISPATCHER``, a dict of
+    :class:`EmailDispatcher` constructor kwargs (optional).
+
+    """
+    global _email_dispatcher
+    if _email_dispatcher is None:
+        with _email_dispatcher_lock:
+            if _email_dispatcher is None:
+                options = getattr(settings, 'LU_EMAIL_DISPATCHER', {})
+                _email_dispatcher = EmailDispatcher(**options)
+    return _email_dispatcher
+
+
+class RawEmailMessage(django.core.mail.EmailMessage):
+
+    """Already serialized email message, sent as it is.
+
+    It's sent like any :class:`django.core.mail.EmailMessage` but its
+    :meth:`message` is ``data`` (e.g. the result of :func:`message_bytes`):
+    the headers, body and attachments are not built again. All the
+    envelope recipients are kept in ``to``.
+
+    """
+
+    def __init__(self, from_email, recipients, data, connection=None):
+        super(RawEmailMessage, self).__init__(
+            from_email=from_email, to=recipients, connection=connection)
+        self.data = data
+
+    def message(self):
+        return _RawMIMEMessage(self.data)
+
+
+class _RawMIMEMessage(object):
+
+    """The subset of :class:`email.message.Message` used by email backends."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def as_bytes(self, unixfrom=False, linesep='\n'):
+        return self.data
+
+    def as_string(self, unixfrom=False, linesep='\n'):
+        return self.data if six.PY2 else self.data.decode('utf-8', 'replace')
+
+    def walk(self):
+        yield self
+
+
+class DeliveryReport(object):
+
+    """Outcome of sending messages, per recipient.
+
+    :attr:`sent` is the list of recipients that accepted a message and
+    :attr:`failed` maps the others to a description of the error.
+
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.failed = {}
+        self._lock = threading.Lock()
+
+    def add_sent(self, recipients):
+        with self._lock:
+            self.sent.extend(recipients)
+
+    def add_failed(self, recipients, error):
+        with self._lock:
+            for recipient in recipients:
+                self.failed[recipient] = error
+
+    def stats(self):
+        """Return the number of recipients that were ``sent`` and ``failed``.
+
+        :rtype: dict
+
+        """
+        with self._lock:
+            return {'sent': len(self.sent), 'failed': len(self.failed)}
+
+    def __repr__(self):
+        return '<DeliveryReport sent=%s failed=%s>' % (len(self.sent), len(self.failed))
+
+
+class EmailOutbox(object):
+
+    """Durable queue of fully rendered email messages, stored in an SQLite
+    database at ``path``.
+
+    Messages are stored with :meth:`put` and sent by :meth:`drain`, which may
+    be called concurrently by several processes (e.g. by the
+    ``drain_email_outbox`` management command): each message is leased to
+    one of them for ``lease`` seconds.
+
+    A message that fails to be sent is retried after an exponential backoff
+    (``backoff`` seconds, doubled on each attempt up to ``max_backoff``, with
+    jitter). After ``max_attempts`` attempts, or a permanent (5xx) SMTP
+    error, it's kept as a dead letter (see :meth:`requeue_dead`).
+
+    Delivery is at-least-once: a message is removed after it's sent, so a
+    process that dies after sending it but before removing it results in a
+    duplicate.
+
+    """
+
+    def __init__(self, path, max_attempts=8, backoff=60, max_backoff=3600, lease=300,
+                 batch_size=100):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self.batch_size = batch_size
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS outbox ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' from_email TEXT NOT NULL,'
+                ' recipients TEXT NOT NULL,'
+                ' data BLOB NOT NULL,'
+                ' created_at REAL NOT NULL,'
+                ' attempts INTEGER NOT NULL DEFAULT 0,'
+                ' next_attempt_at REAL NOT NULL,'
+                ' locked_until REAL NOT NULL DEFAULT 0,'
+                ' last_error TEXT,'
+                ' dead INTEGER NOT NULL DEFAULT 0)')
+            db.execute(
+                'CREATE INDEX IF NOT EXISTS outbox_due ON outbox (dead, next_attempt_at)')
+
+    def put(self, message, delay=0):
+        """Store ``message`` (a :class:`django.core.mail.EmailMessage`, a
+        :class:`PlainEmail` or an :class:`EmailSpec`) to be sent in ``delay``
+        seconds.
+
+        :return: the id of the stored message
+        :rtype: int
+
+        """
+        if isinstance(message, EmailSpec):
+            message = message.to_email()
+        if isinstance(message, PlainEmail):
+            message = message.create_message()
+        data = message_bytes(message.message())
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute(
+                'INSERT INTO outbox (from_email, recipients, data, created_at, next_attempt_at)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (message.from_email, json.dumps(message.recipients()),
+                 sqlite3.Binary(data), now, now + delay))
+            return cursor.lastrowid
+
+    def drain(self, connection=None, limit=None):
+        """Send the messages that are due, in batches of ``batch_size`` over
+        a single connection (by default, the result of
+        :func:`django.core.mail.get_connection`).
+
+        :param limit: maximum number of messages to process (None: all of them)
+        :return: the number of messages that were ``sent``, ``deferred``
+            (to be retried) and moved to the ``dead`` letters
+        :rtype: dict
+
+        """
+        counts = {'sent': 0, 'deferred': 0, 'dead': 0}
+        if connection is None:
+            connection = django.core.mail.get_connection()
+        processed = 0
+        while limit is None or processed < limit:
+            size = self.batch_size if limit is None else min(self.batch_size, limit - processed)
+            rows = self._claim(size)
+            if not rows:
+                break
+            processed += len(rows)
+            self._send_batch(connection, rows, counts)
+        return counts
+
+    def stats(self):
+        """Return the number of ``queued`` messages (not dead), how many are
+        ``due``, the number of ``dead`` letters and the age in seconds of the
+        oldest queued message (``oldest_age``, None if there are none).
+
+        :rtype: dict
+
+        """
+        now = time.time()
+        with self._transaction() as db:
+            queued, due, oldest = db.execute(
+                'SELECT COUNT(*), SUM(next_attempt_at <= ?), MIN(created_at)'
+                ' FROM outbox WHERE dead = 0', (now,)).fetchone()
+            dead, = db.execute('SELECT COUNT(*) FROM outbox WHERE dead = 1').fetchone()
+        return {
+            'queued': queued,
+            'due': due or 0,
+            'dead': dead,
+            'oldest_age': None if oldest is None else now - oldest,
+        }
+
+    def requeue_dead(self):
+        """Queue the dead letters again, to be sent as soon as possible.
+
+        :return: the number of requeued messages
+        :rtype: int
+
+        """
+        with self._transaction() as db:
+            return db.execute(
+                'UPDATE outbox SET dead = 0, attempts = 0, next_attempt_at = ?'
+                ' WHERE dead = 1', (time.time(), )).rowcount
+
+    def _claim(self, size):
+        now = time.time()
+        with self._transaction() as db:
+            rows = db.execute(
+                'SELECT id, from_email, recipients, data, attempts FROM outbox'
+                ' WHERE dead = 0 AND next_attempt_at <= ? AND locked_until <= ?'
+                ' ORDER BY next_attempt_at, id LIMIT ?', (now, now, size)).fetchall()
+            db.executemany(
+                'UPDATE outbox SET locked_until = ? WHERE id = ?',
+                [(now + self.lease, row[0]) for row in rows])
+        return rows
+
+    def _send_batch(self, connection, rows, counts):
+        sent, deferred, dead = [], [], []
+        new_conn_created = False
+        #noinspection PyBroadException
+        try:
+            new_conn_created = connection.open()
+        except Exception as e:
+            logger.warning("Failed to open email connection for the outbox: %s" % e)
+            deferred = [(row, e) for row in rows]
+            rows = []
+        try:
+            for row in rows:
+                message_id, from_email, recipients, data, attempts = row
+                message = RawEmailMessage(from_email, json.loads(recipients), bytes(data))
+                #noinspection PyBroadException
+                try:
+                    if not _send_reconnecting(connection, message):
+                        raise smtplib.SMTPException("No mail was sent")
+                except Exception as e:
+                    if _is_permanent_error(e) or attempts + 1 >= self.max_attempts:
+                        logger.exception("Outbox message %s is a dead letter." % message_id)
+                        dead.append((row, e))
+                    else:
+                        logger.warning("Outbox message %s failed: %s" % (message_id, e))
+                        deferred.append((row, e))
+                else:
+                    sent.append(row)
+        finally:
+            if new_conn_created:
+                _close_quietly(connection)
+
+        now = time.time()
+        with self._transaction() as db:
+            db.executemany('DELETE FROM outbox WHERE id = ?', [(row[0], ) for row in sent])
+            db.executemany(
+                'UPDATE outbox SET attempts = ?, next_attempt_at = ?, locked_until = 0,'
+                ' last_error = ? WHERE id = ?',
+                [(row[4] + 1, now + self._get_delay(row[4] + 1), repr(e), row[0])
+                 for row, e in deferred])
+            db.executemany(
+                'UPDATE outbox SET attempts = ?, locked_until = 0, last_error = ?, dead = 1'
+                ' WHERE id = ?',
+                [(row[4] + 1, repr(e), row[0]) for row, e in dead])
+        counts['sent'] += len(sent)
+        counts['deferred'] += len(deferred)
+        counts['dead'] += len(dead)
+
+    def _get_delay(self, attempts):
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        return random.uniform(delay / 2.0, delay)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+
+def _is_permanent_error(error):
+    """Whether sending a message failed with a permanent (5xx) SMTP error."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+_email_outbox = None
+_email_outbox_lock = threading.Lock()
+
+
+def get_email_outbox():
+    """Return the shared :class:`EmailOutbox`, or None if disabled.
+
+    The outbox is enabled by the setting ``LU_EMAIL_OUTBOX``, a dict of
+    :class:`EmailOutbox` constructor kwargs (``path`` is required). When
+    enabled, :func:`send_templated_mail` stores in it the messages that fail
+    to be sent.
+
+    """
+    global _email_outbox
+    options = getattr(settings, 'LU_EMAIL_OUTBOX', None)
+    if options is None:
+        return None
+    if _email_outbox is None:
+        with _email_outbox_lock:
+            if _email_outbox is None:
+                _email_outbox = EmailOutbox(**options)
+    return _email_outbox
+
+
+class TemplateCache(object):
+
+    """Bounded LRU cache of compiled templates, by name.
+
+    Finding and compiling a template goes through the whole template loader
+    chain; when many messages are rendered with the same templates that work
+    is done just once.
+
+    If ``enabled`` is False (by default, if ``settings.DEBUG`` is True)
+    templates are not cached, so edited templates are used right away in
+    development.
+
+    If ``check_mtime`` is True a cached template is compiled again when its
+    source file changes. This needs the template origin, which Django only
+    keeps when template debug is enabled.
+
+    """
+
+    def __init__(self, maxsize=64, check_mtime=False, enabled=None):
+        self._cache = LRUCache(maxsize)
+        self.check_mtime = check_mtime
+        self._enabled = enabled
+        self._reloads = 0
+
+    @property
+    def enabled(self):
+        if self._enabled is None:
+            return not settings.DEBUG
+        return self._enabled
+
+    def get_template(self, template_name):
+        """Return the compiled template named ``template_name``."""
+        if not self.enabled:
+            return get_template(template_name)
+        entry = self._cache.get(template_name)
+        if entry is not None:
+            template, path, mtime = entry
+            if not self.check_mtime or _get_mtime(path) == mtime:
+                return template
+            self._reloads += 1
+
+        template = get_template(template_name)
+        path = _get_template_path(template)
+        self._cache.set(template_name, (template, path, _get_mtime(path)))
+        return template
+
+    def render(self, template_name, context=None):
+        """Render the template named ``template_name`` with ``context``
+        (equivalent to :func:`django.template.loader.render_to_string`).
+
+        """
+        template = self.get_template(template_name)
+        if django.VERSION < (1, 8):
+            context = context if isinstance(context, Context) else Context(context)
+        return template.render(context)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        """Return the cache counters: ``hits``, ``misses``, ``evictions``,
+        ``size`` and ``reloads`` (templates compiled again because their
+        source file changed).
+
+        :rtype: dict
+
+        """
+        stats = self._cache.stats()
+        stats['reloads'] = self._reloads
+        return stats
+
+
+template_cache = TemplateCache()
+"""Templates cache used to render email messages."""
+
+
+def _get_template_path(template):
+    """Return the path of ``template``'s source file, if known."""
+    template = getattr(template, 'template', template)  # Django 1.8+ backend wrapper
+    origin = getattr(template, 'origin', None)
+    return getattr(origin, 'name', None)
+
+
+def _get_mtime(path):
+    if path is None:
+        return None
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
 def send_mail2(
         subject='', body='', from_email=None, to=None, cc=None, bcc=None,
         reply_to=None, fail_silently=False, auth_user=None,
-        auth_password=None, connection=None, attachments=None, headers=None):
+        auth_password=None, connection=None, attachments=None, headers=None,
+        validate_recipients=False):
     """Combination of :func:`django.core.mail.send_mail` and
     :class:`django.core.mail.EmailMessage`.
 
@@ -112,11 +1719,17 @@ def send_mail2(
     Check parameters definitions at :class:`django.core.mail.EmailMessage`
     and :func:`django.core.mail.get_connection`.
 
+    With ``validate_recipients=True``, the addresses are validated,
+    normalized and de-duplicated with :data:`address_validator` (see
+    :meth:`AddressValidator.validate_recipients`): invalid ones are dropped
+    (and logged) and, if none is left, nothing is sent.
+
     :return: the number of email messages sent (return value of
         :meth:`EmailMessage.send`)
 
     .. warning::
-        All passed email addresses must be validated beforehand. For example,
+        Unless ``validate_recipients`` is True, all passed email addresses
+        must be validated beforehand. For example,
         all these values **WILL** result in a message being sent
         (i.e. return value will be ``> 0``:
         ``['', ' ', 'x', 'x@x']``
@@ -133,20 +1746,38 @@ def send_mail2(
     # 4. create the EmailMessage object
     # 5. send it
 
-    if to is not None:
-        validate_addresses(to)
-    if cc is not None:
-        validate_addresses(cc)
-    if bcc is not None:
-        validate_addresses(bcc)
+    if validate_recipients:
+        to, cc, bcc, rejected = address_validator.validate_recipients(to, cc, bcc)
+        if rejected:
+            logger.warning("Rejected email addresses: %s" % (rejected, ))
+        if not (to or cc or bcc):
+            return 0
+    else:
+        if to is not None:
+            validate_addresses(to)
+        if cc is not None:
+            validate_addresses(cc)
+        if bcc is not None:
+            validate_addresses(bcc)
+
+    headers = set_header_reply_to(headers, reply_to)
 
     if connection is None:
+        pool = get_connection_pool()
+        if pool is not None:
+            with pool.connection(
+                    username=auth_user, password=auth_password,
+                    fail_silently=fail_silently) as connection:
+                message = django.core.mail.EmailMessage(
+                    subject, body, from_email, to, bcc, connection, attachments,
+                    headers, cc)
+                return message.send()
+
         connection = django.core.mail.get_connection(
             username=auth_user,
             password=auth_password,
             fail_silently=fail_silently)
 
-    headers = set_header_reply_to(headers, reply_to)
     message = django.core.mail.EmailMessage(
         subject, body, from_email, to, bcc, connection, attachments, headers, cc)
 
@@ -177,6 +1808,10 @@ def send_templated_mail(
     :return: True if at least one message is sent successfully; False otherwise
     :rtype: bool
 
+    If the email outbox is enabled (see :func:`get_email_outbox`), a message
+    that fails to be sent is stored in it to be retried later (the return
+    value is still False).
+
     .. warning::
         All passed email addresses **must** be validated beforehand.
 
@@ -187,26 +1822,18 @@ def send_templated_mail(
     """
     #noinspection PyBroadException
     try:
-        subject = render_to_string(subject_template_name, context)
-        subject = ''.join(subject.splitlines())
-        body = render_to_string(body_template_name, context)
-        if html_body_template_name is None:
-            html_body = None
-        else:
-            html_body = render_to_string(html_body_template_name, context)
+        subject, body, html_body = render_templated_mail(
+            context, subject_template_name, body_template_name, html_body_template_name)
     except Exception:
         logger.exception(
             "Failed to render body or subject.\nTemplate names: (%s, %s, %s)\nContext: %s" %
             (subject_template_name, body_template_name, html_body_template_name, context))
         return False
 
+    message = None
     #noinspection PyBroadException
     try:
-        if html_body is None:
-            message = PlainEmail(subject=subject, body=body, **kwargs)
-        else:
-            message = HTMLEmail(html_body, subject=subject, body=body, **kwargs)
-
+        message = _create_templated_email(subject, body, html_body, **kwargs)
         result = message.send()
         if not result >= 1:
             logger.error("No mail was sent.\nsubject: %s\nbody: %s\nkwargs: %s" %
@@ -215,10 +1842,812 @@ def send_templated_mail(
     except Exception:
         logger.exception("send_templated_mail failed.\nsubject: %s\nbody: %s\nkwargs: %s" %
                          (subject, body, kwargs))
+        if message is not None:
+            _put_in_outbox(message)
         return False
     return True
 
 
+def queue_templated_mail(
+        context, subject_template_name, body_template_name, html_body_template_name=None,
+        **kwargs):
+    """Like :func:`send_templated_mail` but, instead of sending the message,
+    store it in the outbox (see :func:`get_email_outbox`) to be sent by a
+    worker process.
+
+    :return: the id of the stored message, or None if it failed
+    :rtype: int or None
+    :raises: :class:`django.core.exceptions.ImproperlyConfigured` if the
+        outbox is not enabled
+
+    """
+    outbox = get_email_outbox()
+    if outbox is None:
+        raise ImproperlyConfigured("The email outbox is not enabled (LU_EMAIL_OUTBOX)")
+
+    #noinspection PyBroadException
+    try:
+        subject, body, html_body = render_templated_mail(
+            context, subject_template_name, body_template_name, html_body_template_name)
+        message = _create_templated_email(subject, body, html_body, **kwargs)
+        return outbox.put(message)
+    except Exception:
+        logger.exception(
+            "queue_templated_mail failed.\nTemplate names: (%s, %s, %s)\nContext: %s" %
+            (subject_template_name, body_template_name, html_body_template_name, context))
+        return None
+
+
+def send_templated_mass_mail(
+        contexts, subject_template_name, body_template_name, html_body_template_name=None,
+        **kwargs):
+    """Send one templated message per item of ``contexts`` over a single connection.
+
+    ``contexts`` is an iterable (it may be a generator) of ``(context, recipients)``
+    pairs: each message is rendered like in :func:`send_templated_mail` using
+    ``context`` and is sent to ``recipients`` (its ``to`` list). Items are
+    consumed in batches of ``batch_size`` (kwarg) so memory usage doesn't
+    depend on the total number of messages.
+
+    The connection (kwarg ``connection`` or else the result of
+    :func:`django.core.mail.get_connection`) is opened once and reused for all
+    messages. If the server drops the session, the connection is opened again
+    and the message is retried once. If it can't be opened, every message
+    fails.
+
+    If many messages are identical, rendering can be done once per distinct
+    message by passing kwarg ``dedupe_keys``: True to identify messages by
+    their whole context, or the context keys used by the templates (see
+    :func:`context_fingerprint`). Rendered messages are kept in a table of
+    at most ``render_cache_size`` (kwarg) items.
+
+    With ``validate_recipients=True`` (kwarg), the recipients of each
+    message are validated, normalized and de-duplicated with
+    :data:`address_validator`: invalid ones are dropped (and logged) and
+    messages without valid recipients fail, without being rendered.
+
+    The remaining ``kwargs`` are passed directly to :class:`PlainEmail`
+    (e.g. cc, bcc, headers, attachments). Attachments are encoded once, for
+    all the messages (see :data:`attachment_cache`).
+
+    :param contexts: ``(context, recipients)`` pairs
+    :type contexts: iterable
+    :return: one boolean per item of ``contexts``: True if its message was
+        sent successfully; False otherwise
+    :rtype: list
+
+    .. warning::
+        Unless ``validate_recipients`` is True, all passed email addresses
+        **must** be validated beforehand.
+
+    """
+    batch_size = kwargs.pop('batch_size', DEFAULT_MASS_MAIL_BATCH_SIZE)
+    render_memo = _pop_render_memo(kwargs)
+    validator = _pop_address_validator(kwargs)
+    connection = kwargs.pop('connection', None)
+    if kwargs.get('attachments'):
+        kwargs['attachments'] = attachment_cache.get_parts(kwargs['attachments'])
+    if connection is None:
+        connection = django.core.mail.get_connection()
+
+    #noinspection PyBroadException
+    try:
+        new_conn_created = connection.open()
+    except Exception:
+        logger.exception("send_templated_mass_mail failed to open the connection.")
+        return [False for _ in contexts]
+
+    results = []
+    try:
+        for batch in _iter_batches(contexts, batch_size):
+            messages = [
+                _create_templated_mass_message(
+                    context, recipients, subject_template_name, body_template_name,
+                    html_body_template_name, kwargs, render_memo, validator)
+                for context, recipients in batch]
+            results.extend(_send_mass_mail_batch(connection, messages))
+    finally:
+        if new_conn_created:
+            connection.close()
+    return results
+
+
+def send_templated_mass_mail_multiprocess(
+        contexts, subject_template_name, body_template_name, html_body_template_name=None,
+        **kwargs):
+    """Like :func:`send_templated_mass_mail` but rendering and serializing the
+    messages in a pool of ``processes`` (kwarg; by default, one per CPU)
+    worker processes, and sending them over ``senders`` (kwarg) connections
+    at the same time, one per thread.
+
+    Building MIME messages (specially, encoding HTML bodies and attachments)
+    is CPU-bound pure-Python work that threads can't run in parallel; worker
+    processes return the messages as bytes, ready to be sent.
+
+    Items of ``contexts`` are consumed in batches of ``batch_size`` (kwarg)
+    and handed to workers in chunks of ``chunksize`` (kwarg) items. Worker
+    processes are forked (or started, depending on the platform) when this
+    function is called, so this is worth it only for big mailings. If they
+    can't set Django up (e.g. started processes when settings are configured
+    with ``settings.configure()``), :class:`RuntimeError` is raised.
+
+    The remaining ``kwargs`` are handled like in :func:`send_templated_mass_mail`
+    (except ``connection``, not supported) and they must be picklable.
+
+    :param contexts: ``(context, recipients)`` pairs
+    :type contexts: iterable
+    :return: delivery report of all the recipients
+    :rtype: :class:`DeliveryReport`
+
+    .. warning::
+        All passed email addresses **must** be validated beforehand.
+
+    """
+    processes = kwargs.pop('processes', None) or multiprocessing.cpu_count()
+    senders = kwargs.pop('senders', DEFAULT_MASS_MAIL_SENDERS)
+    batch_size = kwargs.pop('batch_size', DEFAULT_MASS_MAIL_BATCH_SIZE * processes)
+    chunksize = kwargs.pop('chunksize', max(1, batch_size // (processes * 4)))
+    if kwargs.get('attachments'):
+        kwargs['attachments'] = attachment_cache.get_parts(kwargs['attachments'])
+
+    report = DeliveryReport()
+    # fork before starting threads: a worker must not inherit a lock held by
+    # one of them (e.g. the import lock)
+    pool = multiprocessing.Pool(
+        processes, _init_mime_worker,
+        (subject_template_name, body_template_name, html_body_template_name, kwargs))
+    try:
+        messages, threads = _start_senders(senders, senders * chunksize * 4, report)
+    except BaseException:
+        pool.terminate()
+        pool.join()
+        raise
+    try:
+        for batch in _iter_batches(contexts, batch_size):
+            for recipients, raw, error in pool.imap(_build_raw_message, batch, chunksize):
+                if raw is None:
+                    report.add_failed(recipients, error)
+                else:
+                    messages.put(RawEmailMessage(*raw))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _stop_senders(messages, threads)
+    return report
+
+
+def send_fan_out(message, chunk_size=DEFAULT_FAN_OUT_CHUNK_SIZE,
+                 connections=DEFAULT_FAN_OUT_CONNECTIONS):
+    """Send ``message`` to its recipients in envelopes of at most
+    ``chunk_size`` recipients, over ``connections`` connections at the same
+    time (one per thread, from :func:`django.core.mail.get_connection`).
+
+    This is meant for messages with very long recipient lists (e.g. a big
+    ``bcc``): servers limit the number of recipients per message and, in a
+    single envelope, a slow recipient delays all the others. The message is
+    serialized once and the same bytes are sent in every envelope.
+
+    :param message: the message; its ``connection`` is not used
+    :type message: :class:`django.core.mail.EmailMessage` or :class:`PlainEmail`
+    :return: delivery report of all the recipients
+    :rtype: :class:`DeliveryReport`
+
+    """
+    if isinstance(message, PlainEmail):
+        message = message.create_message()
+    report = DeliveryReport()
+    recipients = message.recipients()
+    if not recipients:
+        return report
+    data = message_bytes(message.message())
+
+    chunks = _iter_batches(recipients, chunk_size)
+    connections = min(connections, (len(recipients) + chunk_size - 1) // chunk_size)
+    messages, threads = _start_senders(connections, connections * 2, report)
+    try:
+        for chunk in chunks:
+            messages.put(RawEmailMessage(message.from_email, chunk, data))
+    finally:
+        _stop_senders(messages, threads)
+    return report
+
+
+def dispatch_templated_mail(
+        context, subject_template_name, body_template_name, html_body_template_name=None,
+        **kwargs):
+    """Like :func:`send_templated_mail` but the message is rendered and sent in
+    background by the shared :class:`EmailDispatcher`.
+
+    This function returns as soon as the message is accepted by the
+    dispatcher. If its queue is full it blocks, at most for the dispatcher's
+    ``put_timeout`` seconds.
+
+    :return: handle whose result is the return value of
+        :func:`send_templated_mail`, or None if the message was not accepted
+        because the queue is full
+    :rtype: :class:`DispatchHandle` or None
+
+    """
+    try:
+        return get_email_dispatcher().submit(
+            send_templated_mail, context, subject_template_name, body_template_name,
+            html_body_template_name, **kwargs)
+    except six.moves.queue.Full:
+        logger.error(
+            "Email dispatch queue is full; message not accepted.\n"
+            "Template names: (%s, %s, %s)\nContext: %s\nkwargs: %s" %
+            (subject_template_name, body_template_name, html_body_template_name,
+             context, kwargs))
+        return None
+
+
+def _put_in_outbox(message):
+    """Store a message that failed to be sent in the outbox, if enabled."""
+    outbox = get_email_outbox()
+    if outbox is None:
+        return
+    message = message.create_message()
+    if not message.recipients():
+        return
+    #noinspection PyBroadException
+    try:
+        message_id = outbox.put(message, delay=outbox.backoff)
+    except Exception:
+        logger.exception("Failed to store message in the outbox.\nsubject: %s\nto: %s" %
+                         (message.subject, message.to))
+    else:
+        logger.warning("Message stored in the outbox with id %s." % message_id)
+
+
+def render_templated_mail(
+        context, subject_template_name, body_template_name, html_body_template_name=None):
+    """Render the subject, body and (optionally) HTML body templates.
+
+    The rendered subject is joined into a single line. Templates are taken
+    from :data:`template_cache`.
+
+    :return: ``(subject, body, html_body)``; ``html_body`` is None if
+        ``html_body_template_name`` is None
+    :rtype: tuple
+
+    """
+    with _time_phase('render_subject'):
+        subject = template_cache.render(subject_template_name, context)
+    subject = ''.join(subject.splitlines())
+    with _time_phase('render_body'):
+        body = template_cache.render(body_template_name, context)
+    if html_body_template_name is None:
+        html_body = None
+    else:
+        with _time_phase('render_html_body'):
+            html_body = template_cache.render(html_body_template_name, context)
+    return subject, body, html_body
+
+
+def context_fingerprint(context, keys=None):
+    """Return a hash identifying the contents of ``context``.
+
+    Only the items of ``keys`` are considered, if given; they should be all
+    the context keys used by the templates. Values are identified by their
+    pickled representation, so they must be picklable.
+
+    :param context: template context
+    :type context: dict
+    :param keys: context keys to consider; None for all
+    :rtype: string
+    :raises: :class:`pickle.PicklingError` or other exceptions if a value
+        can't be pickled
+
+    """
+    if keys is None:
+        items = sorted(context.items())
+    else:
+        items = [(key, context.get(key)) for key in keys]
+    return hashlib.sha1(pickle.dumps(items, 2)).hexdigest()
+
+
+def _pop_render_memo(kwargs):
+    """Pop the rendering de-duplication kwargs of a mass mailing.
+
+    :return: ``(memo, keys)`` to be used by :func:`_render_templated_mass_message`,
+        or None if de-duplication is disabled
+
+    """
+    dedupe_keys = kwargs.pop('dedupe_keys', None)
+    size = kwargs.pop('render_cache_size', DEFAULT_RENDER_CACHE_SIZE)
+    if dedupe_keys is None or dedupe_keys is False:
+        return None
+    return LRUCache(size), None if dedupe_keys is True else list(dedupe_keys)
+
+
+def _pop_address_validator(kwargs):
+    """Pop the kwarg ``validate_recipients`` of a mass mailing.
+
+    :return: the :class:`AddressValidator` to use, or None
+
+    """
+    return address_validator if kwargs.pop('validate_recipients', False) else None
+
+
+def _render_templated_mass_message(
+        context, subject_template_name, body_template_name, html_body_template_name,
+        render_memo):
+    """Like :func:`render_templated_mail`, reusing previous results for
+    contexts with the same fingerprint if ``render_memo`` is not None.
+
+    """
+    if render_memo is not None:
+        memo, keys = render_memo
+        #noinspection PyBroadException
+        try:
+            fingerprint = context_fingerprint(context, keys)
+        except Exception:
+            fingerprint = None
+        if fingerprint is not None:
+            rendered = memo.get(fingerprint)
+            if rendered is None:
+                rendered = render_templated_mail(
+                    context, subject_template_name, body_template_name,
+                    html_body_template_name)
+                memo.set(fingerprint, rendered)
+            return rendered
+    return render_templated_mail(
+        context, subject_template_name, body_template_name, html_body_template_name)
+
+
+def _create_templated_email(subject, body, html_body, **kwargs):
+    if html_body is None:
+        return PlainEmail(subject=subject, body=body, **kwargs)
+    return HTMLEmail(html_body, subject=subject, body=body, **kwargs)
+
+
+def _create_templated_mass_message(
+        context, recipients, subject_template_name, body_template_name,
+        html_body_template_name, kwargs, render_memo=None, validator=None):
+    """Return the Django message for one item of a mass mailing, or None if it failed."""
+    if validator is not None:
+        recipients, _, _, rejected = validator.validate_recipients(recipients)
+        if rejected:
+            logger.warning("Rejected email addresses: %s" % (rejected, ))
+        if not recipients:
+            logger.error("No valid recipient.\nContext: %s" % context)
+            return None
+
+    #noinspection PyBroadException
+    try:
+        subject, body, html_body = _render_templated_mass_message(
+            context, subject_template_name, body_template_name, html_body_template_name,
+            render_memo)
+    except Exception:
+        logger.exception(
+            "Failed to render body or subject.\nTemplate names: (%s, %s, %s)\nContext: %s" %
+            (subject_template_name, body_template_name, html_body_template_name, context))
+        return None
+
+    #noinspection PyBroadException
+    try:
+        email = _create_templated_email(subject, body, html_body, to=recipients, **kwargs)
+        with _time_phase('create_message'):
+            return email.create_message()
+    except Exception:
+        logger.exception("Failed to create message.\nsubject: %s\nto: %s\nkwargs: %s" %
+                         (subject, recipients, kwargs))
+        return None
+
+
+def _send_mass_mail_batch(connection, messages):
+    """Send each message of ``messages`` (None items are failures) over ``connection``."""
+    results = []
+    for message in messages:
+        if message is None:
+            results.append(False)
+            continue
+        #noinspection PyBroadException
+        try:
+            sent = _send_reconnecting(connection, message)
+            if not sent:
+                logger.error("No mail was sent.\nsubject: %s\nto: %s" %
+                             (message.subject, message.to))
+        except Exception:
+            logger.exception("send_templated_mass_mail failed.\nsubject: %s\nto: %s" %
+                             (message.subject, message.to))
+            sent = False
+        results.append(sent)
+    return results
+
+
+def _send_reconnecting(connection, message):
+    """Send ``message`` over ``connection``, opening it again if the server dropped it."""
+    try:
+        return bool(send_message(message, connection))
+    except smtplib.SMTPServerDisconnected:
+        logger.warning("SMTP server disconnected; reconnecting.")
+        connection.close()
+        connection.open()
+        return bool(send_message(message, connection))
+
+
+def _init_mime_worker(subject_template_name, body_template_name, html_body_template_name,
+                      kwargs):
+    """Initialize a worker process of :func:`send_templated_mass_mail_multiprocess`.
+
+    Errors are not raised here, since the pool would replace the worker with
+    another one failing the same way forever, but by :func:`_build_raw_message`.
+
+    """
+    global _mime_worker_state
+    #noinspection PyBroadException
+    try:
+        if hasattr(django, 'setup'):
+            django.setup()
+        # don't share the database connections (sockets) of the parent process
+        if hasattr(django.db.connections, 'close_all'):
+            django.db.connections.close_all()
+        else:  # Django < 1.8
+            for connection in django.db.connections.all():
+                connection.close()
+    except Exception as e:
+        _mime_worker_state = RuntimeError(
+            "Failed to initialize the worker process: %s" % _describe_error(e))
+        return
+    kwargs = dict(kwargs)
+    render_memo = _pop_render_memo(kwargs)
+    validator = _pop_address_validator(kwargs)
+    _mime_worker_state = (
+        subject_template_name, body_template_name, html_body_template_name, kwargs,
+        render_memo, validator)
+
+
+_mime_worker_state = None
+
+
+def _build_raw_message(item):
+    """Render and serialize a message in a worker process.
+
+    :return: ``(recipients, (from_email, envelope_recipients, data), None)``,
+        or ``(recipients, None, error)`` if it failed
+    :raises: :class:`RuntimeError` if the worker failed to initialize
+
+    """
+    if isinstance(_mime_worker_state, Exception):
+        raise _mime_worker_state
+    context, recipients = item
+    (subject_template_name, body_template_name, html_body_template_name, kwargs, render_memo,
+     validator) = _mime_worker_state
+    message = _create_templated_mass_message(
+        context, recipients, subject_template_name, body_template_name,
+        html_body_template_name, kwargs, render_memo, validator)
+    if message is None:
+        return recipients, None, "Failed to create message"
+    #noinspection PyBroadException
+    try:
+        data = message_bytes(message.message())
+        return recipients, (message.from_email, message.recipients(), data), None
+    except Exception as e:
+        logger.exception("Failed to serialize message.\nsubject: %s\nto: %s" %
+                         (message.subject, message.to))
+        return recipients, None, _describe_error(e)
+
+
+def _start_senders(count, queue_size, report):
+    """Start ``count`` threads running :func:`_send_raw_messages`.
+
+    :return: ``(messages, threads)``: the queue of messages to be sent (of at
+        most ``queue_size`` items) and the threads, to be stopped with
+        :func:`_stop_senders`
+
+    """
+    messages = six.moves.queue.Queue(queue_size)
+    threads = [
+        threading.Thread(target=_send_raw_messages, args=(messages, report))
+        for _ in range(count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return messages, threads
+
+
+def _stop_senders(messages, threads):
+    """Wait for the sender threads to send all the queued messages and stop."""
+    for _ in threads:
+        messages.put(None)
+    for thread in threads:
+        thread.join()
+
+
+def _send_raw_messages(messages, report):
+    """Send the :class:`RawEmailMessage` items of the queue ``messages`` (until
+    a None item) over a new connection, adding the results to ``report``.
+
+    """
+    connection = django.core.mail.get_connection()
+    try:
+        while True:
+            message = messages.get()
+            if message is None:
+                return
+            #noinspection PyBroadException
+            try:
+                refused = _send_raw_reconnecting(connection, message)
+            except Exception as e:
+                logger.exception("Failed to send message.\nto: %s" % message.to)
+                report.add_failed(message.to, _describe_error(e))
+            else:
+                report.add_sent([address for address in message.to if address not in refused])
+                for address, (code, response) in refused.items():
+                    report.add_failed([address], _describe_error(
+                        smtplib.SMTPResponseException(code, response)))
+    finally:
+        _close_quietly(connection)
+
+
+def _send_raw_reconnecting(connection, message):
+    try:
+        return send_raw_message(message, connection)
+    except smtplib.SMTPServerDisconnected:
+        logger.warning("SMTP server disconnected; reconnecting.")
+        connection.close()
+        return send_raw_message(message, connection)
+
+
+def send_raw_message(message, connection=None):
+    """Send a :class:`RawEmailMessage` over ``connection`` (by default, the
+    message's one), reporting the recipients refused by the server.
+
+    Unlike Django email backends, the SMTP recipients refused by the server
+    are not ignored (if there are other recipients) but returned; other
+    backends are assumed to accept all of them.
+
+    :return: refused recipients, as ``{address: (code, response)}``
+    :rtype: dict
+    :raises: :class:`smtplib.SMTPException` if no recipient accepted the message
+
+    """
+    if connection is None:
+        connection = message.get_connection()
+    if not isinstance(connection, SMTPEmailBackend):
+        if not send_message(message, connection):
+            raise smtplib.SMTPException("No mail was sent")
+        return {}
+
+    limiter = get_rate_limiter(get_rate_limit_key(connection))
+    if limiter is not None:
+        limiter.acquire(limiter.get_cost(message))
+    if connection.connection is None:
+        connection.open()
+    addresses = dict(
+        (sanitize_address(address, message.encoding), address) for address in message.to)
+    try:
+        refused = connection.connection.sendmail(
+            sanitize_address(message.from_email, message.encoding), list(addresses),
+            message.data)
+    except smtplib.SMTPException as e:
+        if limiter is not None:
+            limiter.notify_error(e)
+        raise
+    if limiter is not None:
+        limiter.notify_success()
+    return dict((addresses.get(address, address), reply) for address, reply in refused.items())
+
+
+def _describe_error(error):
+    if isinstance(error, smtplib.SMTPResponseException):
+        response = error.smtp_error
+        if isinstance(response, bytes):
+            response = response.decode('utf-8', 'replace')
+        return '%s %s' % (error.smtp_code, response)
+    return '%s: %s' % (error.__class__.__name__, error)
+
+
+def _iter_batches(iterable, size):
+    """Yield lists of (at most) ``size`` consecutive items of ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def send_message(message, connection=None):
+    """Send a :class:`django.core.mail.EmailMessage` over ``connection``
+    (by default, the message's one).
+
+    It's equivalent to ``connection.send_messages([message])`` except that
+    the content of :class:`FileAttachment` objects is streamed if
+    ``connection`` is an SMTP backend, the phases ``'connect'`` and
+    ``'send'`` are timed (see :data:`email_phase_finished`) and sends are
+    rate-limited (see :func:`get_rate_limiter`).
+
+    :return: the number of email messages sent
+    :rtype: int
+
+    """
+    if not message.recipients():
+        return 0
+    if connection is None:
+        connection = message.get_connection()
+    limiter = get_rate_limiter(get_rate_limit_key(connection))
+    if limiter is None:
+        return _send_message(message, connection)
+
+    limiter.acquire(limiter.get_cost(message))
+    try:
+        result = _send_message(message, connection)
+    except smtplib.SMTPException as e:
+        limiter.notify_error(e)
+        raise
+    limiter.notify_success()
+    return result
+
+
+def _send_message(message, connection):
+    smtp = isinstance(connection, SMTPEmailBackend)
+    streaming = smtp and _get_file_attachments(message)
+    if not (streaming or email_phase_finished.receivers):
+        return connection.send_messages([message])
+
+    with _time_phase('connect'):
+        new_conn_created = connection.open()
+    try:
+        with _time_phase('send') as timer:
+            if not streaming:
+                if timer.active and smtp and connection.connection:
+                    with _measuring_sendmail(connection.connection, timer):
+                        return connection.send_messages([message])
+                return connection.send_messages([message])
+            if not connection.connection:
+                return 0
+            try:
+                _, size = _smtp_send_streaming(connection.connection, message)
+            except smtplib.SMTPException:
+                if not connection.fail_silently:
+                    raise
+                return 0
+            if timer.active:
+                timer.size = size
+            return 1
+    finally:
+        if new_conn_created:
+            connection.close()
+
+
+@contextlib.contextmanager
+def _measuring_sendmail(smtp, timer):
+    """Set ``timer.size`` to the size of the data sent with ``smtp.sendmail``
+    (e.g. by Django's SMTP backend) while the context is active.
+
+    """
+    had_sendmail = 'sendmail' in vars(smtp)
+    sendmail = smtp.sendmail
+
+    def measured_sendmail(from_addr, to_addrs, msg, *args, **kwargs):
+        timer.size = len(msg)
+        return sendmail(from_addr, to_addrs, msg, *args, **kwargs)
+
+    smtp.sendmail = measured_sendmail
+    try:
+        yield
+    finally:
+        if had_sendmail:
+            smtp.sendmail = sendmail
+        else:
+            del smtp.sendmail
+
+
+def iter_message_bytes(message):
+    """Like :func:`message_bytes` but yielding the serialized message in
+    chunks, streaming the content of its :class:`FileAttachment` parts.
+
+    """
+    attachments = dict(
+        (part.marker.encode('ascii'), part) for part in message.walk()
+        if isinstance(part, FileAttachment))
+    _streaming.active = True
+    try:
+        data = message_bytes(message)
+    finally:
+        _streaming.active = False
+    if not attachments:
+        yield data
+        return
+
+    pattern = re.compile(b'(' + b'|'.join(map(re.escape, attachments)) + b')')
+    for segment in pattern.split(data):
+        if segment in attachments:
+            for chunk in attachments[segment].iter_encoded():
+                yield chunk
+        elif segment:
+            yield segment
+
+
+def _get_file_attachments(message):
+    return [attachment for attachment in message.attachments
+            if isinstance(attachment, FileAttachment)]
+
+
+def _smtp_send_streaming(smtp, message):
+    """Send ``message`` over an open :class:`smtplib.SMTP` connection,
+    writing the message data in chunks (see :func:`iter_message_bytes`).
+
+    Equivalent to :meth:`smtplib.SMTP.sendmail` otherwise.
+
+    :return: refused recipients and size of the message data (in bytes,
+        before dot-stuffing)
+    :rtype: tuple
+
+    """
+    from_email = sanitize_address(message.from_email, message.encoding)
+    recipients = [sanitize_address(address, message.encoding)
+                  for address in message.recipients()]
+
+    smtp.ehlo_or_helo_if_needed()
+    code, response = smtp.mail(from_email)
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, response, from_email)
+    refused = {}
+    for recipient in recipients:
+        code, response = smtp.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, response)
+    if len(refused) == len(recipients):
+        smtp.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, response = smtp.docmd('data')
+    if code != 354:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, response)
+    size = 0
+    try:
+        at_line_start = True
+        for chunk in iter_message_bytes(message.message()):
+            if not chunk:
+                continue
+            size += len(chunk)
+            # dot-stuffing (RFC 5321, section 4.5.2)
+            if at_line_start and chunk.startswith(b'.'):
+                chunk = b'.' + chunk
+            chunk = chunk.replace(b'\n.', b'\n..')
+            at_line_start = chunk.endswith(b'\n')
+            smtp.send(chunk)
+        smtp.send(b'.\r\n' if at_line_start else b'\r\n.\r\n')
+    except Exception:
+        # the server is still reading the message data: drop the connection
+        smtp.close()
+        raise
+    code, response = smtp.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+    return refused, size
+
+
+def _encode_base64_lines(data, linesep):
+    """Base64-encode ``data`` in lines of 76 characters separated by ``linesep``."""
+    encoded = base64.b64encode(data)
+    return linesep.join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+
+
+def message_bytes(message):
+    """Serialize a MIME message (e.g. from :meth:`EmailMessage.message`) with
+    CRLF line endings, ready to be sent over SMTP.
+
+    :rtype: bytes
+
+    """
+    try:
+        data = message.as_bytes(linesep='\r\n')
+    except (AttributeError, TypeError):
+        data = message.as_string()
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+    return _BARE_LF_RE.sub(b'\r\n', data)
+
+
 def set_header_reply_to(headers, reply_to):
     """Set ``reply_to`` as email header ``'Reply-To'``.
 
@@ -249,6 +2678,149 @@ def set_header_reply_to(headers, reply_to):
     return headers
 
 
+class AddressValidator(object):
+
+    """Validate and normalize email addresses in bulk.
+
+    Addresses are normalized with :func:`lu_dj_utils.normalization.normalize_email`
+    and checked with the rules of :class:`django.core.validators.EmailValidator`
+    (addresses of the form ``'Name <address>'`` are accepted too); items
+    that are not strings are rejected. The verdict on each domain is memoized
+    (for the ``max_domains`` most recently used domains), so the cost of
+    checking a domain is paid once per batch, not once per address.
+
+    ``domain_validator`` is an optional callable that receives a (valid,
+    normalized) domain and returns whether addresses of that domain must be
+    accepted, e.g. to check a blacklist. Its results are memoized too.
+
+    """
+
+    def __init__(self, domain_validator=None, max_domains=10000):
+        self.domain_validator = domain_validator
+        self.max_domains = max_domains
+        self._domains = LRUCache(max_domains)
+
+    def validate(self, addresses):
+        """Validate and normalize ``addresses`` (an iterable, e.g. a generator).
+
+        :return: ``(valid, rejected)``: the set of valid normalized addresses
+            and the list of rejected items of ``addresses`` (which may be
+            unhashable, e.g. lists)
+        :rtype: tuple
+
+        """
+        valid = set()
+        rejected = []
+        normalize = self.normalize
+        for address in addresses:
+            normalized = normalize(address)
+            if normalized is None:
+                rejected.append(address)
+            else:
+                valid.add(normalized)
+        return valid, rejected
+
+    def validate_recipients(self, to=None, cc=None, bcc=None):
+        """Validate and normalize the recipient lists of a message, removing
+        duplicates: an address is kept only in the first list (in the order
+        ``to``, ``cc``, ``bcc``) and in its first position.
+
+        :return: ``(to, cc, bcc, rejected)``: lists of valid normalized
+            addresses and the list of rejected items
+        :rtype: tuple
+
+        """
+        seen = set()
+        rejected = []
+        normalize = self.normalize
+        results = []
+        for addresses in (to, cc, bcc):
+            result = []
+            for address in addresses or ():
+                normalized = normalize(address)
+                if normalized is None:
+                    rejected.append(address)
+                elif normalized not in seen:
+                    seen.add(normalized)
+                    result.append(normalized)
+            results.append(result)
+        return results[0], results[1], results[2], rejected
+
+    def normalize(self, address):
+        """Return the normalized ``address``, or None if it's not valid.
+
+        :rtype: string or None
+
+        """
+        if not isinstance(address, six.string_types):
+            return None
+        address = normalize_email(address)
+        if address.endswith('>'):
+            address = normalize_email(parseaddr(address)[1])
+        if len(address) > 254:
+            return None
+        user, at, domain = address.rpartition('@')
+        if not at or len(user) > 64 or not _EMAIL_USER_RE.match(user):
+            return None
+
+        verdict = self._domains.get(domain)
+        if verdict is None:
+            verdict = self._check_domain(domain)
+            self._domains.set(domain, verdict)
+        return address if verdict else None
+
+    def group_by_domain(self, addresses):
+        """Group valid normalized ``addresses`` by domain.
+
+        :return: ``{domain: [addresses]}``
+        :rtype: dict
+
+        """
+        groups = {}
+        for address in addresses:
+            groups.setdefault(address.rpartition('@')[2], []).append(address)
+        return groups
+
+    def _check_domain(self, domain):
+        if domain != 'localhost' and not _is_valid_domain(domain):
+            try:
+                if not _is_valid_domain(domain.encode('idna').decode('ascii')):
+                    return False
+            except UnicodeError:
+                return False
+        if self.domain_validator is not None:
+            return bool(self.domain_validator(domain))
+        return True
+
+
+def _is_valid_domain(domain):
+    if _EMAIL_DOMAIN_RE.match(domain):
+        return True
+    literal_match = _EMAIL_LITERAL_RE.match(domain)
+    if literal_match:
+        try:
+            validate_ipv46_address(literal_match.group(1))
+        except ValidationError:
+            return False
+        return True
+    return False
+
+
+address_validator = AddressValidator()
+"""Default :class:`AddressValidator`."""
+
+
+def validate_recipients(to=None, cc=None, bcc=None):
+    """Validate, normalize and de-duplicate recipient lists with
+    :data:`address_validator` (see :meth:`AddressValidator.validate_recipients`).
+
+    :return: ``(to, cc, bcc, rejected)``
+    :rtype: tuple
+
+    """
+    return address_validator.validate_recipients(to, cc, bcc)
+
+
 def validate_addresses(addresses):
     """Check that ``addresses`` can be joined in a single string.
 
@@ -257,7 +2829,8 @@ def validate_addresses(addresses):
     :raises: ValueError if ``addresses`` couldn't be joined
 
     """
-    addresses = list(addresses)
+    if not isinstance(addresses, (list, tuple)):
+        addresses = list(addresses)
     try:
         ', '.join(addresses)
     except TypeError:
@@ -0,0 +1,500 @@
+# coding: utf-8
+"""asyncio counterparts of the email utilities of :mod:`lu_dj_utils.email`.
+
+Messages are sent by an SMTP client speaking over asyncio streams, so many
+messages can be sent concurrently over a few connections without blocking
+the event loop or tying up executor threads.
+
+.. note::
+    This module requires Python 3.5+, and Python 3.7+ for ``STARTTLS``
+    (``use_tls``).
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import asyncio
+import base64
+import logging
+import re
+import smtplib
+import ssl
+import weakref
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.message import sanitize_address
+
+from lu_dj_utils.email import (
+    _create_templated_email, _create_templated_mass_message, _pop_address_validator,
+    _pop_render_memo, attachment_cache, get_rate_limiter, message_bytes, render_templated_mail,
+)
+
+
+logger = logging.getLogger(__name__)
+
+SMTP_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+DEFAULT_MASS_MAIL_CONCURRENCY = 100
+
+_LINE_START_DOT_RE = re.compile(br'^\.', re.MULTILINE)
+
+
+class AsyncSMTPConnection(object):
+
+    """SMTP client connection over asyncio streams.
+
+    Constructor parameters and their defaults (taken from settings) are the
+    same as Django's SMTP email backend. The connection is opened on the
+    first :meth:`sendmail` if :meth:`connect` wasn't called before.
+
+    If the server supports ``PIPELINING`` (RFC 2920), the envelope commands
+    of each message are sent in a single round trip.
+
+    :raises: :class:`django.core.exceptions.ImproperlyConfigured` if
+        ``use_tls`` is true and the Python version is older than 3.7
+        (asyncio can't start TLS on an open connection)
+
+    """
+
+    def __init__(
+            self, host=None, port=None, username=None, password=None,
+            use_tls=None, use_ssl=None, timeout=None, local_hostname='localhost'):
+        self.host = host or settings.EMAIL_HOST
+        self.port = port or settings.EMAIL_PORT
+        self.username = settings.EMAIL_HOST_USER if username is None else username
+        self.password = settings.EMAIL_HOST_PASSWORD if password is None else password
+        self.use_tls = settings.EMAIL_USE_TLS if use_tls is None else use_tls
+        self.use_ssl = getattr(settings, 'EMAIL_USE_SSL', False) if use_ssl is None else use_ssl
+        self.timeout = getattr(settings, 'EMAIL_TIMEOUT', None) if timeout is None else timeout
+        self.local_hostname = local_hostname
+        if self.use_tls and not hasattr(asyncio.AbstractEventLoop, 'start_tls'):
+            raise ImproperlyConfigured("STARTTLS (use_tls) requires Python 3.7+")
+        self.esmtp_features = {}
+        self._reader = None
+        self._writer = None
+        self._lock = None
+
+    @property
+    def is_connected(self):
+        return self._writer is not None and not self._writer.transport.is_closing()
+
+    async def connect(self):
+        """Open the connection, say ``EHLO`` and (if configured) start TLS and log in."""
+        self.close()
+        context = ssl.create_default_context() if self.use_ssl or self.use_tls else None
+        self._reader, self._writer = await self._wait(asyncio.open_connection(
+            self.host, self.port, ssl=context if self.use_ssl else None))
+        await self._expect(220)
+        await self._ehlo()
+        if self.use_tls:
+            await self._command('STARTTLS', 220)
+            await self._start_tls(context)
+            await self._ehlo()
+        if self.username and self.password:
+            await self._login()
+
+    async def sendmail(self, from_addr, recipients, data):
+        """Send ``data`` (the raw message) to ``recipients``.
+
+        :return: refused recipients, as in :meth:`smtplib.SMTP.sendmail`
+        :rtype: dict
+        :raises: the same exceptions as :meth:`smtplib.SMTP.sendmail`
+
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.is_connected:
+                await self.connect()
+            try:
+                return await self._transaction(from_addr, recipients, data)
+            except smtplib.SMTPServerDisconnected:
+                raise
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code == 421:
+                    self.close()
+                raise
+            except (OSError, asyncio.TimeoutError, ValueError) as e:
+                self.close()
+                raise smtplib.SMTPServerDisconnected(str(e))
+
+    async def noop(self):
+        """Send a ``NOOP`` command and return its reply code."""
+        return (await self._command('NOOP'))[0]
+
+    async def quit(self):
+        """Say ``QUIT`` and close the connection."""
+        try:
+            await self._command('QUIT')
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        self.close()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _transaction(self, from_addr, recipients, data):
+        commands = ['MAIL FROM:<%s>' % from_addr]
+        commands.extend('RCPT TO:<%s>' % recipient for recipient in recipients)
+        commands.append('DATA')
+
+        replies = []
+        if 'pipelining' in self.esmtp_features:
+            self._write(commands)
+            for _ in commands:
+                replies.append(await self._read_reply())
+        else:
+            for command in commands:
+                self._write([command])
+                replies.append(await self._read_reply())
+                if command.startswith('MAIL') and replies[0][0] != 250:
+                    break
+
+        mail_reply, data_reply = replies[0], replies[-1]
+        refused = dict(
+            (recipient, reply) for recipient, reply in zip(recipients, replies[1:-1])
+            if reply[0] not in (250, 251))
+        if data_reply[0] == 354 and (mail_reply[0] != 250 or len(refused) == len(recipients)):
+            # the server is waiting for the message data: send none
+            self._write(['.'])
+            await self._read_reply()
+        if mail_reply[0] != 250:
+            await self._rset()
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+        if len(refused) == len(recipients):
+            await self._rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_reply[0] != 354:
+            await self._rset()
+            raise smtplib.SMTPDataError(*data_reply)
+
+        data = _LINE_START_DOT_RE.sub(b'..', data)
+        if not data.endswith(b'\r\n'):
+            data += b'\r\n'
+        self._writer.write(data + b'.\r\n')
+        code, message = await self._read_reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, message)
+        return refused
+
+    async def _ehlo(self):
+        self.esmtp_features = {}
+        code, message = await self._command('EHLO %s' % self.local_hostname)
+        if code != 250:
+            await self._command('HELO %s' % self.local_hostname, 250)
+            return
+        for line in message.splitlines()[1:]:
+            feature, _, params = line.partition(' ')
+            self.esmtp_features[feature.lower()] = params
+
+    async def _start_tls(self, context):
+        if hasattr(self._writer, 'start_tls'):  # Python 3.11+
+            await self._writer.start_tls(context, server_hostname=self.host)
+            return
+        # Python 3.7+
+        loop = asyncio.get_event_loop()
+        transport = self._writer.transport
+        protocol = transport.get_protocol()
+        tls_transport = await loop.start_tls(
+            transport, protocol, context, server_hostname=self.host)
+        self._writer = asyncio.StreamWriter(tls_transport, protocol, self._reader, loop)
+
+    async def _login(self):
+        mechanisms = self.esmtp_features.get('auth', '').upper().split()
+        if 'PLAIN' in mechanisms or 'LOGIN' not in mechanisms:
+            token = _b64('\0%s\0%s' % (self.username, self.password))
+            code, message = await self._command('AUTH PLAIN %s' % token)
+        else:
+            await self._command('AUTH LOGIN', 334)
+            await self._command(_b64(self.username), 334)
+            code, message = await self._command(_b64(self.password))
+        if code != 235:
+            raise smtplib.SMTPAuthenticationError(code, message)
+
+    async def _rset(self):
+        try:
+            await self._command('RSET')
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def _command(self, command, expected_code=None):
+        self._write([command])
+        return await self._expect(expected_code)
+
+    async def _expect(self, expected_code=None):
+        code, message = await self._read_reply()
+        if expected_code is not None and code != expected_code:
+            raise smtplib.SMTPResponseException(code, message)
+        return code, message
+
+    async def _read_reply(self):
+        lines = []
+        while True:
+            line = await self._wait(self._reader.readline())
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            lines.append(line[4:])
+            if line[3:4] != '-':
+                return int(line[:3]), '\n'.join(lines)
+
+    def _write(self, commands):
+        if self._writer is None:
+            raise smtplib.SMTPServerDisconnected("Not connected")
+        self._writer.write(''.join(command + '\r\n' for command in commands).encode('utf-8'))
+
+    async def _wait(self, awaitable):
+        return await asyncio.wait_for(awaitable, self.timeout)
+
+
+class AsyncEmailConnectionPool(object):
+
+    """Send Django email messages concurrently over at most ``size`` connections.
+
+    ``kwargs`` are passed to :class:`AsyncSMTPConnection`. Connections are
+    created as needed; a message whose connection was dropped by the server
+    is retried once over a new one.
+
+    Sends are rate-limited by the rate limiter of the SMTP host (see
+    :func:`lu_dj_utils.email.get_rate_limiter`).
+
+    After :meth:`close`, sends fail with :class:`RuntimeError`.
+
+    """
+
+    def __init__(self, size=2, **kwargs):
+        self.size = size
+        self.host = kwargs.get('host') or settings.EMAIL_HOST
+        self._kwargs = kwargs
+        self._idle = None
+        self._connections = []
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    async def send_message(self, message):
+        """Send a :class:`django.core.mail.EmailMessage`.
+
+        :return: the number of email messages sent (0 or 1)
+        :rtype: int
+
+        """
+        if not message.recipients():
+            return 0
+        from_email = sanitize_address(message.from_email, message.encoding)
+        recipients = [sanitize_address(address, message.encoding)
+                      for address in message.recipients()]
+        data = message_bytes(message.message())
+
+        limiter = get_rate_limiter(self.host)
+        if limiter is not None:
+            await wait_rate_limit(limiter, limiter.get_cost(message))
+        connection = await self._acquire()
+        try:
+            try:
+                await connection.sendmail(from_email, recipients, data)
+            except smtplib.SMTPServerDisconnected:
+                logger.warning("SMTP server disconnected; reconnecting.")
+                await connection.sendmail(from_email, recipients, data)
+        except smtplib.SMTPException as e:
+            if limiter is not None:
+                limiter.notify_error(e)
+            raise
+        finally:
+            await self._release(connection)
+        if limiter is not None:
+            limiter.notify_success()
+        return 1
+
+    async def close(self):
+        """Close all the connections.
+
+        Connections in use are closed when their messages have been sent and
+        sends waiting for a connection fail.
+
+        """
+        self._closed = True
+        if self._idle is None:
+            return
+        while not self._idle.empty():
+            connection = self._idle.get_nowait()
+            if connection is not None:
+                self._connections.remove(connection)
+                await connection.quit()
+        # wake up the sends waiting for a connection (see ``_acquire``)
+        self._idle.put_nowait(None)
+
+    async def _acquire(self):
+        if self._closed:
+            raise RuntimeError("The connection pool is closed")
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        if self._idle.empty() and len(self._connections) < self.size:
+            connection = AsyncSMTPConnection(**self._kwargs)
+            self._connections.append(connection)
+            return connection
+        connection = await self._idle.get()
+        if connection is None:
+            # closed: pass the wake-up on to the next waiting send
+            self._idle.put_nowait(None)
+            raise RuntimeError("The connection pool is closed")
+        return connection
+
+    async def _release(self, connection):
+        if not self._closed:
+            self._idle.put_nowait(connection)
+            return
+        self._connections.remove(connection)
+        await connection.quit()
+
+
+async def wait_rate_limit(limiter, cost=1):
+    """Asynchronous version of :meth:`lu_dj_utils.email.RateLimiter.acquire`.
+
+    :return: seconds waited
+    :rtype: float
+
+    """
+    delay = limiter.reserve(cost)
+    if delay > 0:
+        await asyncio.sleep(delay)
+    return delay
+
+
+_default_pools = weakref.WeakKeyDictionary()
+
+
+def get_default_pool():
+    """Return the :class:`AsyncEmailConnectionPool` of the current event loop.
+
+    It is configured by the setting ``LU_EMAIL_ASYNC_POOL``, a dict of
+    :class:`AsyncEmailConnectionPool` constructor kwargs (optional).
+
+    """
+    loop = asyncio.get_event_loop()
+    pool = _default_pools.get(loop)
+    if pool is None or pool.closed:
+        pool = AsyncEmailConnectionPool(**getattr(settings, 'LU_EMAIL_ASYNC_POOL', {}))
+        _default_pools[loop] = pool
+    return pool
+
+
+async def send_message(message, pool=None):
+    """Send a :class:`django.core.mail.EmailMessage` over ``pool``.
+
+    If ``pool`` is None the default one is used, unless the configured email
+    backend is not SMTP (e.g. ``locmem`` or ``console``): then the message
+    is sent with it synchronously, since those backends do no network I/O.
+
+    :return: the number of email messages sent (0 or 1)
+    :rtype: int
+
+    """
+    if pool is None:
+        if settings.EMAIL_BACKEND != SMTP_BACKEND:
+            return message.send()
+        pool = get_default_pool()
+    return await pool.send_message(message)
+
+
+async def send_templated_mail_async(
+        context, subject_template_name, body_template_name, html_body_template_name=None,
+        **kwargs):
+    """Asynchronous version of :func:`lu_dj_utils.email.send_templated_mail`.
+
+    The connection pool can be given with kwarg ``pool`` (see
+    :func:`send_message`); the remaining ``kwargs`` are passed directly to
+    :class:`lu_dj_utils.email.PlainEmail`.
+
+    :return: True if the message is sent successfully; False otherwise
+    :rtype: bool
+
+    """
+    pool = kwargs.pop('pool', None)
+
+    #noinspection PyBroadException
+    try:
+        subject, body, html_body = render_templated_mail(
+            context, subject_template_name, body_template_name, html_body_template_name)
+    except Exception:
+        logger.exception(
+            "Failed to render body or subject.\nTemplate names: (%s, %s, %s)\nContext: %s" %
+            (subject_template_name, body_template_name, html_body_template_name, context))
+        return False
+
+    #noinspection PyBroadException
+    try:
+        message = _create_templated_email(subject, body, html_body, **kwargs)
+        result = await send_message(message.create_message(), pool)
+        if not result >= 1:
+            logger.error("No mail was sent.\nsubject: %s\nbody: %s\nkwargs: %s" %
+                         (subject, body, kwargs))
+            return False
+    except Exception:
+        logger.exception("send_templated_mail_async failed.\nsubject: %s\nbody: %s\nkwargs: %s" %
+                         (subject, body, kwargs))
+        return False
+    return True
+
+
+async def send_templated_mass_mail_async(
+        contexts, subject_template_name, body_template_name, html_body_template_name=None,
+        **kwargs):
+    """Asynchronous version of :func:`lu_dj_utils.email.send_templated_mass_mail`.
+
+    Messages are rendered and sent by ``concurrency`` (kwarg) workers, so at
+    most that many are in memory and in flight at the same time, sharing the
+    connections of ``pool`` (kwarg, see :func:`send_message`). Rendering
+    de-duplication, recipients validation and attachments caching work as in
+    the synchronous version.
+
+    :return: one boolean per item of ``contexts``: True if its message was
+        sent successfully; False otherwise
+    :rtype: list
+
+    """
+    pool = kwargs.pop('pool', None)
+    concurrency = kwargs.pop('concurrency', DEFAULT_MASS_MAIL_CONCURRENCY)
+    render_memo = _pop_render_memo(kwargs)
+    validator = _pop_address_validator(kwargs)
+    if kwargs.get('attachments'):
+        kwargs['attachments'] = attachment_cache.get_parts(kwargs['attachments'])
+
+    results = []
+
+    def create_messages():
+        for index, (context, recipients) in enumerate(contexts):
+            results.append(False)
+            message = _create_templated_mass_message(
+                context, recipients, subject_template_name, body_template_name,
+                html_body_template_name, kwargs, render_memo, validator)
+            if message is not None:
+                yield index, message
+
+    # the workers share the generator (``next`` never awaits, so they can't
+    # run it at the same time)
+    messages = create_messages()
+    await asyncio.gather(*[
+        _send_mass_messages(messages, pool, results) for _ in range(concurrency)])
+    return results
+
+
+async def _send_mass_messages(messages, pool, results):
+    for index, message in messages:
+        #noinspection PyBroadException
+        try:
+            results[index] = bool(await send_message(message, pool))
+            if not results[index]:
+                logger.error(
+                    "No mail was sent.\nsubject: %s\nto: %s" % (message.subject, message.to))
+        except Exception:
+            logger.exception("send_templated_mass_mail_async failed.\nsubject: %s\nto: %s" %
+                             (message.subject, message.to))
+
+
+def _b64(value):
+    return base64.b64encode(value.encode('utf-8')).decode('ascii')
@@ -6,9 +6,15 @@ Source: lookup_www.common.utils.hash
 """
 from __future__ import absolute_import, print_function, unicode_literals
 
+import binascii
+import collections
 import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
 import re
-import uuid
+import threading
+import time
 
 
 HEX_6_RE = re.compile('^[a-f0-9]{6}$')  # 6 hex digits string
@@ -17,6 +23,13 @@ HEX_40_RE = re.compile('^[a-f0-9]{40}$')  # 40 hex digits string
 SHA1_RE = HEX_40_RE
 UUID4_RE = HEX_32_RE
 
+# values at least this long are hashed by :func:`hex_sha1_many` in threads
+# (hashlib releases the GIL while hashing more than 2 KiB)
+DEFAULT_PARALLEL_SIZE = 64 * 1024
+
+# hex digit of the variant field of a UUID (bits 10xx) from a random one
+_UUID_VARIANT_DIGITS = dict(zip('0123456789abcdef', '89ab89ab89ab89ab'))
+
 
 def hex_sha1(salt, value):
     """Return a 40-character string containing only hexadecimal digits based on
@@ -38,16 +51,215 @@ def hex_sha1(salt, value):
     return m.hexdigest()
 
 
+def hex_sha1_many(salt, values, threads=None, parallel_size=DEFAULT_PARALLEL_SIZE):
+    """Generate ``hex_sha1(salt, value)`` for each of ``values`` (any
+    iterable, consumed lazily), in the same order.
+
+    The salt is hashed only once and the hash state is copied for each value.
+    Values of at least ``parallel_size`` bytes are hashed in a pool of
+    ``threads`` threads (by default, the number of CPUs), while the rest are
+    hashed in the calling thread. With less than 2 threads (e.g. a single
+    CPU) all the values are hashed in the calling thread.
+
+    >>> list(hex_sha1_many(b'chao1', [b'hola'])) == [hex_sha1(b'chao1', b'hola')]
+    True
+
+    """
+    prefix = hashlib.sha1()
+    prefix.update(salt)
+    if threads is None:
+        threads = _cpu_count()
+    if threads < 2:
+        for value in values:
+            m = prefix.copy()
+            m.update(value)
+            yield m.hexdigest()
+        return
+
+    pool = None
+    # results in order, while there are any from the pool: hex digests or
+    # pending results, at most ``2 * threads`` of the latter to bound the
+    # memory used by ``values``
+    pending = collections.deque()
+    in_pool = 0
+    try:
+        for value in values:
+            if len(value) >= parallel_size:
+                if pool is None:
+                    pool = ThreadPool(threads)
+                pending.append(pool.apply_async(_hex_sha1_from, (prefix, value)))
+                in_pool += 1
+            elif pending:
+                pending.append(_hex_sha1_from(prefix, value))
+            else:
+                m = prefix.copy()
+                m.update(value)
+                yield m.hexdigest()
+                continue
+            while pending and (in_pool >= 2 * threads or _is_ready(pending[0])):
+                result = pending.popleft()
+                if not _is_digest(result):
+                    result = result.get()
+                    in_pool -= 1
+                yield result
+        while pending:
+            result = pending.popleft()
+            yield result if _is_digest(result) else result.get()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def _hex_sha1_from(prefix, value):
+    m = prefix.copy()
+    m.update(value)
+    return m.hexdigest()
+
+
+def _is_digest(result):
+    return isinstance(result, str)
+
+
+def _is_ready(result):
+    return _is_digest(result) or result.ready()
+
+
+def _cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
 def random_hex_32():
     """Return a 32-character string containing only hexadecimal digits based on
     a random generated version-4 UUID.
 
+    Values are taken from a buffer filled by :func:`random_hex_32_many`.
+
     """
-    return uuid.uuid4().hex
+    return _hex_32_buffer.pop()
 
 
 def random_hex_6():
-    """Return a string of 6 hexadecimal digits based on :func:`random_hex_32`.
+    """Return a string of 6 random hexadecimal digits.
+
+    Values are taken from a buffer filled by :func:`random_hex_6_many`.
 
     """
-    return random_hex_32()[:6]
+    return _hex_6_buffer.pop()
+
+
+def time_hex_32():
+    """Return a 32-character string containing only hexadecimal digits,
+    ordered by creation time (the hex of a version-7 UUID).
+
+    The first 12 digits are the Unix time in milliseconds and the next 3
+    (after the version digit) a counter of the values created in the same
+    millisecond, so values are strictly increasing within a process; the
+    last 16 digits (but the variant one) are random. Unlike
+    :func:`random_hex_32`, consecutive values are close to each other in a
+    database index.
+
+    """
+    global _time_hex_32_last
+    with _time_hex_32_lock:
+        millis, counter = int(time.time() * 1000), 0
+        last_millis, last_counter = _time_hex_32_last
+        if millis <= last_millis:
+            millis, counter = last_millis, last_counter + 1
+            if counter > 0xfff:
+                millis, counter = last_millis + 1, 0
+        _time_hex_32_last = millis, counter
+    random_digits = _hex_16_buffer.pop()
+    return '%012x7%03x%s%s' % (
+        millis, counter, _UUID_VARIANT_DIGITS[random_digits[0]], random_digits[1:])
+
+
+def random_hex_32_many(n):
+    """Return a list of ``n`` values like the ones of :func:`random_hex_32`
+    (the hex of random version-4 UUIDs), generated from a single read of
+    random bytes.
+
+    :rtype: list
+
+    """
+    digits = _random_hex(16 * n)
+    variant = _UUID_VARIANT_DIGITS
+    return [
+        digits[i:i + 12] + '4' + digits[i + 13:i + 16] + variant[digits[i + 16]] +
+        digits[i + 17:i + 32]
+        for i in range(0, 32 * n, 32)]
+
+
+def random_hex_6_many(n):
+    """Return a list of ``n`` strings of 6 random hexadecimal digits,
+    generated from a single read of random bytes.
+
+    .. note::
+        There are only 16,777,216 distinct values so, even for small ``n``,
+        the list may contain duplicates.
+
+    :rtype: list
+
+    """
+    digits = _random_hex(3 * n)
+    return [digits[i:i + 6] for i in range(0, 6 * n, 6)]
+
+
+def _random_hex_16_many(n):
+    digits = _random_hex(8 * n)
+    return [digits[i:i + 16] for i in range(0, 16 * n, 16)]
+
+
+def _random_hex(size):
+    """Return ``size`` random bytes as a (text) string of hex digits."""
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
+
+
+class _HexBuffer(object):
+
+    """Thread-safe buffer of random values, refilled in batches of ``size``
+    values by ``generate(size)``.
+
+    The buffer is emptied in child processes after a fork, so they don't
+    return the same values as their parent.
+
+    """
+
+    def __init__(self, generate, size):
+        self.generate = generate
+        self.size = size
+        self._values = collections.deque()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.clear)
+            self._check_pid = False
+        else:
+            self._check_pid = True
+
+    def pop(self):
+        if self._check_pid and self._pid != os.getpid():
+            self.clear()
+        while True:
+            try:
+                return self._values.popleft()
+            except IndexError:
+                with self._lock:
+                    if not self._values:
+                        self._values.extend(self.generate(self.size))
+
+    def clear(self):
+        self._values = collections.deque()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+
+_hex_32_buffer = _HexBuffer(random_hex_32_many, 256)
+_hex_6_buffer = _HexBuffer(random_hex_6_many, 1024)
+_hex_16_buffer = _HexBuffer(_random_hex_16_many, 512)
+
+# (milliseconds, counter) of the last value of :func:`time_hex_32`
+_time_hex_32_last = (0, 0)
+_time_hex_32_lock = threading.Lock()
@@ -0,0 +1,238 @@
+# coding: utf-8
+"""Allocation of unique short hex values for model fields.
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import threading
+import time
+
+from django.db.models import signals
+
+from lu_dj_utils.hex import HEX_6_RE, random_hex_6_many
+
+
+HEX_6_VALUES = 16 ** 6
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class Hex6Allocator(object):
+
+    """Hand out 6-hex-digit values that are not taken yet in the column
+    ``field_name`` of ``model`` (e.g. a :class:`~lu_dj_utils.model_fields.Hex6Field`).
+
+    There are only 16,777,216 distinct values so, in large tables, random
+    values collide often (birthday bound) and ``save()`` fails with
+    ``IntegrityError``. The allocator keeps a bitmap of the taken values
+    (2 MiB, one bit per possible value) loaded from the database on first use
+    and updated incrementally: values of saved rows (``post_save``) are set
+    and values of deleted rows (``post_delete``) are cleared. Random
+    candidates whose bit is set are discarded without a query.
+
+    Values handed out are only reserved for ``lease`` seconds (so they are
+    not handed out twice meanwhile) until a row with them is saved: values
+    of objects that are never saved become free again.
+
+    Rows inserted by other processes (or by ``bulk_create``, which doesn't
+    send ``post_save``) after the bitmap was loaded are unknown to it, so
+    their values may be handed out: the database unique constraint is still
+    needed, and the values of failed inserts should be passed to
+    :meth:`mark` (or the bitmap reloaded with :meth:`refresh`). No query is
+    made per allocation. With ``check_existing=True`` the candidates are
+    also looked up in the database (one query per ``allocate_many`` call,
+    except in the unlikely case that some of them were taken) and the taken
+    ones are marked and replaced, which is worth it only if many rows are
+    inserted by other means.
+
+    """
+
+    def __init__(self, model, field_name, batch_size=64, lease=600, check_existing=False,
+                 chunk_size=500):
+        self.model = model
+        self.field_name = field_name
+        self.batch_size = batch_size
+        self.lease = lease
+        self.check_existing = check_existing
+        self.chunk_size = chunk_size
+        self._bitmap = None
+        self._taken = 0
+        # reserved values: time when their reservation expires
+        self._reserved = {}
+        self._next_purge = 0
+        self._lock = threading.Lock()
+        self._loads = 0
+        self._allocated = 0
+        self._collisions = 0
+        self._existing = 0
+        signals.post_save.connect(self._post_save, sender=model, weak=False)
+        signals.post_delete.connect(self._post_delete, sender=model, weak=False)
+
+    def allocate(self):
+        """Return a free value (reserved for ``lease`` seconds)."""
+        return self.allocate_many(1)[0]
+
+    def allocate_many(self, n):
+        """Return a list of ``n`` distinct free values (reserved for
+        ``lease`` seconds).
+
+        :raises ValueError: if there are less than ``n`` free values
+
+        """
+        with self._lock:
+            if self._bitmap is None:
+                self._load()
+            self._purge_reserved()
+            free = HEX_6_VALUES - self._taken - len(self._reserved)
+            if n > free:
+                raise ValueError("There are only %s free values." % free)
+            values = self._draw(n)
+        # only the values drawn to replace taken ones need to be checked again
+        unchecked = values
+        while self.check_existing and unchecked:
+            existing = self._get_existing(unchecked)
+            if not existing:
+                break
+            with self._lock:
+                self._existing += len(existing)
+                for value in existing:
+                    self._reserved.pop(value, None)
+                    self._set(value, True)
+                unchecked = self._draw(len(existing))
+            values = [value for value in values if value not in existing] + unchecked
+        with self._lock:
+            self._allocated += n
+        return values
+
+    def mark(self, value):
+        """Consider ``value`` taken (e.g. after an ``IntegrityError`` caused
+        by a row inserted by another process).
+
+        """
+        with self._lock:
+            self._reserved.pop(value, None)
+            if self._bitmap is not None:
+                self._set(value, True)
+
+    def release(self, value):
+        """Consider ``value`` free again."""
+        with self._lock:
+            self._reserved.pop(value, None)
+            if self._bitmap is not None:
+                self._set(value, False)
+
+    def refresh(self):
+        """Reload the taken values from the database."""
+        with self._lock:
+            self._load()
+
+    def stats(self):
+        """Return the allocator counters: ``loads`` (of the bitmap from the
+        database), ``allocated`` (values handed out), ``collisions`` (random
+        candidates discarded because they were taken or reserved),
+        ``existing`` (candidates found in the database by
+        ``check_existing``), ``taken`` (values currently known to be taken)
+        and ``reserved`` (values handed out and not saved yet).
+
+        :rtype: dict
+
+        """
+        with self._lock:
+            return {
+                'loads': self._loads,
+                'allocated': self._allocated,
+                'collisions': self._collisions,
+                'existing': self._existing,
+                'taken': self._taken,
+                'reserved': len(self._reserved),
+            }
+
+    def _draw(self, n):
+        """Reserve and return ``n`` random values that are neither taken nor
+        reserved.
+
+        """
+        bitmap = self._bitmap
+        reserved = self._reserved
+        expires = _now() + self.lease
+        values = []
+        while len(values) < n:
+            for value in random_hex_6_many(max(self.batch_size, n - len(values))):
+                index = int(value, 16)
+                if bitmap[index >> 3] & (1 << (index & 7)) or value in reserved:
+                    self._collisions += 1
+                    continue
+                reserved[value] = expires
+                values.append(value)
+                if len(values) == n:
+                    break
+        return values
+
+    def _purge_reserved(self):
+        """Free the values whose reservation expired (at most every tenth
+        of ``lease``).
+
+        """
+        now = _now()
+        if now < self._next_purge:
+            return
+        self._next_purge = now + self.lease / 10.0
+        for value, expires in list(self._reserved.items()):
+            if expires <= now:
+                del self._reserved[value]
+
+    def _get_existing(self, values):
+        """Return the set of ``values`` that are in the database."""
+        existing = set()
+        manager = self.model._default_manager
+        for start in range(0, len(values), self.chunk_size):
+            lookup = {str('%s__in' % self.field_name): values[start:start + self.chunk_size]}
+            existing.update(manager.filter(**lookup).values_list(self.field_name, flat=True))
+        return existing
+
+    def _load(self):
+        self._bitmap = bytearray(HEX_6_VALUES // 8)
+        self._taken = 0
+        values = self.model._default_manager.values_list(self.field_name, flat=True)
+        for value in values.iterator():
+            self._set(value, True)
+        self._loads += 1
+
+    def _set(self, value, taken):
+        if not value or not HEX_6_RE.match(value):
+            return
+        index = int(value, 16)
+        byte, bit = index >> 3, 1 << (index & 7)
+        if bool(self._bitmap[byte] & bit) == taken:
+            return
+        if taken:
+            self._bitmap[byte] |= bit
+            self._taken += 1
+        else:
+            self._bitmap[byte] &= ~bit
+            self._taken -= 1
+
+    def _post_save(self, sender, instance, **kwargs):
+        self.mark(getattr(instance, self.field_name))
+
+    def _post_delete(self, sender, instance, **kwargs):
+        self.release(getattr(instance, self.field_name))
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def get_hex6_allocator(model, field_name):
+    """Return the shared :class:`Hex6Allocator` of the column ``field_name``
+    of ``model``.
+
+    """
+    key = (model, field_name)
+    allocator = _allocators.get(key)
+    if allocator is None:
+        with _allocators_lock:
+            allocator = _allocators.get(key)
+            if allocator is None:
+                allocator = _allocators[key] = Hex6Allocator(model, field_name)
+    return allocator
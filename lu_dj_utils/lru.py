@@ -0,0 +1,106 @@
+# coding: utf-8
+"""Bounded least-recently-used (LRU) cache.
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+
+    """Thread-safe mapping that keeps at most ``maxsize`` items, evicting the
+    least recently used ones.
+
+    The cache can be bounded by the total size of its values too, instead
+    of (``maxsize=None``) or besides their number: ``maxbytes`` is the
+    maximum sum of ``sizeof(value)`` over the cached values.
+
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache.set('a', 1)
+    >>> cache.set('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3)  # evicts 'b'
+    >>> cache.get('b') is None
+    True
+
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, default=None):
+        """Return the value of ``key`` (marking it as the most recently used)
+        or ``default`` if it's not cached.
+
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self._misses += 1
+                return default
+            self._data[key] = value
+            self._hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._remove(key)
+            self._data[key] = value
+            if self.maxbytes is not None:
+                self._sizes[key] = self.sizeof(value)
+                self._bytes += self._sizes[key]
+            while self._data and (
+                    (self.maxsize is not None and len(self._data) > self.maxsize) or
+                    (self.maxbytes is not None and self._bytes > self.maxbytes)):
+                self._remove(next(iter(self._data)))
+                self._evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._remove(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def _remove(self, key, default=None):
+        self._bytes -= self._sizes.pop(key, 0)
+        return self._data.pop(key, default)
+
+    def stats(self):
+        """Return the cache counters: ``hits``, ``misses``, ``evictions``,
+        ``size`` (current number of items) and ``bytes`` (current total size
+        of the values, if bounded by ``maxbytes``).
+
+        :rtype: dict
+
+        """
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'size': len(self._data),
+                'bytes': self._bytes,
+            }
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,64 @@
+# coding: utf-8
+"""Send the messages stored in the email outbox.
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lu_dj_utils.email import get_email_outbox
+
+
+class Command(BaseCommand):
+
+    help = ("Send the messages stored in the email outbox (setting LU_EMAIL_OUTBOX), "
+            "retrying failed ones with exponential backoff.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true', dest='once', default=False,
+            help="Send the messages that are due and exit.")
+        parser.add_argument(
+            '--interval', type=float, dest='interval', default=10,
+            help="Seconds to wait between runs (default: 10).")
+        parser.add_argument(
+            '--stats', action='store_true', dest='stats', default=False,
+            help="Report the queue depth and age and exit.")
+        parser.add_argument(
+            '--requeue-dead', action='store_true', dest='requeue_dead', default=False,
+            help="Queue the dead letters again and exit.")
+
+    def handle(self, *args, **options):
+        outbox = get_email_outbox()
+        if outbox is None:
+            raise CommandError("The email outbox is not enabled (setting LU_EMAIL_OUTBOX).")
+
+        # options are missing if the command is called with call_command()
+        # on Django < 1.8, which doesn't use add_arguments()
+        if options.get('stats'):
+            self._write_stats(outbox)
+            return
+        if options.get('requeue_dead'):
+            self.stdout.write("Requeued %s messages." % outbox.requeue_dead())
+            return
+
+        while True:
+            counts = outbox.drain()
+            if any(counts.values()):
+                self.stdout.write(
+                    "Sent: %(sent)s, deferred: %(deferred)s, dead: %(dead)s." % counts)
+            if options.get('once'):
+                break
+            time.sleep(options.get('interval', 10))
+        if int(options.get('verbosity', 1)) > 1:
+            self._write_stats(outbox)
+
+    def _write_stats(self, outbox):
+        stats = outbox.stats()
+        oldest_age = stats['oldest_age']
+        self.stdout.write(
+            "Queued: %s (due: %s), dead: %s, oldest: %s." % (
+                stats['queued'], stats['due'], stats['dead'],
+                '-' if oldest_age is None else '%ds' % oldest_age))
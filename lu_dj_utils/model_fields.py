@@ -6,10 +6,21 @@ Source: lookup_www.common.fields (but just a subset).
 """
 from __future__ import absolute_import, print_function, unicode_literals
 
+import binascii
+import uuid
+
+from django.core.exceptions import ValidationError
+from django.utils import six
+import django
 import django.db.models
 import django.forms
 
 import lu_dj_utils.hex
+from lu_dj_utils.hex_allocator import get_hex6_allocator
+
+
+# kwargs of the hex fields that ``__init__`` sets (and ``deconstruct`` omits)
+_FORCED_KWARGS = ('blank', 'default', 'max_length', 'unique')
 
 
 class Hex32Field(django.db.models.CharField):
@@ -20,18 +31,34 @@ class Hex32Field(django.db.models.CharField):
     Although it's very unlikely that it returns a repeated value,
     uniqueness is enforced at database level as precautionary measure.
 
+    With ``ordered=True`` it's calculated by :func:`lu_dj_utils.hex.time_hex_32`
+    instead (UUID version 7), so new rows are appended to the end of the
+    index instead of being inserted at random places, which is much cheaper
+    in large tables.
+
     """
 
     description = "32-hex-digits string"
 
     def __init__(self, *args, **kwargs):
+        self.ordered = kwargs.pop('ordered', False)
         kwargs['blank'] = False
-        kwargs['default'] = lu_dj_utils.hex.random_hex_32
+        kwargs['default'] = (
+            lu_dj_utils.hex.time_hex_32 if self.ordered else lu_dj_utils.hex.random_hex_32)
         kwargs['max_length'] = 32
         kwargs['unique'] = True
         kwargs.setdefault('editable', False)
         super(Hex32Field, self).__init__(*args, **kwargs)
 
+    def deconstruct(self):
+        name, path, args, kwargs = super(Hex32Field, self).deconstruct()
+        # set by ``__init__``
+        for key in _FORCED_KWARGS:
+            kwargs.pop(key, None)
+        if self.ordered:
+            kwargs['ordered'] = True
+        return name, path, args, kwargs
+
 
 class Hex6Field(django.db.models.CharField):
 
@@ -41,11 +68,17 @@ class Hex6Field(django.db.models.CharField):
     (substring of UUID version 4).
     Uniqueness is enforced at database level as precautionary measure.
 
+    With ``allocate=True`` the default value is a free one instead, taken
+    from the field's :class:`lu_dj_utils.hex_allocator.Hex6Allocator`, which
+    avoids (most of) the ``IntegrityError`` of repeated random values in
+    large tables.
+
     """
 
     description = "6-hex-digits string"
 
     def __init__(self, *args, **kwargs):
+        self.allocate = kwargs.pop('allocate', False)
         kwargs['blank'] = False
         kwargs['default'] = lu_dj_utils.hex.random_hex_6
         kwargs['max_length'] = 6
@@ -53,12 +86,139 @@ class Hex6Field(django.db.models.CharField):
         kwargs.setdefault('editable', False)
         super(Hex6Field, self).__init__(*args, **kwargs)
 
+    def deconstruct(self):
+        name, path, args, kwargs = super(Hex6Field, self).deconstruct()
+        # set by ``__init__``
+        for key in _FORCED_KWARGS:
+            kwargs.pop(key, None)
+        if self.allocate:
+            kwargs['allocate'] = True
+        return name, path, args, kwargs
+
+    def get_default(self):
+        if self.allocate:
+            return get_hex6_allocator(self.model, self.attname).allocate()
+        return super(Hex6Field, self).get_default()
+
+
+# Before Django 1.8 (which added ``from_db_value``), values loaded from the
+# database are converted by ``to_python`` only with this metaclass
+if django.VERSION < (1, 8):
+    _ConvertingFieldBase = django.db.models.SubfieldBase
+else:
+    _ConvertingFieldBase = type
+
+_BINARY_TYPES = (bytes, bytearray, memoryview, six.memoryview)
+
+
+class BinaryHex32Field(six.with_metaclass(_ConvertingFieldBase, Hex32Field)):
+
+    """Like :class:`Hex32Field` (in Python, values are 32-hex-digits
+    strings), but stored as 16 bytes: a native ``uuid`` column in PostgreSQL,
+    ``binary(16)`` in MySQL, ``raw(16)`` in Oracle and a blob in SQLite.
+
+    Its unique index is about half the size of a :class:`Hex32Field` one.
+    Values are converted when saved, loaded and in lookups (``exact`` and
+    ``in``; other text lookups, e.g. ``startswith``, are not supported).
+
+    """
+
+    description = "32-hex-digits string stored as 16 bytes"
+
+    DB_TYPES = {
+        'mysql': 'binary(16)',
+        'oracle': 'raw(16)',
+        'postgresql': 'uuid',
+    }
+
+    def db_type(self, connection):
+        return self.DB_TYPES.get(connection.vendor, 'blob')
+
+    def to_python(self, value):
+        if value is None:
+            return None
+        if isinstance(value, uuid.UUID):
+            return value.hex
+        if isinstance(value, _BINARY_TYPES) and len(value) == 16:
+            return binascii.hexlify(bytes(value)).decode('ascii')
+        if isinstance(value, six.binary_type):
+            value = value.decode('ascii', 'replace')
+        # PostgreSQL returns UUIDs in their canonical form, with dashes
+        value = six.text_type(value).replace('-', '').lower()
+        if not lu_dj_utils.hex.HEX_32_RE.match(value):
+            raise ValidationError(
+                "'%s' is not a 32-hex-digits string." % value, code='invalid')
+        return value
+
+    def from_db_value(self, value, expression, connection, context):
+        return self.to_python(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        if value is None:
+            return None
+        if connection.vendor == 'postgresql':
+            return value
+        return connection.Database.Binary(binascii.unhexlify(value))
+
+
+class IntegerHex6Field(six.with_metaclass(_ConvertingFieldBase, Hex6Field)):
+
+    """Like :class:`Hex6Field` (in Python, values are 6-hex-digits
+    strings), but stored as an integer: ``mediumint unsigned`` (3 bytes) in
+    MySQL and ``integer`` (4 bytes) in the rest of the databases.
+
+    Values are converted when saved, loaded and in lookups (``exact`` and
+    ``in``; other text lookups, e.g. ``startswith``, are not supported).
+
+    """
+
+    description = "6-hex-digits string stored as an integer"
+
+    DB_TYPES = {
+        'mysql': 'mediumint unsigned',
+        'oracle': 'NUMBER(8)',
+    }
+
+    def db_type(self, connection):
+        return self.DB_TYPES.get(connection.vendor, 'integer')
+
+    def to_python(self, value):
+        if value is None:
+            return None
+        if isinstance(value, six.integer_types) and 0 <= value < 16 ** 6:
+            return '%06x' % value
+        if isinstance(value, six.binary_type):
+            value = value.decode('ascii', 'replace')
+        value = six.text_type(value).lower()
+        if not lu_dj_utils.hex.HEX_6_RE.match(value):
+            raise ValidationError(
+                "'%s' is not a 6-hex-digits string." % value, code='invalid')
+        return value
+
+    def from_db_value(self, value, expression, connection, context):
+        return self.to_python(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        if value is None:
+            return None
+        return int(value, 16)
+
 
 # Tell South about the custom field. Since it's essentially an IntegerField (as
 # South and DB are concerned), the definitions are as simple as they can be.
 # Read:
 # * http://south.readthedocs.org/en/latest/customfields.html#extending-introspection
 # * http://south.readthedocs.org/en/latest/tutorial/part4.html#simple-inheritance
-from south.modelsinspector import add_introspection_rules
-add_introspection_rules([], ["^common\.fields\.Hex32Field"])
-add_introspection_rules([], ["^common\.fields\.Hex6Field"])
+try:
+    from south.modelsinspector import add_introspection_rules
+except ImportError:  # South is not used since Django 1.7
+    pass
+else:
+    add_introspection_rules([], ["^common\.fields\.Hex32Field"])
+    add_introspection_rules([], ["^common\.fields\.Hex6Field"])
+    add_introspection_rules([], ["^lu_dj_utils\.model_fields\.BinaryHex32Field"])
+    add_introspection_rules([], ["^lu_dj_utils\.model_fields\.IntegerHex6Field"])
@@ -4,6 +4,30 @@
 """
 from __future__ import absolute_import, print_function, unicode_literals
 
+import copy
+import threading
+import time
+
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError
+from django.db import connection
+from django.db.models import Manager, Model, signals
+from django.db.models.query import QuerySet
+from django.utils import six
+
+try:
+    from django.core.cache import caches
+except ImportError:  # Django < 1.7
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
+
+from lu_dj_utils.hex import HEX_32_RE, random_hex_32
+from lu_dj_utils.lru import LRUCache
+
+
+_now = getattr(time, 'monotonic', time.time)
+
 
 ###############################################################################
 # MIXINS
@@ -32,9 +56,629 @@ class ValidateModelMixin(object):
         but it won't."
         https://code.djangoproject.com/ticket/13100
 
+    Objects loaded from the database (Django 1.8+) or saved keep a snapshot
+    of their field values, and :meth:`save` validates only the fields that
+    changed since then (see :meth:`clean_changed`), so e.g. updating a
+    counter doesn't cost a uniqueness query per unique field. Set
+    ``full_validation = True`` in the model, or call
+    ``save(full_validation=True)``, to always call :meth:`full_clean`.
+
+    The fields to clean and the unique checks of the model are gathered
+    once, in a :class:`ValidationPlan`, instead of on every validation.
+
     """
 
+    full_validation = False
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ValidateModelMixin, cls).from_db(db, field_names, values)
+        # ``field_names`` is shared by all the objects of a query
+        instance._original_values = (field_names, tuple(values))
+        return instance
+
     def save(self, *args, **kwargs):
-        """Call :meth:`full_clean` before saving."""
-        self.full_clean()
+        """Call :meth:`full_clean` (or :meth:`clean_changed`) before saving.
+
+        :param full_validation: call :meth:`full_clean` even if the object
+            has a snapshot of its values (by default, ``self.full_validation``)
+
+        """
+        full_validation = kwargs.pop('full_validation', self.full_validation)
+        if full_validation:
+            self.full_clean()
+        else:
+            self.clean_changed(update_fields=kwargs.get('update_fields'))
         super(ValidateModelMixin, self).save(*args, **kwargs)
+        self._update_original_values(kwargs.get('update_fields'))
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super(ValidateModelMixin, self).refresh_from_db(using=using, fields=fields, **kwargs)
+        # also called to load deferred fields when they are accessed
+        self._update_original_values(fields)
+
+    def _update_original_values(self, fields=None):
+        """Add the values just saved or loaded (those of ``fields``, names or
+        attnames, if given) to the snapshot. Deferred fields that were not
+        loaded are left out, to not load them.
+
+        """
+        if fields is not None:
+            fields = set(fields)
+        original_values = getattr(self, '_original_values', None)
+        original = dict(zip(*original_values)) if original_values is not None else {}
+        for name, attname in get_validation_plan(self).concrete_fields:
+            if attname in self.__dict__ and (
+                    fields is None or name in fields or attname in fields):
+                original[attname] = self.__dict__[attname]
+        self._original_values = (tuple(original), tuple(original.values()))
+
+    def get_changed_fields(self):
+        """Return the names of the fields whose values changed since the
+        object was loaded or saved, or None if there is no snapshot of them
+        (e.g. a new object). Fields that were deferred and then assigned are
+        changed.
+
+        .. note::
+            Values are compared with ``==``, so changes made in place to
+            mutable values (e.g. a dict) are not detected.
+
+        :rtype: list
+
+        """
+        original_values = getattr(self, '_original_values', None)
+        if original_values is None:
+            return None
+        original = dict(zip(*original_values))
+        return [
+            name for name, attname in get_validation_plan(self).concrete_fields
+            if attname in self.__dict__ and (
+                attname not in original or self.__dict__[attname] != original[attname])]
+
+    def clean_changed(self, update_fields=None):
+        """Like :meth:`full_clean`, but validating only the fields that
+        changed (see :meth:`get_changed_fields`), and among them only those
+        in ``update_fields`` if given, and the unique constraints that involve
+        them. ``clean`` is always called.
+
+        If there is no snapshot of the values, :meth:`full_clean` is called.
+
+        """
+        changed = self.get_changed_fields()
+        if changed is None:
+            self.full_clean()
+            return
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            changed = [name for name in changed if name in update_fields]
+        changed = set(changed)
+        plan = get_validation_plan(self)
+        exclude = plan.field_names.difference(changed)
+
+        errors = {}
+        try:
+            self.clean_fields(exclude=exclude)
+        except ValidationError as e:
+            errors = e.update_error_dict(errors)
+        try:
+            self.clean()
+        except ValidationError as e:
+            errors = e.update_error_dict(errors)
+
+        # only for fields that changed and passed validation
+        changed.difference_update(errors)
+        if changed:
+            unique_checks, date_checks = plan.get_unique_checks(involving=changed)
+            for check_errors in (self._perform_unique_checks(unique_checks),
+                                 self._perform_date_checks(date_checks)):
+                for name, messages in check_errors.items():
+                    errors.setdefault(name, []).extend(messages)
+
+        if errors:
+            raise ValidationError(errors)
+
+    def clean_fields(self, exclude=None):
+        """Like Django's ``clean_fields``, but using the fields of the
+        model's :class:`ValidationPlan`.
+
+        """
+        exclude = exclude or ()
+        errors = {}
+        for name, attname, blank, empty_values, clean in get_validation_plan(self).cleaners:
+            if name in exclude:
+                continue
+            # skip validation of empty fields with blank=True
+            raw_value = getattr(self, attname)
+            if blank and raw_value in empty_values:
+                continue
+            try:
+                setattr(self, attname, clean(raw_value, self))
+            except ValidationError as e:
+                errors[name] = e.error_list
+        if errors:
+            raise ValidationError(errors)
+
+    def _get_unique_checks(self, exclude=None):
+        return get_validation_plan(self).get_unique_checks(exclude=exclude)
+
+
+class ValidateQuerySetMixin(object):
+
+    """Make :meth:`bulk_create` validate the objects with
+    :func:`bulk_full_clean` (unless ``validate=False``), which Django's
+    ``bulk_create`` doesn't do even if the model has
+    :class:`ValidateModelMixin`.
+
+    """
+
+    def bulk_create(self, objs, batch_size=None, validate=True):
+        """Like Django's ``bulk_create``, but validating the objects first.
+
+        :raises BulkValidationError: if any of the objects is not valid
+            (none is created)
+
+        """
+        objs = list(objs)
+        if validate:
+            bulk_full_clean(objs)
+        return super(ValidateQuerySetMixin, self).bulk_create(objs, batch_size=batch_size)
+
+
+class ValidateQuerySet(ValidateQuerySetMixin, QuerySet):
+    pass
+
+
+if hasattr(Manager, 'from_queryset'):
+    _ValidateManagerBase = Manager.from_queryset(ValidateQuerySet)
+else:  # Django < 1.7
+    class _ValidateManagerBase(Manager):
+
+        def get_queryset(self):
+            return ValidateQuerySet(self.model, using=self._db)
+
+
+class ValidateManager(_ValidateManagerBase):
+
+    """Manager whose querysets are :class:`ValidateQuerySet`, e.g. for models
+    with :class:`ValidateModelMixin`.
+
+    """
+
+
+class HexKeyCacheManager(Manager):
+
+    """Manager of models with a :class:`~lu_dj_utils.model_fields.Hex32Field`
+    (or another unique 32-hex-digits field, e.g.
+    :class:`~lu_dj_utils.model_fields.BinaryHex32Field`) that gets objects by
+    that key (:meth:`get_by_hex`, :meth:`get_many_by_hex`) through a two-tier
+    cache, for objects that are read much more often than they change:
+
+    1. an in-process :class:`~lu_dj_utils.lru.LRUCache` of at most
+       ``local_maxsize`` objects, each kept for ``local_timeout`` seconds;
+    2. the Django cache ``cache_alias``, where objects are kept for
+       ``timeout`` seconds.
+
+    Objects missing in both are fetched from the database with one query per
+    ``chunk_size`` keys. Both tiers are invalidated when an object is saved
+    or deleted (``post_save`` and ``post_delete`` signals); the in-process
+    tier of other processes can't be, so it may return stale objects for up
+    to ``local_timeout`` seconds.
+
+    In the Django cache, objects are stored under a key that includes a
+    generation token of their hex key, replaced on each invalidation, so an
+    object read from the database before an invalidation and cached after it
+    is never used.
+
+    ``field_name`` is the key field; by default, the first ``Hex32Field``
+    (or subclass) of the model.
+
+    """
+
+    def __init__(self, field_name=None, timeout=300, local_maxsize=1024, local_timeout=60,
+                 cache_alias='default', chunk_size=500):
+        super(HexKeyCacheManager, self).__init__()
+        self.field_name = field_name
+        self.timeout = timeout
+        self.local_maxsize = local_maxsize
+        self.local_timeout = local_timeout
+        self.cache_alias = cache_alias
+        self.chunk_size = chunk_size
+        self._state = None
+
+    def contribute_to_class(self, model, name):
+        super(HexKeyCacheManager, self).contribute_to_class(model, name)
+        # managers are copied (to subclasses and, since Django 1.10, when
+        # accessed through the model), so the caches and counters live in an
+        # object shared by the copies; each model has its own
+        self._state = _HexKeyCacheState(self, model)
+        if not model._meta.abstract:
+            signals.post_save.connect(self._state.invalidate, sender=model, weak=False)
+            signals.post_delete.connect(self._state.invalidate, sender=model, weak=False)
+
+    def get_by_hex(self, value):
+        """Return the object whose key is ``value``.
+
+        :raises DoesNotExist: if there is no such object
+
+        """
+        obj = self.get_many_by_hex([value]).get(value)
+        if obj is None:
+            raise self.model.DoesNotExist(
+                "%s matching query does not exist." % self.model._meta.object_name)
+        return obj
+
+    def get_many_by_hex(self, values):
+        """Return a dict that maps ``values`` to their objects; values
+        without object (or not valid keys) are left out.
+
+        :rtype: dict
+
+        """
+        state = self._state
+        result = {}
+        now = _now()
+        missing = []
+        local_hits = 0
+        for value in set(values):
+            if not isinstance(value, six.string_types) or not HEX_32_RE.match(value):
+                continue
+            entry = state.local.get(value)
+            if entry is not None and entry[0] > now:
+                result[value] = _copy_instance(entry[1])
+                local_hits += 1
+            else:
+                missing.append(value)
+
+        cache_hits = queries = 0
+        if missing:
+            # objects are cached in this process only if nothing was
+            # invalidated meanwhile
+            invalidations = state.invalidations
+            to_cache_locally = []
+            cache = get_cache(self.cache_alias)
+            keys = dict(
+                (state.get_cache_key(value, generation), value)
+                for value, generation in state.get_generations(missing).items())
+            for key, obj in cache.get_many(list(keys)).items():
+                result[keys[key]] = obj
+                to_cache_locally.append((keys[key], obj))
+                cache_hits += 1
+            missing = [value for value in missing if value not in result]
+
+            field_name = state.get_field_name()
+            to_cache = {}
+            cache_keys = dict((value, key) for key, value in keys.items())
+            for start in range(0, len(missing), self.chunk_size):
+                chunk = missing[start:start + self.chunk_size]
+                queries += 1
+                queryset = self.get_queryset().filter(**{str('%s__in' % field_name): chunk})
+                for obj in queryset:
+                    value = getattr(obj, field_name)
+                    result[value] = obj
+                    to_cache[cache_keys[value]] = obj
+                    to_cache_locally.append((value, obj))
+            if to_cache:
+                cache.set_many(to_cache, self.timeout)
+            state.cache_locally(to_cache_locally, now + self.local_timeout, invalidations)
+
+        with state.lock:
+            state.local_hits += local_hits
+            state.cache_hits += cache_hits
+            state.misses += len(missing)
+            state.queries += queries
+        return result
+
+    def clear_local_cache(self):
+        """Empty the in-process cache (the Django cache is left alone)."""
+        self._state.local.clear()
+
+    def stats(self):
+        """Return the cache counters: ``local_hits``, ``cache_hits`` (of
+        the Django cache), ``misses`` (keys looked up in the database),
+        ``queries`` and ``invalidations``; and ``local`` (the counters of the
+        in-process :class:`~lu_dj_utils.lru.LRUCache`).
+
+        :rtype: dict
+
+        """
+        state = self._state
+        with state.lock:
+            return {
+                'local_hits': state.local_hits,
+                'cache_hits': state.cache_hits,
+                'misses': state.misses,
+                'queries': state.queries,
+                'invalidations': state.invalidations,
+                'local': state.local.stats(),
+            }
+
+
+class _HexKeyCacheState(object):
+
+    """Caches and counters of a :class:`HexKeyCacheManager` (and its copies)."""
+
+    def __init__(self, manager, model):
+        self.model = model
+        self.field_name = manager.field_name
+        self.cache_alias = manager.cache_alias
+        self.local = LRUCache(maxsize=manager.local_maxsize)
+        self.lock = threading.Lock()
+        self.local_hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+        self.queries = 0
+        self.invalidations = 0
+
+    def get_field_name(self):
+        if self.field_name is None:
+            from lu_dj_utils.model_fields import Hex32Field
+
+            for field in self.model._meta.fields:
+                if isinstance(field, Hex32Field):
+                    self.field_name = field.name
+                    break
+            else:
+                raise TypeError(
+                    "Model %s has no Hex32Field." % self.model._meta.object_name)
+        return self.field_name
+
+    def get_cache_key(self, value, generation=None):
+        """Return the Django cache key of the object of ``value`` (of its
+        ``generation``), or of its generation token (if None).
+
+        """
+        meta = self.model._meta
+        key = 'lu_dj_utils:hex_key:%s.%s:%s' % (meta.app_label, meta.model_name, value)
+        return key + ':gen' if generation is None else '%s:%s' % (key, generation)
+
+    def get_generations(self, values):
+        """Return a dict that maps ``values`` to their generation tokens,
+        creating those missing.
+
+        :rtype: dict
+
+        """
+        cache = get_cache(self.cache_alias)
+        keys = dict((self.get_cache_key(value), value) for value in values)
+        generations = dict(
+            (keys[key], generation) for key, generation in cache.get_many(list(keys)).items())
+        for key, value in keys.items():
+            if value not in generations:
+                # ``add`` doesn't replace a token added meanwhile
+                generation = random_hex_32()
+                cache.add(key, generation, None)
+                generations[value] = cache.get(key) or generation
+        return generations
+
+    def cache_locally(self, objs, expires, invalidations):
+        """Add ``objs`` (pairs of value and object) to the in-process cache,
+        unless there were invalidations since there were ``invalidations``.
+
+        """
+        with self.lock:
+            if self.invalidations != invalidations:
+                return
+            for value, obj in objs:
+                self.local.set(value, (expires, _copy_instance(obj)))
+
+    def invalidate(self, sender, instance, **kwargs):
+        value = getattr(instance, self.get_field_name())
+        if value is None:
+            return
+        with self.lock:
+            self.invalidations += 1
+            self.local.pop(value)
+        get_cache(self.cache_alias).set(self.get_cache_key(value), random_hex_32(), None)
+
+
+def _copy_instance(obj):
+    """Return a copy of model instance ``obj`` (to hand out cached objects
+    without sharing their state).
+
+    """
+    obj = copy.copy(obj)
+    obj._state = copy.copy(obj._state)
+    return obj
+
+
+###############################################################################
+# VALIDATION
+###############################################################################
+
+
+DEFAULT_BULK_CLEAN_CHUNK_SIZE = 500
+
+
+class ValidationPlan(object):
+
+    """What there is to validate in instances of a model, gathered once from
+    its ``_meta``: the fields to clean (``cleaners``), in order, and the
+    unique checks (like Django's ``_get_unique_checks``, without excluded
+    fields).
+
+    Use :func:`get_validation_plan` to get the (cached) plan of a model.
+
+    """
+
+    def __init__(self, instance):
+        meta = instance._meta
+        self.cleaners = [
+            (f.name, f.attname, f.blank, f.empty_values, f.clean) for f in meta.fields]
+        self.field_names = frozenset(f.name for f in meta.fields)
+        self.concrete_fields = tuple((f.name, f.attname) for f in meta.concrete_fields)
+        self.attnames = tuple(attname for _, attname in self.concrete_fields)
+        # call Django's implementation, not the one that uses this plan
+        self.unique_checks, self.date_checks = Model._get_unique_checks(instance)
+
+    def get_unique_checks(self, exclude=None, involving=None):
+        """Return the unique checks and date checks (like Django's
+        ``_get_unique_checks``) except those that involve fields in
+        ``exclude``, and, if given, only those that involve fields in
+        ``involving``.
+
+        :rtype: tuple
+
+        """
+        unique_checks = [
+            (model_class, unique_check) for model_class, unique_check in self.unique_checks
+            if _is_check_included(unique_check, exclude, involving)]
+        date_checks = [
+            check for check in self.date_checks
+            if _is_check_included(check[2:], exclude, involving)]
+        return unique_checks, date_checks
+
+
+def _is_check_included(field_names, exclude, involving):
+    if exclude and any(name in exclude for name in field_names):
+        return False
+    if involving is not None and not any(name in involving for name in field_names):
+        return False
+    return True
+
+
+_validation_plans = {}
+_validation_plans_lock = threading.Lock()
+
+
+def get_validation_plan(instance):
+    """Return the :class:`ValidationPlan` of the model of ``instance``,
+    building it on first use.
+
+    Plans are discarded when a model class is prepared (signal
+    ``class_prepared``), e.g. if it's redefined.
+
+    """
+    model = type(instance)
+    plan = _validation_plans.get(model)
+    if plan is None:
+        with _validation_plans_lock:
+            plan = _validation_plans.get(model)
+            if plan is None:
+                plan = _validation_plans[model] = ValidationPlan(instance)
+    return plan
+
+
+def _discard_validation_plan(sender, **kwargs):
+    _validation_plans.pop(sender, None)
+
+
+signals.class_prepared.connect(_discard_validation_plan)
+
+
+class BulkValidationError(ValidationError):
+
+    """Raised by :func:`bulk_full_clean` with the errors of each invalid
+    instance: ``instance_errors`` maps instance indexes to a
+    ``ValidationError`` like the one raised by its ``full_clean``.
+
+    """
+
+    def __init__(self, instance_errors):
+        self.instance_errors = instance_errors
+        super(BulkValidationError, self).__init__(
+            "%s instance(s) are not valid: %s." % (
+                len(instance_errors), ', '.join(str(i) for i in sorted(instance_errors))),
+            code='invalid')
+
+
+def bulk_full_clean(instances, exclude=None, validate_unique=True,
+                    chunk_size=DEFAULT_BULK_CLEAN_CHUNK_SIZE):
+    """Like calling ``full_clean`` on each of ``instances`` (of the same
+    model), but with much fewer queries.
+
+    Fields and ``clean`` are validated in memory, as usual. Uniqueness of
+    single fields is checked with one ``IN (...)`` query per field per chunk
+    of ``chunk_size`` instances, instead of one query per field per instance;
+    repeated values among ``instances`` are reported too (unlike
+    ``full_clean``, which only looks at the database). Other checks
+    (``unique_together`` and ``unique_for_date``, etc.) are done per instance.
+
+    If the database considers equal values that are different in Python
+    (e.g. with a case-insensitive collation, as usual in MySQL), the
+    values not found as they are in the results of the ``IN`` query are
+    checked one by one, so collisions with rows in the database are
+    detected. Repeated values among ``instances`` are detected only if they
+    are equal in Python, though.
+
+    :raises BulkValidationError: if any of the instances is not valid
+
+    """
+    instances = list(instances)
+    exclude = list(exclude or [])
+    errors = {}
+    # values of unique fields among ``instances`` (for repeated values)
+    seen = {}
+    for start in range(0, len(instances), chunk_size):
+        chunk = instances[start:start + chunk_size]
+        _clean_chunk(start, chunk, exclude, validate_unique, seen, errors)
+    if errors:
+        raise BulkValidationError(dict(
+            (index, ValidationError(instance_errors))
+            for index, instance_errors in errors.items()))
+
+
+def _clean_chunk(start, instances, exclude, validate_unique, seen, errors):
+    # values to check, by (model class, field name): lists of (index, value)
+    unique_values = {}
+    for index, instance in enumerate(instances, start):
+        instance_errors = {}
+        try:
+            instance.clean_fields(exclude=exclude)
+        except ValidationError as e:
+            instance_errors = e.update_error_dict(instance_errors)
+        try:
+            instance.clean()
+        except ValidationError as e:
+            instance_errors = e.update_error_dict(instance_errors)
+
+        if validate_unique:
+            # run unique checks only for fields that passed validation
+            unique_exclude = exclude + [
+                name for name in instance_errors if name != NON_FIELD_ERRORS]
+            unique_checks, date_checks = instance._get_unique_checks(exclude=unique_exclude)
+            other_checks = []
+            for model_class, unique_check in unique_checks:
+                if len(unique_check) != 1:
+                    other_checks.append((model_class, unique_check))
+                    continue
+                field = instance._meta.get_field(unique_check[0])
+                value = getattr(instance, field.attname)
+                if value is None or (
+                        value == '' and connection.features.interprets_empty_strings_as_nulls):
+                    continue
+                if field.primary_key and not instance._state.adding:
+                    continue
+                unique_values.setdefault(
+                    (model_class, field.name), []).append((index, value))
+            for check_errors in (instance._perform_unique_checks(other_checks),
+                                 instance._perform_date_checks(date_checks)):
+                for name, messages in check_errors.items():
+                    instance_errors.setdefault(name, []).extend(messages)
+
+        if instance_errors:
+            errors[index] = instance_errors
+
+    for (model_class, name), values in unique_values.items():
+        pks_by_value = {}
+        distinct_values = set(value for _, value in values)
+        manager = model_class._default_manager
+        queryset = manager.filter(**{str('%s__in' % name): list(distinct_values)})
+        for value, pk in queryset.values_list(name, 'pk'):
+            pks_by_value.setdefault(value, set()).add(pk)
+        # rows whose value is not one of ``values`` matched one of them by the
+        # database collation: find out which, one by one
+        collated = any(value not in distinct_values for value in pks_by_value)
+        model_seen = seen.setdefault((model_class, name), set())
+        for index, value in values:
+            instance = instances[index - start]
+            if value not in pks_by_value and collated:
+                pks_by_value[value] = set(
+                    manager.filter(**{str(name): value}).values_list('pk', flat=True))
+            pks = pks_by_value.get(value, set())
+            pk = instance._get_pk_val(model_class._meta)
+            if not instance._state.adding and pk is not None:
+                pks = pks - set([pk])
+            if pks or value in model_seen:
+                errors.setdefault(index, {}).setdefault(name, []).append(
+                    instance.unique_error_message(model_class, (name, )))
+            model_seen.add(value)
@@ -0,0 +1,104 @@
+# coding: utf-8
+"""In-process statistics of measured values.
+
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import math
+import threading
+
+
+class Histogram(object):
+
+    """Thread-safe histogram of positive values (e.g. durations, sizes).
+
+    Values are counted in buckets whose bounds grow geometrically by
+    ``growth`` (by default, each bucket is about 19% wider than the previous
+    one), so percentiles are estimated with that relative error and memory
+    usage doesn't depend on the number of values.
+
+    >>> histogram = Histogram()
+    >>> for value in range(1, 101):
+    ...     histogram.add(value)
+    >>> histogram.count, histogram.max
+    (100, 100)
+    >>> 45 < histogram.percentile(50) < 60
+    True
+
+    """
+
+    def __init__(self, growth=2 ** 0.25):
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        bucket = self._get_bucket(value)
+        with self._lock:
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, percent):
+        """Return an estimation of the ``percent`` percentile (0 to 100) of
+        the values: the upper bound of its bucket, within the minimum and
+        maximum values. None if there are no values.
+
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+            seen = 0
+            for bucket in sorted(self._buckets, key=_bucket_order):
+                seen += self._buckets[bucket]
+                if seen >= rank:
+                    break
+            upper = 0 if bucket is None else self.growth ** (bucket + 1)
+            return min(max(upper, self.min), self.max)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self.count = 0
+            self.total = 0
+            self.min = None
+            self.max = None
+
+    def stats(self, percents=(50, 90, 99)):
+        """Return the ``count``, ``total``, ``min``, ``max`` and ``mean`` of
+        the values and their percentiles (``'p50'``, etc.).
+
+        :rtype: dict
+
+        """
+        with self._lock:
+            stats = {
+                'count': self.count,
+                'total': self.total,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.total / float(self.count) if self.count else None,
+            }
+        for percent in percents:
+            stats['p%s' % percent] = self.percentile(percent)
+        return stats
+
+    def _get_bucket(self, value):
+        if value <= 0:
+            return None
+        return int(math.floor(math.log(value) / self._log_growth))
+
+
+def _bucket_order(bucket):
+    # the bucket of non-positive values (None) goes first
+    return float('-inf') if bucket is None else bucket
@@ -6,9 +6,12 @@ Source: lookup_www.common.utils.test.
 """
 from __future__ import absolute_import, print_function, unicode_literals
 
+import threading
+
 from mock import NonCallableMock
 
 import django.test
+from django.utils.six.moves import socketserver
 
 
 class TestServerClient(django.test.Client):
@@ -104,3 +107,152 @@ def setup_view(view, request, *args, **kwargs):
     view.args = args
     view.kwargs = kwargs
     return view
+
+
+class SMTPSink(object):
+
+    """Minimal SMTP server listening on loopback that keeps the messages it receives.
+
+    Each received message is stored in :attr:`messages` as a tuple
+    ``(mail_from, rcpt_tos, data)`` where ``data`` is the raw message
+    (:class:`bytes`, already un-dot-stuffed). Any ``AUTH`` is accepted and
+    ``PIPELINING`` is advertised.
+
+    If ``max_messages_per_connection`` is given, the server drops the session
+    after that many messages, like relays that limit the length of sessions.
+
+    If ``keep_messages`` is False, messages are just counted in
+    :attr:`received` (like when kept) and their size in :attr:`received_bytes`,
+    e.g. for benchmarks.
+
+    Use it as a context manager::
+
+        with SMTPSink() as sink:
+            settings.EMAIL_PORT = sink.port
+            ...
+        sink.messages
+
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, max_messages_per_connection=None,
+                 keep_messages=True):
+        self.messages = []
+        self.received = 0
+        self.received_bytes = 0
+        self.connections = 0
+        self.max_messages_per_connection = max_messages_per_connection
+        self.keep_messages = keep_messages
+        self._lock = threading.Lock()
+        self._server = _SMTPSinkServer((host, port), _SMTPSinkHandler)
+        self._server.sink = self
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _add_message(self, mail_from, rcpt_tos, data):
+        with self._lock:
+            self.received += 1
+            self.received_bytes += len(data)
+            if self.keep_messages:
+                self.messages.append((mail_from, rcpt_tos, data))
+
+    def _add_connection(self):
+        with self._lock:
+            self.connections += 1
+
+
+class _SMTPSinkServer(socketserver.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        sink = self.server.sink
+        sink._add_connection()
+        self.reply('220 localhost SMTPSink')
+        mail_from, rcpt_tos, count = None, [], 0
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, arg = line.decode('utf-8').strip().partition(' ')
+            command = command.upper()
+
+            if command == 'EHLO':
+                self.reply('250-localhost', '250-PIPELINING', '250-8BITMIME',
+                           '250 AUTH PLAIN LOGIN')
+            elif command == 'HELO':
+                self.reply('250 localhost')
+            elif command == 'AUTH':
+                mechanism = arg.split(' ')
+                if mechanism[0].upper() == 'LOGIN':
+                    for prompt in ('334 VXNlcm5hbWU6', '334 UGFzc3dvcmQ6'):
+                        self.reply(prompt)
+                        self.rfile.readline()
+                elif len(mechanism) == 1:
+                    self.reply('334 ')
+                    self.rfile.readline()
+                self.reply('235 Authentication successful')
+            elif command == 'MAIL':
+                mail_from, rcpt_tos = _smtp_path(arg), []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                rcpt_tos.append(_smtp_path(arg))
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                sink._add_message(mail_from, rcpt_tos, self.read_data())
+                count += 1
+                self.reply('250 OK')
+                if count == sink.max_messages_per_connection:
+                    return
+            elif command == 'RSET':
+                mail_from, rcpt_tos = None, []
+                self.reply('250 OK')
+            elif command == 'NOOP':
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+    def read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line == b'.\r\n':
+                break
+            if line.startswith(b'.'):
+                line = line[1:]
+            lines.append(line)
+        return b''.join(lines)
+
+    def reply(self, *lines):
+        self.wfile.write(''.join(line + '\r\n' for line in lines).encode('utf-8'))
+
+
+def _smtp_path(arg):
+    """Extract the address of a ``MAIL FROM:<...>`` or ``RCPT TO:<...>`` argument."""
+    return arg.partition(':')[2].strip().split(' ')[0].strip('<>')
@@ -55,6 +55,7 @@ DEFAULT_SETTINGS = dict(
     INSTALLED_APPS=(
         'django.contrib.sites',  # used by `lu_dj_utils.urls`
         'lu_dj_utils',
+        'tests',  # models used by the tests
     ),
     DATABASES={
         'default': {
@@ -0,0 +1,58 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals
+
+from django.core.exceptions import ValidationError
+from django.db import models
+
+from lu_dj_utils.model_fields import BinaryHex32Field, Hex32Field, IntegerHex6Field
+from lu_dj_utils.models import HexKeyCacheManager, ValidateManager, ValidateModelMixin
+
+
+class Coupon(models.Model):
+
+    code = models.CharField(max_length=6, unique=True)
+
+
+class CompactKeys(models.Model):
+
+    key = BinaryHex32Field()
+    code = IntegerHex6Field(allocate=True)
+
+
+class Subscriber(ValidateModelMixin, models.Model):
+
+    email = models.EmailField(unique=True)
+    list_name = models.CharField(max_length=10)
+    position = models.PositiveIntegerField()
+    visits = models.PositiveIntegerField(default=0)
+
+    objects = ValidateManager()
+
+    class Meta:
+        unique_together = (('list_name', 'position'), )
+
+    def clean(self):
+        if self.list_name == 'closed':
+            raise ValidationError("The list is closed.")
+
+
+class NoCaseCharField(models.CharField):
+
+    def db_type(self, connection):
+        return '%s COLLATE NOCASE' % super(NoCaseCharField, self).db_type(connection)
+
+
+class Tag(ValidateModelMixin, models.Model):
+
+    name = NoCaseCharField(max_length=20, unique=True)
+
+    objects = ValidateManager()
+
+
+class Document(models.Model):
+
+    token = Hex32Field()
+    title = models.CharField(max_length=50)
+
+    objects = models.Manager()
+    cached = HexKeyCacheManager(local_timeout=10)
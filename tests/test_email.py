@@ -9,6 +9,7 @@ from mock import MagicMock, Mock, NonCallableMock, NonCallableMagicMock, patch
 from django.conf import settings
 from django.core import mail as django_mail
 from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
 
 
 class PlainEmail(SimpleTestCase):
@@ -163,6 +164,16 @@ class SendMail2(SimpleTestCase):
 
         self.assertEqual(send_mail2(), 0)
 
+    def test_validate_recipients(self):
+        from lu_dj_utils.email import send_mail2
+
+        _reset_test_outbox()
+        self.assertEqual(send_mail2(to=['x', ['a@a.cl']], validate_recipients=True), 0)
+        self.assertEqual(send_mail2(
+            to=['A@a.cl', 'bad'], cc=['a@a.cl', 'b@a.cl'], validate_recipients=True), 1)
+        message, = django_mail.outbox
+        self.assertEqual((message.to, message.cc), (['a@a.cl'], ['b@a.cl']))
+
     def test_full_call(self):
         """Test the function using all the parameters with mock objects."""
         from lu_dj_utils.email import send_mail2
@@ -306,6 +317,889 @@ class SendMail2(SimpleTestCase):
                 send_mail2(subject=subject, body=body, to=[address])
 
 
+class FileAttachmentTest(SimpleTestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+
+        fd, self.path = tempfile.mkstemp(suffix='.pdf')
+        self.content = os.urandom(200 * 1024 + 7)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.content)
+        self.addCleanup(os.remove, self.path)
+
+    def test_iter_encoded(self):
+        import base64
+        from lu_dj_utils.email import FileAttachment
+
+        attachment = FileAttachment(self.path)
+        attachment.chunk_size = 57 * 10
+        encoded = b''.join(attachment.iter_encoded())
+
+        lines = encoded.split(b'\r\n')
+        self.assertTrue(all(len(line) == 76 for line in lines[:-1]))
+        self.assertFalse(encoded.endswith(b'\n'))
+        self.assertEqual(base64.b64decode(encoded), self.content)
+
+    def test_not_streamed(self):
+        from lu_dj_utils.email import FileAttachment, HTMLEmail
+
+        _reset_test_outbox()
+        attachment = FileAttachment(self.path, filename='report.pdf')
+        self.assertEqual(attachment.get_content_type(), 'application/pdf')
+
+        HTMLEmail('<p>hi</p>', subject='s', body='b', to=['a@a.cl'],
+                  attachments=[attachment]).send()
+        message = django_mail.outbox[0].message()
+        self.assert_attachment(_parse_message(message.as_bytes()), 'report.pdf')
+
+    def test_streamed(self):
+        from lu_dj_utils.email import FileAttachment, HTMLEmail, message_bytes
+        from lu_dj_utils.test import SMTPSink
+
+        body = 'first line\n.line starting with a dot\n'
+        serialized = []
+
+        def serialize(message):
+            serialized.append(message_bytes(message))
+            return serialized[-1]
+
+        with SMTPSink() as sink:
+            connection = django_mail.get_connection(
+                'django.core.mail.backends.smtp.EmailBackend',
+                host=sink.host, port=sink.port)
+            with patch('lu_dj_utils.email.message_bytes', side_effect=serialize):
+                result = HTMLEmail(
+                    '<p>hi</p>', subject='s', body=body, to=['a@a.cl'], cc=['b@b.cl'],
+                    connection=connection,
+                    attachments=[FileAttachment(self.path), ('x.txt', 'text', None)]).send()
+
+        self.assertEqual(result, 1)
+        mail_from, rcpt_tos, data = sink.messages[0]
+        self.assertEqual(rcpt_tos, ['a@a.cl', 'b@b.cl'])
+        message = _parse_message(data)
+        self.assertEqual(
+            message.get_payload()[0].get_payload()[0].get_payload().replace('\r\n', '\n'),
+            body)
+        self.assert_attachment(message, self.path.split('/')[-1])
+        self.assertEqual(message.get_payload()[2].get_payload(), 'text')
+        # the file content was not part of the serialized message
+        self.assertLess(len(serialized[0]), 10 * 1024)
+
+    def assert_attachment(self, message, filename):
+        attachment = message.get_payload()[1]
+        self.assertEqual(attachment.get_filename(), filename)
+        self.assertEqual(attachment.get_content_type(), 'application/pdf')
+        self.assertEqual(attachment.get_payload(decode=True), self.content)
+
+
+class EmailSpecTest(SimpleTestCase):
+
+    def setUp(self):
+        from lu_dj_utils.email import EmailSpec
+
+        self.spec = EmailSpec(
+            subject='s', body='b', html_body='<p>b</p>', from_email='x@x.cl',
+            to=['a@a.cl'], cc=('b@b.cl', ), bcc=iter(['c@c.cl']), reply_to='r@r.cl',
+            headers={'X-Campaign': '1'},
+            attachments=[['a.txt', 'text', 'text/plain'], ('b.bin', b'\x00\xff', None)])
+
+    def test_immutable(self):
+        from lu_dj_utils.email import EmailSpec
+
+        spec = self.spec
+        self.assertEqual(spec.to, ('a@a.cl', ))
+        self.assertEqual(spec.bcc, ('c@c.cl', ))
+        self.assertEqual(spec.headers, (('Reply-To', 'r@r.cl'), ('X-Campaign', '1')))
+        self.assertEqual(spec.attachments[0], ('a.txt', 'text', 'text/plain'))
+        self.assertFalse(hasattr(spec, '__dict__'))
+        self.assertRaises(AttributeError, setattr, spec, 'subject', 'x')
+        self.assertRaises(AttributeError, delattr, spec, 'subject')
+
+        other = spec.replace(to=['d@d.cl'])
+        self.assertEqual(other.to, ('d@d.cl', ))
+        self.assertEqual(other.headers, spec.headers)
+        self.assertNotEqual(other, spec)
+        self.assertEqual(other.replace(to=spec.to), spec)
+        self.assertEqual(len(set([spec, other, other.replace(to=spec.to)])), 2)
+        self.assertEqual(EmailSpec().to, ())
+
+    def test_serialize(self):
+        import json
+        from django.utils.six.moves import cPickle as pickle
+        from lu_dj_utils.email import EmailSpec, FileAttachment
+
+        spec = self.spec
+        self.assertEqual(pickle.loads(pickle.dumps(spec, 2)), spec)
+        self.assertEqual(EmailSpec.loads(spec.dumps()), spec)
+        self.assertEqual(spec.dumps(), EmailSpec.loads(spec.dumps()).dumps())
+        data = json.loads(spec.dumps())
+        self.assertEqual(data['version'], 1)
+        self.assertEqual(data['attachments'][1]['content_base64'], 'AP8=')
+
+        file_spec = spec.replace(attachments=[FileAttachment('/tmp/report.pdf')])
+        attachment, = EmailSpec.loads(file_spec.dumps()).attachments
+        self.assertEqual(attachment.path, '/tmp/report.pdf')
+        self.assertEqual(attachment.get_content_type(), 'application/pdf')
+
+        self.assertRaises(ValueError, spec.replace(attachments=[object()]).to_dict)
+        data['version'] = 2
+        self.assertRaises(ValueError, EmailSpec.from_dict, data)
+
+    def test_email(self):
+        from lu_dj_utils.email import HTMLEmail, PlainEmail
+
+        _reset_test_outbox()
+        email = self.spec.to_email()
+        self.assertIsInstance(email, HTMLEmail)
+        self.assertEqual(email.to_spec(), self.spec)
+        self.assertEqual(email.send(), 1)
+        message = django_mail.outbox[0]
+        self.assertEqual(message.to, ['a@a.cl'])
+        self.assertEqual(message.bcc, ['c@c.cl'])
+        self.assertEqual(message.extra_headers['Reply-To'], 'r@r.cl')
+        self.assertEqual(message.alternatives, [('<p>b</p>', 'text/html')])
+        self.assertEqual(len(message.attachments), 2)
+
+        plain = PlainEmail.from_spec(self.spec.replace(html_body=None), connection='c')
+        self.assertNotIsInstance(plain, HTMLEmail)
+        self.assertEqual(plain.connection, 'c')
+        self.assertEqual(PlainEmail(to=['a@a.cl']).to_spec().to, ('a@a.cl', ))
+
+
+class AttachmentCacheTest(SimpleTestCase):
+
+    def test_get_part(self):
+        from lu_dj_utils.email import AttachmentCache
+
+        cache = AttachmentCache()
+        part = cache.get_part('terms.pdf', b'%PDF-1.4 terms', 'application/pdf')
+        self.assertEqual(part.get_filename(), 'terms.pdf')
+        self.assertEqual(part.get_payload(decode=True), b'%PDF-1.4 terms')
+
+        self.assertIs(cache.get_part('terms.pdf', b'%PDF-1.4 terms', 'application/pdf'), part)
+        self.assertIsNot(cache.get_part('terms.pdf', b'%PDF-1.4 other', 'application/pdf'), part)
+        self.assertIsNot(cache.get_part('other.pdf', b'%PDF-1.4 terms', 'application/pdf'), part)
+        text_part = cache.get_part('prices.txt', 'ñandú', None)
+        self.assertEqual(text_part.get_content_type(), 'text/plain')
+        self.assertEqual(text_part.get_payload(decode=True), 'ñandú'.encode('utf-8'))
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 4, 4))
+
+    def test_create_attachment_part(self):
+        from lu_dj_utils.email import create_attachment_part
+
+        part = create_attachment_part('a.bin', b'\x00\xff')
+        self.assertEqual(part.get_content_type(), 'application/octet-stream')
+        self.assertEqual(part.get_payload(decode=True), b'\x00\xff')
+        self.assertEqual(part.get_filename(), 'a.bin')
+        part = create_attachment_part('a.txt', b'\xff')  # not UTF-8
+        self.assertEqual(part.get_content_type(), 'application/octet-stream')
+        part = create_attachment_part('ñandú.pdf', b'%PDF')
+        self.assertEqual(part.get_content_type(), 'application/pdf')
+        self.assertEqual(part.get_filename(), 'ñandú.pdf')
+        part = create_attachment_part(
+            'forwarded.eml', 'Subject: hi\n\nbody', 'message/rfc822')
+        self.assertEqual(part.get_payload()[0]['Subject'], 'hi')
+
+        # same as Django's
+        message = django_mail.EmailMessage(body='b', attachments=[('a.pdf', b'%PDF', None)])
+        message.attach(create_attachment_part('a.pdf', b'%PDF'))
+        parts = message.message().get_payload()
+        self.assertEqual(parts[1].as_string(), parts[2].as_string())
+
+    def test_maxbytes(self):
+        from lu_dj_utils.email import AttachmentCache
+
+        cache = AttachmentCache(maxbytes=100)
+        cache.get_part('a.bin', b'x' * 60)
+        cache.get_part('b.bin', b'x' * 60)  # encoded size: 80
+        self.assertEqual(cache.stats()['size'], 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_mass_mail(self):
+        from django.core.mail.message import MIMEBase
+        from lu_dj_utils.email import (
+            attachment_cache, create_attachment_part, send_templated_mass_mail,
+        )
+
+        _reset_test_outbox()
+        attachment_cache.clear()
+        part = MIMEBase('image', 'png')
+        attachments = [('terms.pdf', b'%PDF-1.4 terms', 'application/pdf'), part]
+
+        with patch('lu_dj_utils.email.create_attachment_part',
+                   wraps=create_attachment_part) as mock_create:
+            send_templated_mass_mail(
+                [({}, ['%s@a.cl' % i]) for i in range(3)],
+                'email1_subject.txt', 'email1_body.txt', attachments=attachments)
+            self.assertEqual(mock_create.call_count, 1)
+
+        outbox = django_mail.outbox
+        self.assertEqual(len(outbox), 3)
+        self.assertTrue(all(m.attachments[0] is outbox[0].attachments[0] for m in outbox))
+        self.assertTrue(all(m.attachments[1] is part for m in outbox))
+
+
+class EmailPhaseStatsTest(SimpleTestCase):
+
+    def setUp(self):
+        from lu_dj_utils.email import EmailPhaseStats
+
+        _reset_test_outbox()
+        self.stats = EmailPhaseStats()
+        self.stats.connect()
+        self.addCleanup(self.stats.disconnect)
+
+    def test_send_templated_mail(self):
+        from lu_dj_utils.email import send_templated_mail
+        from lu_dj_utils.test import SMTPSink
+
+        # timing doesn't change how messages are sent
+        with SMTPSink() as sink, \
+                patch('lu_dj_utils.email._smtp_send_streaming') as mock_streaming:
+            with override_settings(
+                    EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                    EMAIL_HOST=sink.host, EMAIL_PORT=sink.port):
+                for i in range(3):
+                    self.assertTrue(send_templated_mail(
+                        {'nombre': 'x' * i}, 'email1_subject.txt', 'email1_body.txt',
+                        'email1_body.html', to=['a@a.cl']))
+        self.assertFalse(mock_streaming.called)
+
+        stats = self.stats.stats()
+        self.assertEqual(
+            sorted(stats['phases']),
+            ['connect', 'create_message', 'render_body', 'render_html_body',
+             'render_subject', 'send'])
+        for phase_stats in stats['phases'].values():
+            self.assertEqual(phase_stats['count'], 3)
+            self.assertEqual(phase_stats['errors'], 0)
+            self.assertGreaterEqual(phase_stats['min'], 0)
+        self.assertEqual(stats['sizes']['count'], 3)
+        # the sizes of the messages written
+        sizes = sorted(len(data) for _, _, data in sink.messages)
+        self.assertEqual(
+            (stats['sizes']['min'], stats['sizes']['max']), (sizes[0], sizes[-1]))
+
+        dump = self.stats.dump()
+        self.assertIn('render_html_body: count=3 errors=0', dump)
+        self.assertIn('size: count=3', dump)
+
+        self.stats.clear()
+        self.assertEqual(self.stats.stats()['phases'], {})
+
+    def test_errors(self):
+        from lu_dj_utils.email import PlainEmail
+
+        connection = Mock()
+        connection.send_messages.side_effect = IOError
+        self.assertRaises(
+            IOError, PlainEmail(to=['a@a.cl'], connection=connection).send)
+        self.assertEqual(self.stats.stats()['phases']['send']['errors'], 1)
+
+    def test_no_receivers(self):
+        from lu_dj_utils.email import PlainEmail, _time_phase, email_phase_finished
+
+        self.stats.disconnect()
+        self.assertFalse(email_phase_finished.receivers)
+        self.assertFalse(_time_phase('send').active)
+        PlainEmail(to=['a@a.cl']).send()
+        self.assertEqual(self.stats.stats()['phases'], {})
+
+
+class SendFanOutTest(SimpleTestCase):
+
+    def test_send_fan_out(self):
+        from lu_dj_utils.email import HTMLEmail
+
+        _reset_test_outbox()
+        bcc = ['%s@b.cl' % i for i in range(25)]
+        email = HTMLEmail('<p>hi</p>', subject='s', body='b', to=['a@a.cl'], bcc=bcc)
+
+        report = email.send_fan_out(chunk_size=10)
+
+        self.assertEqual(sorted(report.sent), sorted(['a@a.cl'] + bcc))
+        self.assertEqual(report.failed, {})
+        outbox = django_mail.outbox
+        self.assertEqual(sorted(len(message.to) for message in outbox), [6, 10, 10])
+        self.assertEqual(len(set(message.data for message in outbox)), 1)
+        self.assertNotIn(b'b.cl', outbox[0].data)
+
+    def test_smtp(self):
+        from lu_dj_utils.email import PlainEmail
+        from lu_dj_utils.test import SMTPSink
+
+        bcc = ['%s@b.cl' % i for i in range(250)]
+        with SMTPSink() as sink:
+            with override_settings(
+                    EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                    EMAIL_HOST=sink.host, EMAIL_PORT=sink.port):
+                report = PlainEmail(subject='s', body='b', to=['a@a.cl'], bcc=bcc).send_fan_out(
+                    chunk_size=100, connections=2)
+
+        self.assertEqual(report.stats(), {'sent': 251, 'failed': 0})
+        self.assertEqual(sorted(len(rcpt_tos) for _, rcpt_tos, _ in sink.messages), [51, 100, 100])
+        self.assertEqual(
+            sorted(address for _, rcpt_tos, _ in sink.messages for address in rcpt_tos),
+            sorted(['a@a.cl'] + bcc))
+        self.assertEqual(len(set(data for _, _, data in sink.messages)), 1)
+        self.assertLessEqual(sink.connections, 2)
+
+    def test_no_recipients(self):
+        from lu_dj_utils.email import send_fan_out
+
+        report = send_fan_out(django_mail.EmailMessage(subject='s'))
+        self.assertEqual(report.stats(), {'sent': 0, 'failed': 0})
+
+
+class AddressValidatorTest(SimpleTestCase):
+
+    def test_validate(self):
+        from lu_dj_utils.email import AddressValidator
+
+        validator = AddressValidator()
+        valid, rejected = validator.validate(iter([
+            'A@A.cl', ' a@a.cl\n', 'Pedro Pérez <pedro@B.CL>', '"quoted@user"@c.cl',
+            'x@[127.0.0.1]', 'admin@localhost', 'user@ñandú.cl',
+            '', 'x', 'x@x', 'a@@a.cl', 'a b@a.cl', 'a@-a.cl', 'x@[999.0.0.1]',
+            'a' * 65 + '@a.cl', None, 1, ['y@y.cl'],
+        ]))
+        self.assertEqual(valid, set([
+            'a@a.cl', 'pedro@b.cl', '"quoted@user"@c.cl', 'x@[127.0.0.1]',
+            'admin@localhost', 'user@ñandú.cl']))
+        self.assertEqual(rejected, [
+            '', 'x', 'x@x', 'a@@a.cl', 'a b@a.cl', 'a@-a.cl', 'x@[999.0.0.1]',
+            'a' * 65 + '@a.cl', None, 1, ['y@y.cl']])
+
+    def test_domain_validator(self):
+        from lu_dj_utils.email import AddressValidator
+
+        domain_validator = Mock(side_effect=lambda domain: domain != 'spam.cl')
+        validator = AddressValidator(domain_validator=domain_validator, max_domains=2)
+        valid, rejected = validator.validate(
+            ['%s@%s' % (i, domain) for i in range(100) for domain in ('a.cl', 'spam.cl')])
+        self.assertEqual(len(valid), 100)
+        self.assertEqual(len(rejected), 100)
+        self.assertEqual(domain_validator.call_count, 2)
+        self.assertEqual(sorted(validator.group_by_domain(valid)), ['a.cl'])
+
+        # the least recently used domain is forgotten
+        validator.validate(['a@b.cl', 'a@spam.cl'])
+        self.assertEqual(domain_validator.call_count, 3)
+        validator.validate(['a@a.cl'])
+        self.assertEqual(domain_validator.call_count, 4)
+
+    def test_validate_recipients(self):
+        from lu_dj_utils.email import validate_recipients
+
+        to, cc, bcc, rejected = validate_recipients(
+            to=['b@a.cl', 'A@a.cl', 'b@a.cl'], cc=('a@a.cl', 'c@a.cl', 'bad'),
+            bcc=(address for address in ['C@A.CL', 'd@a.cl']))
+        self.assertEqual(to, ['b@a.cl', 'a@a.cl'])
+        self.assertEqual(cc, ['c@a.cl'])
+        self.assertEqual(bcc, ['d@a.cl'])
+        self.assertEqual(rejected, ['bad'])
+
+        self.assertEqual(validate_recipients(), ([], [], [], []))
+
+
+class RateLimiterTest(SimpleTestCase):
+
+    def reserve_many(self, limiter, n, cost=1):
+        with patch('lu_dj_utils.email._now', return_value=100.0):
+            return [round(limiter.reserve(cost), 6) for _ in range(n)]
+
+    def test_reserve(self):
+        from lu_dj_utils.email import RateLimiter
+
+        self.assertEqual(
+            self.reserve_many(RateLimiter([(10, 1)]), 4), [0, 0.1, 0.2, 0.3])
+        self.assertEqual(
+            self.reserve_many(RateLimiter([(10, 1)], burst=3), 5), [0, 0, 0, 0.1, 0.2])
+        self.assertEqual(
+            self.reserve_many(RateLimiter([(10, 1), (120, 60)]), 3), [0, 0.5, 1])
+        self.assertEqual(
+            self.reserve_many(RateLimiter([(10, 1)]), 3, cost=2), [0, 0.2, 0.4])
+
+        limiter = RateLimiter([(10, 1)])
+        self.reserve_many(limiter, 3)
+        stats = limiter.stats()['waits']
+        self.assertEqual(stats['count'], 3)
+        self.assertAlmostEqual(stats['max'], 0.2)
+
+    def test_acquire(self):
+        import time
+        from lu_dj_utils.email import RateLimiter
+
+        limiter = RateLimiter([(50, 1)])
+        start = time.time()
+        for _ in range(5):
+            limiter.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.075)
+
+    def test_adapt(self):
+        import smtplib
+        from lu_dj_utils.email import RateLimiter
+
+        limiter = RateLimiter([(10, 1)], increase=0.25)
+        self.assertFalse(limiter.notify_error(smtplib.SMTPDataError(550, 'no')))
+        self.assertFalse(limiter.notify_error(IOError()))
+        self.assertTrue(limiter.notify_error(smtplib.SMTPSenderRefused(421, 'busy', 'a@a.cl')))
+        self.assertTrue(limiter.notify_error(smtplib.SMTPRecipientsRefused(
+            {'a@a.cl': (451, 'later'), 'b@a.cl': (550, 'no')})))
+        self.assertEqual(limiter.factor, 0.25)
+        self.assertEqual(self.reserve_many(limiter, 2), [0, 0.4])
+        self.assertEqual(limiter.stats()['throttled'], 2)
+
+        for _ in range(4):
+            limiter.notify_success()
+        self.assertEqual(limiter.factor, 1)
+
+        for _ in range(10):
+            limiter.notify_error(smtplib.SMTPDataError(451, 'later'))
+        self.assertEqual(limiter.factor, 0.1)
+
+    def test_send_message(self):
+        import smtplib
+        from lu_dj_utils.email import PlainEmail, get_rate_limiter
+
+        _reset_test_outbox()
+        limits = {
+            'smtp.example.com': {'quotas': [(10, 1)]},
+            '*': {'quotas': [(1000, 1)], 'per_recipient': True},
+        }
+        with override_settings(LU_EMAIL_RATE_LIMITS=limits):
+            limiter = get_rate_limiter('django.core.mail.backends.locmem.EmailBackend')
+            self.assertIs(get_rate_limiter('*'), limiter)
+            self.assertIsNot(get_rate_limiter('smtp.example.com'), limiter)
+            self.assertEqual(limiter.quotas, [(1000, 1)])
+
+            with patch('lu_dj_utils.email.time.sleep') as mock_sleep, \
+                    patch('lu_dj_utils.email._now', return_value=100.0):
+                for _ in range(3):
+                    PlainEmail(to=['a@a.cl', 'b@a.cl']).send()
+            self.assertEqual(len(django_mail.outbox), 3)
+            self.assertEqual(limiter.stats()['waits']['count'], 3)
+            self.assertEqual(mock_sleep.call_count, 2)
+            self.assertAlmostEqual(mock_sleep.call_args_list[1][0][0], 0.004, 3)
+
+            connection = Mock()
+            connection.send_messages.side_effect = smtplib.SMTPDataError(451, 'later')
+            self.assertRaises(
+                smtplib.SMTPDataError, PlainEmail(to=['a@a.cl'], connection=connection).send)
+            self.assertEqual(get_rate_limiter('*').stats()['throttled'], 1)
+
+        with override_settings(LU_EMAIL_RATE_LIMITS={'smtp.example.com': {'quotas': [(1, 1)]}}):
+            self.assertIsNone(get_rate_limiter('other.example.com'))
+        self.assertIsNone(get_rate_limiter('smtp.example.com'))
+
+
+class EmailConnectionPoolTest(SimpleTestCase):
+
+    def test_reuse(self):
+        from lu_dj_utils.email import EmailConnectionPool
+
+        pool = EmailConnectionPool()
+        with pool.connection() as connection1:
+            pass
+        with pool.connection() as connection2:
+            self.assertEqual(pool.stats()['idle'], 0)
+        self.assertIs(connection1, connection2)
+
+        stats = pool.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual((stats['open'], stats['idle']), (1, 1))
+
+        pool.close_all()
+        self.assertEqual(pool.stats()['open'], 0)
+
+    def test_grouped_by_key(self):
+        from lu_dj_utils.email import EmailConnectionPool
+
+        pool = EmailConnectionPool()
+        with pool.connection(username='a') as connection1:
+            pass
+        with pool.connection(username='b') as connection2:
+            pass
+        self.assertIsNot(connection1, connection2)
+        self.assertEqual(pool.stats()['misses'], 2)
+
+    def test_grouped_by_settings(self):
+        from lu_dj_utils.email import EmailConnectionPool
+
+        pool = EmailConnectionPool()
+        with pool.connection(fail_silently=True) as connection:
+            pass
+        with pool.connection() as connection1:
+            pass
+        with pool.connection(port=2525) as connection2:
+            pass
+        with pool.connection(password='secret') as connection3:
+            pass
+        with pool.connection(use_ssl=True) as connection4:
+            pass
+        self.assertEqual(len(set(map(id, (
+            connection, connection1, connection2, connection3, connection4)))), 5)
+        self.assertEqual(pool.stats()['misses'], 5)
+
+        with pool.connection(fail_silently=True) as connection5:
+            pass
+        self.assertIs(connection5, connection)
+        self.assertTrue(connection5.fail_silently)
+
+    def test_max_size(self):
+        from lu_dj_utils.email import EmailConnectionPool
+
+        pool = EmailConnectionPool(max_size=1, wait_timeout=0.01)
+        connection = pool.acquire()
+        with self.assertRaises(RuntimeError):
+            pool.acquire()
+        self.assertEqual(pool.stats()['waits'], 1)
+
+        pool.release(connection)
+        self.assertIs(pool.acquire(), connection)
+
+    def test_discarded_on_error(self):
+        from lu_dj_utils.email import EmailConnectionPool
+
+        pool = EmailConnectionPool()
+        with self.assertRaises(ValueError):
+            with pool.connection():
+                raise ValueError
+        stats = pool.stats()
+        self.assertEqual((stats['discarded'], stats['open']), (1, 0))
+
+    def test_expired(self):
+        from lu_dj_utils.email import EmailConnectionPool
+
+        pool = EmailConnectionPool(idle_timeout=-1)
+        with pool.connection() as connection1:
+            pass
+        with pool.connection() as connection2:
+            pass
+        self.assertIsNot(connection1, connection2)
+        self.assertEqual(pool.stats()['discarded'], 1)
+
+    def test_health_check(self):
+        from lu_dj_utils.email import EmailConnectionPool
+
+        broken = Mock(name='broken')
+        broken.connection.noop.return_value = (421, 'closing')
+        healthy = Mock(name='healthy')
+        healthy.connection.noop.return_value = (250, 'OK')
+
+        pool = EmailConnectionPool(health_check_after=-1)
+        with patch('django.core.mail.get_connection') as mock_get_connection:
+            mock_get_connection.side_effect = [broken, healthy]
+            with pool.connection():
+                pass
+            with pool.connection() as connection:
+                self.assertIs(connection, healthy)
+            with pool.connection() as connection:
+                self.assertIs(connection, healthy)
+
+        self.assertTrue(broken.close.called)
+        self.assertEqual(pool.stats()['open'], 1)
+
+    def test_used_by_send(self):
+        import lu_dj_utils.email
+        from lu_dj_utils.email import PlainEmail, get_connection_pool, send_mail2
+
+        _reset_test_outbox()
+        self.assertIsNone(get_connection_pool())
+
+        with override_settings(LU_EMAIL_CONNECTION_POOL={'max_size': 2}):
+            with patch.object(lu_dj_utils.email, '_connection_pool', None):
+                pool = get_connection_pool()
+                self.assertEqual(pool.max_size, 2)
+
+                PlainEmail(subject='x', body='y', to=['a@a.cl']).send()
+                send_mail2(subject='x', body='y', to=['a@a.cl'])
+                self.assertEqual(pool.stats()['hits'], 1)
+                self.assertEqual(len(django_mail.outbox), 2)
+
+
+class EmailDispatcherTest(SimpleTestCase):
+
+    def test_submit(self):
+        from lu_dj_utils.email import EmailDispatcher
+
+        dispatcher = EmailDispatcher(workers=2)
+        handles = [dispatcher.submit(pow, i, 2) for i in range(10)]
+        self.assertEqual([h.result(timeout=5) for h in handles], [i ** 2 for i in range(10)])
+        self.assertTrue(all(h.done() for h in handles))
+        dispatcher.shutdown()
+
+    def test_exception(self):
+        from lu_dj_utils.email import EmailDispatcher
+
+        dispatcher = EmailDispatcher(workers=1)
+        with patch('lu_dj_utils.email.logger') as mock_logger:
+            handle = dispatcher.submit(int, 'x')
+            with self.assertRaises(ValueError):
+                handle.result(timeout=5)
+            self.assertTrue(mock_logger.exception.called)
+        dispatcher.shutdown()
+
+    def test_back_pressure(self):
+        import threading
+        from django.utils.six.moves.queue import Full
+        from lu_dj_utils.email import EmailDispatcher
+
+        dispatcher = EmailDispatcher(workers=1, queue_size=1, put_timeout=0.01)
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        first = dispatcher.submit(block)
+        started.wait(5)
+        second = dispatcher.submit(block)  # waits in the queue
+        with self.assertRaises(Full):
+            dispatcher.submit(block)
+
+        release.set()
+        dispatcher.shutdown(wait=True)
+        self.assertTrue(first.done() and second.done())
+        with self.assertRaises(RuntimeError):
+            dispatcher.submit(block)
+
+    def test_dispatch_templated_mail(self):
+        from django.utils.six.moves.queue import Full
+        import lu_dj_utils.email
+        from lu_dj_utils.email import EmailDispatcher, dispatch_templated_mail
+
+        _reset_test_outbox()
+        dispatcher = EmailDispatcher(workers=1, queue_size=1, put_timeout=0)
+
+        with patch.object(lu_dj_utils.email, '_email_dispatcher', dispatcher):
+            handle = dispatch_templated_mail(
+                {}, 'email1_subject.txt', 'email1_body.txt', to=['a@a.cl'])
+            self.assertTrue(handle.result(timeout=5))
+            self.assertEqual(len(django_mail.outbox), 1)
+
+            with patch.object(dispatcher, 'submit', side_effect=Full):
+                self.assertIsNone(dispatch_templated_mail(
+                    {}, 'email1_subject.txt', 'email1_body.txt', to=['a@a.cl']))
+        dispatcher.shutdown()
+
+
+class EmailOutboxTest(SimpleTestCase):
+
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'outbox.sqlite3')
+
+    def query(self, sql):
+        import sqlite3
+
+        db = sqlite3.connect(self.path)
+        self.addCleanup(db.close)
+        return db.execute(sql).fetchall()
+
+    def test_drain(self):
+        from lu_dj_utils.email import EmailOutbox, HTMLEmail, message_bytes
+
+        _reset_test_outbox()
+        outbox = EmailOutbox(self.path)
+        email = HTMLEmail('<p>hi</p>', subject='s', body='b', to=['a@a.cl'], bcc=['b@b.cl'])
+        outbox.put(email)
+        outbox.put(email, delay=60)
+        self.assertEqual(outbox.stats()['queued'], 2)
+        self.assertEqual(outbox.stats()['due'], 1)
+
+        (data, ), = self.query('SELECT data FROM outbox WHERE id = 1')
+        self.assertEqual(outbox.drain(), {'sent': 1, 'deferred': 0, 'dead': 0})
+        self.assertEqual(len(django_mail.outbox), 1)
+        sent = django_mail.outbox[0]
+        self.assertEqual(sent.recipients(), ['a@a.cl', 'b@b.cl'])
+        self.assertEqual(message_bytes(sent.message()), bytes(data))
+        self.assertIn(b'<p>hi</p>', bytes(data))
+
+        stats = outbox.stats()
+        self.assertEqual((stats['queued'], stats['due'], stats['dead']), (1, 0, 0))
+        self.assertLess(stats['oldest_age'], 60)
+
+    def test_drain_smtp(self):
+        from lu_dj_utils.email import EmailOutbox, PlainEmail
+        from lu_dj_utils.test import SMTPSink
+
+        outbox = EmailOutbox(self.path, batch_size=2)
+        emails = [PlainEmail(subject='s%s' % i, body='.b', to=['%s@a.cl' % i])
+                  for i in range(5)]
+        for email in emails:
+            outbox.put(email)
+
+        stored = [bytes(data) for data, in self.query('SELECT data FROM outbox ORDER BY id')]
+
+        with SMTPSink() as sink:
+            connection = django_mail.get_connection(
+                'django.core.mail.backends.smtp.EmailBackend',
+                host=sink.host, port=sink.port)
+            self.assertEqual(outbox.drain(connection, limit=3)['sent'], 3)
+            self.assertEqual(outbox.drain(connection)['sent'], 2)
+
+        self.assertEqual(sink.connections, 3)
+        # smtplib terminates the data with a line break
+        self.assertEqual(
+            [data for _, _, data in sink.messages], [data + b'\r\n' for data in stored])
+        self.assertEqual(sink.messages[4][1], ['4@a.cl'])
+
+    def test_retry(self):
+        import smtplib
+        import time
+        from lu_dj_utils.email import EmailOutbox, PlainEmail
+
+        outbox = EmailOutbox(self.path, max_attempts=3, backoff=10)
+        for i in range(3):
+            outbox.put(PlainEmail(subject='s', body='b', to=['%s@a.cl' % i]))
+        connection = Mock()
+        connection.send_messages.side_effect = [
+            smtplib.SMTPDataError(451, 'try later'),
+            smtplib.SMTPDataError(550, 'no such user'),
+            1,
+        ]
+
+        self.assertEqual(outbox.drain(connection), {'sent': 1, 'deferred': 1, 'dead': 1})
+        self.assertEqual(outbox.drain(connection), {'sent': 0, 'deferred': 0, 'dead': 0})
+        stats = outbox.stats()
+        self.assertEqual((stats['queued'], stats['due'], stats['dead']), (1, 0, 1))
+
+        # backoff doubles (with jitter) until the last attempt
+        connection.send_messages.side_effect = smtplib.SMTPServerDisconnected()
+        for attempt, max_delay in ((2, 20), (3, None)):
+            now = time.time() + 1000 * attempt
+            with patch('lu_dj_utils.email.time.time', return_value=now):
+                counts = outbox.drain(connection)
+            (retry_at, ), = self.query('SELECT next_attempt_at FROM outbox WHERE id = 1')
+            if max_delay:
+                self.assertEqual(counts['deferred'], 1)
+                self.assertTrue(now + max_delay / 2 <= retry_at <= now + max_delay)
+            else:
+                self.assertEqual(counts['dead'], 1)
+        self.assertEqual(outbox.stats()['dead'], 2)
+
+        self.assertEqual(outbox.requeue_dead(), 2)
+        connection.send_messages.side_effect = None
+        connection.send_messages.return_value = 1
+        self.assertEqual(outbox.drain(connection)['sent'], 2)
+        self.assertEqual(outbox.stats()['queued'], 0)
+
+    def test_send_templated_mail(self):
+        from lu_dj_utils import email
+        from lu_dj_utils.email import get_email_outbox, send_templated_mail
+
+        _reset_test_outbox()
+        with override_settings(LU_EMAIL_OUTBOX={'path': self.path}), \
+                patch.object(email, '_email_outbox', None), \
+                patch('lu_dj_utils.email.send_message', side_effect=IOError):
+            self.assertFalse(send_templated_mail(
+                {}, 'email1_subject.txt', 'email1_body.txt', to=['a@a.cl']))
+            self.assertEqual(get_email_outbox().stats()['queued'], 1)
+
+    def test_queue_templated_mail(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from lu_dj_utils import email
+        from lu_dj_utils.email import queue_templated_mail
+
+        _reset_test_outbox()
+        self.assertRaises(
+            ImproperlyConfigured, queue_templated_mail,
+            {}, 'email1_subject.txt', 'email1_body.txt', to=['a@a.cl'])
+
+        with override_settings(LU_EMAIL_OUTBOX={'path': self.path}), \
+                patch.object(email, '_email_outbox', None):
+            self.assertEqual(queue_templated_mail(
+                {'nombre': 'Pedro'}, 'email1_subject.txt', 'email1_body.txt', to=['a@a.cl']), 1)
+            self.assertEqual(len(django_mail.outbox), 0)
+
+            stdout = StringIO()
+            call_command('drain_email_outbox', stats=True, stdout=stdout)
+            self.assertIn('Queued: 1 (due: 1), dead: 0', stdout.getvalue())
+            call_command('drain_email_outbox', '--once', '--interval=0', stdout=stdout)
+            self.assertIn('Sent: 1, deferred: 0, dead: 0.', stdout.getvalue())
+
+        self.assertEqual(len(django_mail.outbox), 1)
+        self.assertIn(b'Pedro', django_mail.outbox[0].message().as_bytes())
+
+
+class TemplateCacheTest(SimpleTestCase):
+
+    def test_render(self):
+        from lu_dj_utils.email import TemplateCache, render_to_string
+
+        cache = TemplateCache(maxsize=1)
+        context = {'nombre': 'Pedro'}
+        for i in range(3):
+            self.assertEqual(
+                cache.render('email1_body.txt', context),
+                render_to_string('email1_body.txt', context))
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        cache.render('email1_subject.txt', context)
+        cache.render('email1_body.txt', context)
+        self.assertEqual(cache.stats()['evictions'], 2)
+        self.assertEqual(cache.stats()['size'], 1)
+
+    def test_debug(self):
+        from lu_dj_utils.email import TemplateCache
+
+        cache = TemplateCache()
+        with override_settings(DEBUG=True):
+            self.assertFalse(cache.enabled)
+            cache.render('email1_body.txt', {})
+            cache.render('email1_body.txt', {})
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertTrue(TemplateCache(enabled=True).enabled)
+        self.assertTrue(cache.enabled)
+
+    def test_check_mtime(self):
+        import os
+        import shutil
+        import tempfile
+        import time
+        from lu_dj_utils.email import TemplateCache
+
+        template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, template_dir)
+        path = os.path.join(template_dir, 'mtime_test.txt')
+        with open(path, 'w') as f:
+            f.write('old {{ x }}')
+
+        cache = TemplateCache(check_mtime=True)
+        with override_settings(TEMPLATE_DIRS=(template_dir,), TEMPLATE_DEBUG=True):
+            self.assertEqual(cache.render('mtime_test.txt', {'x': 1}), 'old 1')
+            with open(path, 'w') as f:
+                f.write('new {{ x }}')
+            os.utime(path, (time.time() + 10, time.time() + 10))
+            self.assertEqual(cache.render('mtime_test.txt', {'x': 1}), 'new 1')
+            self.assertEqual(cache.render('mtime_test.txt', {'x': 2}), 'new 2')
+
+        self.assertEqual(cache.stats()['reloads'], 1)
+
+    def test_used_by_send_templated_mail(self):
+        from lu_dj_utils.email import send_templated_mail, template_cache
+
+        template_cache.clear()
+        for i in range(2):
+            send_templated_mail(
+                {}, 'email1_subject.txt', 'email1_body.txt', to=['a@a.cl'])
+        self.assertIn('email1_subject.txt', template_cache._cache)
+        self.assertIn('email1_body.txt', template_cache._cache)
+
+
 class SendTemplatedMailTest(TestCase):
 
     def setUp(self):
@@ -376,6 +1270,189 @@ class SendTemplatedMailTest(TestCase):
             self.context, self.subject_name, self.body_name, to=[email_address])
 
 
+class SendTemplatedMassMailTest(SimpleTestCase):
+
+    def setUp(self):
+        self.subject_name = 'email1_subject.txt'
+        self.body_name = 'email1_body.txt'
+        self.html_body_name = 'email1_body.html'
+
+    def test_send(self):
+        from lu_dj_utils.email import send_templated_mass_mail
+
+        _reset_test_outbox()
+        outbox = django_mail.outbox
+
+        contexts = (
+            ({'nombre': 'user%s' % i}, ['user%s@a.cl' % i]) for i in range(5))
+        results = send_templated_mass_mail(
+            contexts, self.subject_name, self.body_name, self.html_body_name,
+            batch_size=2)
+
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(len(outbox), 5)
+        for i, message in enumerate(outbox):
+            self.assertEqual(message.to, ['user%s@a.cl' % i])
+            self.assertIn('user%s' % i, message.subject)
+            self.assertEqual(message.alternatives[0][1], 'text/html')
+
+    def test_per_message_results(self):
+        from lu_dj_utils.email import send_templated_mass_mail
+
+        _reset_test_outbox()
+
+        contexts = [({}, ['a@a.cl']), ({}, [None]), ({}, ['b@b.cl'])]
+        results = send_templated_mass_mail(contexts, self.subject_name, self.body_name)
+        self.assertEqual(results, [True, False, True])
+        self.assertEqual(len(django_mail.outbox), 2)
+
+    def test_validate_recipients(self):
+        from lu_dj_utils.email import send_templated_mass_mail
+
+        _reset_test_outbox()
+
+        contexts = [({}, ['A@a.cl', 'bad']), ({}, [['a@a.cl']]), ({}, ['b@b.cl'])]
+        results = send_templated_mass_mail(
+            contexts, self.subject_name, self.body_name, validate_recipients=True)
+        self.assertEqual(results, [True, False, True])
+        self.assertEqual([m.to for m in django_mail.outbox], [['a@a.cl'], ['b@b.cl']])
+
+    def test_connection_error(self):
+        import socket
+        from lu_dj_utils.email import send_templated_mass_mail
+
+        connection = Mock()
+        connection.open.side_effect = socket.error("connection refused")
+        contexts = (({}, ['%s@a.cl' % i]) for i in range(3))
+        results = send_templated_mass_mail(
+            contexts, self.subject_name, self.body_name, connection=connection)
+        self.assertEqual(results, [False] * 3)
+        self.assertFalse(connection.send_messages.called)
+
+    def test_multiprocess(self):
+        from lu_dj_utils.email import send_templated_mass_mail_multiprocess
+
+        _reset_test_outbox()
+        contexts = [({'nombre': 'user%s' % i}, ['user%s@a.cl' % i]) for i in range(20)]
+        contexts.insert(3, ({}, [None]))
+
+        report = send_templated_mass_mail_multiprocess(
+            iter(contexts), self.subject_name, self.body_name, self.html_body_name,
+            processes=2, senders=3, batch_size=8, bcc=['audit@a.cl'])
+
+        self.assertEqual(
+            sorted(report.sent),
+            sorted(['user%s@a.cl' % i for i in range(20)] + ['audit@a.cl'] * 20))
+        self.assertEqual(list(report.failed), [None])
+        self.assertEqual(report.stats(), {'sent': 40, 'failed': 1})
+        self.assertEqual(len(django_mail.outbox), 20)
+        message, = [m for m in django_mail.outbox if m.to == ['user7@a.cl', 'audit@a.cl']]
+        data = message.message().as_bytes()
+        self.assertIn(b'Hola user7', data)
+        self.assertIn(b'text/html', data)
+
+    def test_multiprocess_worker_init_error(self):
+        import multiprocessing
+        import django
+        from django.core.exceptions import ImproperlyConfigured
+        from lu_dj_utils.email import send_templated_mass_mail_multiprocess
+
+        if not hasattr(django, 'setup'):
+            self.skipTest("django.setup() requires Django 1.7+")
+        if hasattr(multiprocessing, 'get_start_method') and \
+                multiprocessing.get_start_method() != 'fork':
+            self.skipTest("the patch is inherited only by forked workers")
+
+        contexts = [({}, ['%s@a.cl' % i]) for i in range(4)]
+        with patch('django.setup', side_effect=ImproperlyConfigured("not configured")):
+            with self.assertRaises(RuntimeError) as cm:
+                send_templated_mass_mail_multiprocess(
+                    contexts, self.subject_name, self.body_name, processes=2)
+        self.assertIn('ImproperlyConfigured: not configured', str(cm.exception))
+
+    def test_multiprocess_smtp(self):
+        from lu_dj_utils.email import send_templated_mass_mail_multiprocess
+        from lu_dj_utils.test import SMTPSink
+
+        contexts = [({'nombre': i}, ['%s@a.cl' % i]) for i in range(10)]
+        with SMTPSink() as sink:
+            with override_settings(
+                    EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                    EMAIL_HOST=sink.host, EMAIL_PORT=sink.port):
+                report = send_templated_mass_mail_multiprocess(
+                    contexts, self.subject_name, self.body_name, processes=2, senders=2)
+
+        self.assertEqual(sorted(report.sent), sorted('%s@a.cl' % i for i in range(10)))
+        self.assertEqual(len(sink.messages), 10)
+        self.assertEqual(sink.connections, 2)
+
+    def test_send_raw_message_refused(self):
+        import smtplib
+        from django.core.mail.backends.smtp import EmailBackend
+        from lu_dj_utils.email import RawEmailMessage, send_raw_message
+
+        connection = EmailBackend()
+        connection.connection = Mock()
+        connection.connection.sendmail.return_value = {'b@b.cl': (550, b'no such user')}
+        message = RawEmailMessage('x@x.cl', ['a@a.cl', 'b@b.cl'], b'data')
+        self.assertEqual(
+            send_raw_message(message, connection), {'b@b.cl': (550, b'no such user')})
+        connection.connection.sendmail.assert_called_once_with(
+            'x@x.cl', ['a@a.cl', 'b@b.cl'], b'data')
+
+        connection.connection.sendmail.side_effect = smtplib.SMTPRecipientsRefused(
+            {'a@a.cl': (550, b'no'), 'b@b.cl': (550, b'no')})
+        self.assertRaises(smtplib.SMTPRecipientsRefused, send_raw_message, message, connection)
+
+    def test_dedupe(self):
+        from lu_dj_utils.email import render_templated_mail, send_templated_mass_mail
+
+        _reset_test_outbox()
+        contexts = [({'nombre': 'user%s' % (i % 2), 'id': i}, ['%s@a.cl' % i])
+                    for i in range(6)]
+
+        with patch('lu_dj_utils.email.render_templated_mail',
+                   wraps=render_templated_mail) as mock_render:
+            results = send_templated_mass_mail(
+                contexts, self.subject_name, self.body_name, dedupe_keys=['nombre'])
+            self.assertEqual(mock_render.call_count, 2)
+
+            mock_render.reset_mock()
+            send_templated_mass_mail(
+                contexts, self.subject_name, self.body_name, dedupe_keys=True)
+            self.assertEqual(mock_render.call_count, 6)
+
+            mock_render.reset_mock()
+            send_templated_mass_mail(
+                contexts, self.subject_name, self.body_name, dedupe_keys=['nombre'],
+                render_cache_size=1)
+            self.assertEqual(mock_render.call_count, 6)
+
+        self.assertEqual(results, [True] * 6)
+        outbox = django_mail.outbox
+        self.assertEqual([m.to for m in outbox[:6]], [c[1] for c in contexts])
+        self.assertEqual([m.subject for m in outbox[:6]], [
+            outbox[0].subject, outbox[1].subject] * 3)
+        self.assertNotEqual(outbox[0].subject, outbox[1].subject)
+
+    def test_reconnect(self):
+        from smtplib import SMTPServerDisconnected
+        from lu_dj_utils.email import send_templated_mass_mail
+
+        connection = Mock(name='connection')
+        connection.open.return_value = True
+        connection.send_messages.side_effect = [1, SMTPServerDisconnected(), 1, 1]
+
+        contexts = [({}, ['a@a.cl']), ({}, ['b@b.cl']), ({}, ['c@c.cl'])]
+        results = send_templated_mass_mail(
+            contexts, self.subject_name, self.body_name, connection=connection)
+
+        self.assertEqual(results, [True, True, True])
+        self.assertEqual(connection.send_messages.call_count, 4)
+        self.assertEqual(connection.open.call_count, 2)
+        self.assertEqual(connection.close.call_count, 2)
+
+
 class Functions(SimpleTestCase):
 
     # noinspection PyTypeChecker
@@ -393,6 +1470,24 @@ class Functions(SimpleTestCase):
         self.assertIsNone(func(None, None))
         self.assertEqual(func({}, None), {})
 
+    def test_context_fingerprint(self):
+        from lu_dj_utils.email import context_fingerprint
+
+        func = context_fingerprint
+
+        self.assertEqual(func({'a': 1, 'b': [2]}), func({'b': [2], 'a': 1}))
+        self.assertNotEqual(func({'a': 1, 'b': [2]}), func({'a': 1, 'b': [3]}))
+        self.assertEqual(func({'a': 1, 'b': 2}, ['a']), func({'a': 1, 'b': 3}, ['a']))
+        self.assertNotEqual(func({'a': 1}, ['a']), func({'a': 1}, ['a', 'b']))
+
+
+def _parse_message(data):
+    import email
+
+    if hasattr(email, 'message_from_bytes'):
+        return email.message_from_bytes(data)
+    return email.message_from_string(data)
+
 
 def _reset_test_outbox():
     """Empty the outbox manually.
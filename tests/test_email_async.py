@@ -0,0 +1,202 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals
+
+import sys
+import unittest
+
+from mock import patch
+
+from django.core import mail as django_mail
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from lu_dj_utils.test import SMTPSink
+
+
+SMTP_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio API requires Python 3.5+")
+class AsyncSMTPConnectionTest(SimpleTestCase):
+
+    def setUp(self):
+        import asyncio
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.sink = SMTPSink().start()
+
+    def tearDown(self):
+        import asyncio
+
+        self.sink.stop()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_sendmail(self):
+        from lu_dj_utils.email_async import AsyncSMTPConnection
+
+        connection = AsyncSMTPConnection(
+            self.sink.host, self.sink.port, username='u', password='p', timeout=5)
+        data = b'Subject: hi\r\n\r\n.leading dot\r\nbye\r\n'
+
+        refused = self.loop.run_until_complete(
+            connection.sendmail('a@a.cl', ['b@b.cl', 'c@c.cl'], data))
+        self.assertEqual(refused, {})
+        self.assertIn('pipelining', connection.esmtp_features)
+        self.assertEqual(self.loop.run_until_complete(connection.noop()), 250)
+        self.loop.run_until_complete(connection.quit())
+
+        self.assertEqual(
+            self.sink.messages, [('a@a.cl', ['b@b.cl', 'c@c.cl'], data)])
+
+    def test_pool_concurrency(self):
+        import asyncio
+        from lu_dj_utils.email import PlainEmail
+        from lu_dj_utils.email_async import AsyncEmailConnectionPool
+
+        pool = AsyncEmailConnectionPool(
+            size=2, host=self.sink.host, port=self.sink.port, timeout=5)
+        emails = [PlainEmail(subject='s%s' % i, body='b', to=['%s@a.cl' % i])
+                  for i in range(50)]
+
+        results = self.loop.run_until_complete(
+            asyncio.gather(*[email.asend(pool) for email in emails]))
+        self.loop.run_until_complete(pool.close())
+
+        self.assertEqual(results, [1] * 50)
+        self.assertEqual(self.sink.connections, 2)
+        self.assertEqual(
+            sorted(rcpt_tos[0] for _, rcpt_tos, _ in self.sink.messages),
+            sorted('%s@a.cl' % i for i in range(50)))
+
+    def test_reconnect(self):
+        from lu_dj_utils.email import PlainEmail
+        from lu_dj_utils.email_async import AsyncEmailConnectionPool
+
+        self.sink.max_messages_per_connection = 2
+        pool = AsyncEmailConnectionPool(
+            size=1, host=self.sink.host, port=self.sink.port, timeout=5)
+        for i in range(5):
+            email = PlainEmail(subject='s', body='b', to=['a@a.cl'])
+            self.assertEqual(self.loop.run_until_complete(email.asend(pool)), 1)
+
+        self.assertEqual(len(self.sink.messages), 5)
+        self.assertEqual(self.sink.connections, 3)
+
+    def test_close_while_sending(self):
+        import asyncio
+        from lu_dj_utils.email import PlainEmail
+        from lu_dj_utils.email_async import AsyncEmailConnectionPool
+
+        pool = AsyncEmailConnectionPool(
+            size=2, host=self.sink.host, port=self.sink.port, timeout=5)
+        emails = [PlainEmail(subject='s', body='b', to=['a@a.cl']) for _ in range(5)]
+
+        async def send_and_close():
+            tasks = [asyncio.ensure_future(email.asend(pool)) for email in emails]
+            # let the sends start: 2 of them get connections, 3 wait
+            await asyncio.sleep(0)
+            connections = list(pool._connections)
+            await pool.close()
+            return connections, await asyncio.gather(*tasks, return_exceptions=True)
+
+        connections, results = self.loop.run_until_complete(send_and_close())
+
+        self.assertEqual(results[:2], [1, 1])
+        for result in results[2:]:
+            self.assertIsInstance(result, RuntimeError)
+        self.assertEqual(len(self.sink.messages), 2)
+        self.assertEqual(pool._connections, [])
+        self.assertFalse(any(connection.is_connected for connection in connections))
+        with self.assertRaises(RuntimeError):
+            self.loop.run_until_complete(emails[0].asend(pool))
+
+    def test_send_templated_mail_async(self):
+        from lu_dj_utils.email_async import (
+            send_templated_mail_async, send_templated_mass_mail_async,
+        )
+
+        with override_settings(
+                EMAIL_BACKEND=SMTP_BACKEND, EMAIL_HOST=self.sink.host,
+                EMAIL_PORT=self.sink.port):
+            result = self.loop.run_until_complete(send_templated_mail_async(
+                {'nombre': 'Pedro'}, 'email1_subject.txt', 'email1_body.txt',
+                'email1_body.html', to=['pedro@perez.cl']))
+            self.assertTrue(result)
+
+            contexts = [({'nombre': i}, ['%s@a.cl' % i]) for i in range(10)]
+            contexts.insert(3, ({}, [None]))
+            results = self.loop.run_until_complete(send_templated_mass_mail_async(
+                contexts, 'email1_subject.txt', 'email1_body.txt', concurrency=4))
+
+        self.assertEqual(results, [True] * 3 + [False] + [True] * 7)
+        self.assertEqual(len(self.sink.messages), 11)
+        self.assertIn(b'Pedro', self.sink.messages[0][2])
+
+    def test_mass_mail_workers(self):
+        import asyncio
+        from lu_dj_utils.email_async import send_templated_mass_mail_async
+
+        all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+        in_flight = []
+        counts = []
+
+        async def send_message(message, pool=None):
+            in_flight.append(message)
+            counts.append((len(in_flight), len(all_tasks())))
+            await asyncio.sleep(0)
+            in_flight.remove(message)
+            return 1
+
+        contexts = [({'nombre': i}, ['%s@a.cl' % i]) for i in range(20)]
+        with patch('lu_dj_utils.email_async.send_message', send_message):
+            results = self.loop.run_until_complete(send_templated_mass_mail_async(
+                contexts, 'email1_subject.txt', 'email1_body.txt', concurrency=3))
+
+        self.assertEqual(results, [True] * 20)
+        self.assertEqual(len(counts), 20)
+        self.assertEqual(max(in_flight_count for in_flight_count, _ in counts), 3)
+        # the workers and the gathering task, not one task per message
+        self.assertLessEqual(max(tasks for _, tasks in counts), 4)
+
+    def test_non_smtp_backend(self):
+        from lu_dj_utils.email import PlainEmail
+
+        django_mail.outbox = []
+        email = PlainEmail(subject='s', body='b', to=['a@a.cl'])
+        self.assertEqual(self.loop.run_until_complete(email.asend()), 1)
+        self.assertEqual(len(django_mail.outbox), 1)
+        self.assertEqual(self.sink.connections, 0)
+
+    def test_rate_limit(self):
+        import asyncio
+        from lu_dj_utils.email import PlainEmail, get_rate_limiter
+        from lu_dj_utils.email_async import AsyncEmailConnectionPool
+
+        sleep = asyncio.sleep
+        delays = []
+
+        async def fake_sleep(delay):
+            delays.append(delay)
+            await sleep(0)
+
+        limits = {self.sink.host: {'quotas': [(100, 1)]}}
+        with override_settings(LU_EMAIL_RATE_LIMITS=limits), \
+                patch('lu_dj_utils.email._now', return_value=100.0), \
+                patch('asyncio.sleep', fake_sleep):
+            pool = AsyncEmailConnectionPool(
+                size=2, host=self.sink.host, port=self.sink.port, timeout=5)
+            emails = [PlainEmail(subject='s', body='b', to=['a@a.cl']) for _ in range(10)]
+            results = self.loop.run_until_complete(
+                asyncio.gather(*[email.asend(pool) for email in emails]))
+            self.loop.run_until_complete(pool.close())
+            stats = get_rate_limiter(self.sink.host).stats()
+
+        self.assertEqual(results, [1] * 10)
+        # sends are booked 0.01s apart: the first one doesn't wait
+        self.assertEqual(len(delays), 9)
+        for i, delay in enumerate(delays, 1):
+            self.assertAlmostEqual(delay, i * 0.01)
+        self.assertEqual(stats['waits']['count'], 10)
+        self.assertAlmostEqual(stats['waits']['max'], 0.09)
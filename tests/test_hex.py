@@ -1,9 +1,11 @@
 # coding: utf-8
 from __future__ import absolute_import, print_function, unicode_literals
 
+import os
 import unittest
 
 from django.utils import six
+from mock import Mock, patch
 
 
 class FunctionsTest(unittest.TestCase):
@@ -33,6 +35,37 @@ class FunctionsTest(unittest.TestCase):
             value = hex_sha1(''.encode('utf-8'), six.text_type(i).encode('utf-8'))
             self.assertIsNotNone(SHA1_RE.match(value))
 
+    def test_hex_sha1_many(self):
+        from lu_dj_utils.hex import hex_sha1, hex_sha1_many
+
+        salt = 'chao1'.encode('utf-8')
+        values = [six.text_type(i).encode('utf-8') * i for i in range(50)]
+        expected = [hex_sha1(salt, value) for value in values]
+
+        self.assertEqual(list(hex_sha1_many(salt, [])), [])
+        self.assertEqual(list(hex_sha1_many(salt, iter(values))), expected)
+        self.assertEqual(list(hex_sha1_many(salt, values, threads=0)), expected)
+        # values of at least 40 bytes are hashed in the thread pool
+        self.assertEqual(
+            list(hex_sha1_many(salt, values, threads=2, parallel_size=40)), expected)
+        self.assertEqual(
+            list(hex_sha1_many(salt, values, threads=2, parallel_size=0)), expected)
+
+    def test_hex_sha1_many_lazy(self):
+        from lu_dj_utils.hex import hex_sha1, hex_sha1_many
+
+        consumed = []
+
+        def values():
+            for i in range(1000):
+                consumed.append(i)
+                yield b'x' * 100
+
+        results = hex_sha1_many(b'', values(), threads=2, parallel_size=50)
+        self.assertEqual(next(results), hex_sha1(b'', b'x' * 100))
+        self.assertLessEqual(len(consumed), 4)
+        results.close()
+
     def test_random_hex_32(self):
         # values random enough such that there are no repetitions in 10,000 calls
 
@@ -63,3 +96,75 @@ class FunctionsTest(unittest.TestCase):
             self.assertIsNotNone(HEX_6_RE.match(random_key))
         # if there were any repeated keys then len(keys) < size_
         self.assertEquals(size_, len(keys))
+
+    def test_time_hex_32(self):
+        import time
+        import uuid
+        from lu_dj_utils.hex import time_hex_32, HEX_32_RE
+
+        values = [time_hex_32() for _ in range(10000)]
+        self.assertEqual(values, sorted(set(values)))
+        for value in values:
+            self.assertIsNotNone(HEX_32_RE.match(value))
+            self.assertEqual(uuid.UUID(value).version, 7)
+            self.assertEqual(uuid.UUID(value).variant, uuid.RFC_4122)
+        self.assertAlmostEqual(int(values[-1][:12], 16) / 1000.0, time.time(), delta=5)
+
+    def test_time_hex_32_counter(self):
+        from lu_dj_utils.hex import time_hex_32
+
+        with patch('lu_dj_utils.hex._time_hex_32_last', (1000, 0xffe)):
+            with patch('time.time', return_value=0.5):
+                values = [time_hex_32() for _ in range(3)]
+        self.assertEqual(
+            [value[:16] for value in values],
+            ['0000000003e87fff', '0000000003e97000', '0000000003e97001'])
+
+    def test_random_hex_32_many(self):
+        import uuid
+        from lu_dj_utils.hex import random_hex_32_many, HEX_32_RE
+
+        self.assertEqual(random_hex_32_many(0), [])
+        values = random_hex_32_many(10000)
+        self.assertEqual(len(set(values)), 10000)
+        for value in values:
+            self.assertIsNotNone(HEX_32_RE.match(value))
+            self.assertEqual(uuid.UUID(value).version, 4)
+            self.assertEqual(uuid.UUID(value).variant, uuid.RFC_4122)
+
+    def test_random_hex_6_many(self):
+        from lu_dj_utils.hex import random_hex_6_many, HEX_6_RE
+
+        values = random_hex_6_many(1000)
+        self.assertEqual(len(values), 1000)
+        self.assertGreater(len(set(values)), 900)
+        for value in values:
+            self.assertIsNotNone(HEX_6_RE.match(value))
+
+    def test_buffer(self):
+        from lu_dj_utils.hex import _HexBuffer
+
+        generate = Mock(side_effect=lambda size: list(range(size)))
+        buffer_ = _HexBuffer(generate, 3)
+        self.assertEqual([buffer_.pop() for _ in range(7)], [0, 1, 2, 0, 1, 2, 0])
+        self.assertEqual(generate.call_count, 3)
+
+        buffer_._check_pid = True
+        buffer_._pid = -1
+        self.assertEqual(buffer_.pop(), 0)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "requires os.fork")
+    def test_buffer_fork(self):
+        from lu_dj_utils.hex import random_hex_32
+
+        random_hex_32()  # fill the buffer
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # child
+            os.write(write_fd, random_hex_32().encode('ascii'))
+            os._exit(0)
+        os.close(write_fd)
+        child_value = os.read(read_fd, 32).decode('ascii')
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        self.assertNotEqual(child_value, random_hex_32())
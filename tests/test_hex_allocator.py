@@ -0,0 +1,117 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals
+
+from django.test import TestCase
+from mock import patch
+
+from tests.models import Coupon
+
+
+class Hex6AllocatorTest(TestCase):
+
+    def test_allocate(self):
+        from lu_dj_utils.hex import HEX_6_RE
+        from lu_dj_utils.hex_allocator import Hex6Allocator
+
+        Coupon.objects.create(code='00000a')
+        allocator = Hex6Allocator(Coupon, 'code')
+        values = allocator.allocate_many(1000)
+        value = allocator.allocate()
+
+        self.assertEqual(len(set(values + [value])), 1001)
+        for value in values:
+            self.assertIsNotNone(HEX_6_RE.match(value))
+        stats = allocator.stats()
+        self.assertEqual(stats['loads'], 1)
+        self.assertEqual(stats['allocated'], 1001)
+        self.assertEqual(stats['taken'], 1)
+        self.assertEqual(stats['reserved'], 1001)
+
+        Coupon.objects.create(code=value)
+        self.assertEqual(allocator.stats()['taken'], 2)
+        self.assertEqual(allocator.stats()['reserved'], 1000)
+
+    def test_lease(self):
+        from lu_dj_utils.hex_allocator import Hex6Allocator
+
+        allocator = Hex6Allocator(Coupon, 'code', lease=60)
+        candidates = [['00000a'], ['00000a', '00000b'], ['00000a']]
+        with patch('lu_dj_utils.hex_allocator.random_hex_6_many',
+                   side_effect=lambda n: candidates.pop(0)):
+            with patch('lu_dj_utils.hex_allocator._now', return_value=1000):
+                self.assertEqual(allocator.allocate(), '00000a')
+                # reserved
+                self.assertEqual(allocator.allocate(), '00000b')
+            # never saved: the reservation expired
+            with patch('lu_dj_utils.hex_allocator._now', return_value=1061):
+                self.assertEqual(allocator.allocate(), '00000a')
+
+    def test_check_existing(self):
+        from lu_dj_utils.hex_allocator import Hex6Allocator
+
+        allocator = Hex6Allocator(Coupon, 'code', check_existing=True)
+        allocator.allocate_many(0)  # load
+        # inserted after the load, without ``post_save``
+        Coupon.objects.bulk_create([Coupon(code='00000a'), Coupon(code='00000b')])
+        candidates = [['00000a', '00000b', '00000c'], ['00000b', '00000d', '00000e']]
+        with patch('lu_dj_utils.hex_allocator.random_hex_6_many',
+                   side_effect=lambda n: candidates.pop(0)):
+            with self.assertNumQueries(2):
+                values = allocator.allocate_many(3)
+        self.assertEqual(values, ['00000c', '00000d', '00000e'])
+        stats = allocator.stats()
+        self.assertEqual(stats['existing'], 2)
+        self.assertEqual(stats['taken'], 2)
+
+    def test_no_queries(self):
+        from lu_dj_utils.hex_allocator import Hex6Allocator
+
+        allocator = Hex6Allocator(Coupon, 'code')
+        allocator.allocate_many(0)  # load
+        with self.assertNumQueries(0):
+            allocator.allocate()
+            allocator.allocate_many(10)
+
+    def test_collisions(self):
+        from lu_dj_utils.hex_allocator import Hex6Allocator
+
+        Coupon.objects.create(code='00000a')
+        allocator = Hex6Allocator(Coupon, 'code')
+        candidates = [['00000a', '00000b'], ['00000b', '00000c', '00000d']]
+        # '00000a' is taken, '00000b' is reserved by the first call
+        with patch('lu_dj_utils.hex_allocator.random_hex_6_many',
+                   side_effect=lambda n: candidates.pop(0)):
+            self.assertEqual(allocator.allocate_many(1), ['00000b'])
+            self.assertEqual(allocator.allocate_many(2), ['00000c', '00000d'])
+        self.assertEqual(allocator.stats()['collisions'], 2)
+
+    def test_signals(self):
+        from lu_dj_utils.hex_allocator import Hex6Allocator
+
+        allocator = Hex6Allocator(Coupon, 'code')
+        allocator.allocate_many(0)  # load
+        coupon = Coupon.objects.create(code='00000a')
+        self.assertEqual(allocator.stats()['taken'], 1)
+        coupon.delete()
+        self.assertEqual(allocator.stats()['taken'], 0)
+
+        allocator.mark('00000b')
+        allocator.mark('invalid')
+        self.assertEqual(allocator.stats()['taken'], 1)
+        allocator.release('00000b')
+        self.assertEqual(allocator.stats()['taken'], 0)
+
+    def test_exhausted(self):
+        from lu_dj_utils.hex_allocator import HEX_6_VALUES, Hex6Allocator
+
+        allocator = Hex6Allocator(Coupon, 'code')
+        self.assertRaises(ValueError, allocator.allocate_many, HEX_6_VALUES + 1)
+
+    def test_get_hex6_allocator(self):
+        from lu_dj_utils.hex_allocator import get_hex6_allocator
+
+        allocator = get_hex6_allocator(Coupon, 'code')
+        self.assertIs(get_hex6_allocator(Coupon, 'code'), allocator)
+        Coupon.objects.bulk_create(
+            [Coupon(code=code) for code in allocator.allocate_many(10)])
+        self.assertEqual(Coupon.objects.count(), 10)
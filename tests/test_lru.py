@@ -0,0 +1,62 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals
+
+import unittest
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_get_set(self):
+        from lu_dj_utils.lru import LRUCache
+
+        cache = LRUCache(maxsize=2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a', 0), 0)
+
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIn('b', cache)
+        self.assertEqual(len(cache), 2)
+
+        self.assertEqual(cache.pop('b'), 2)
+        self.assertIsNone(cache.pop('b'))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_eviction(self):
+        from lu_dj_utils.lru import LRUCache
+
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')  # now 'b' is the least recently used
+        cache.set('c', 3)
+
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(
+            cache.stats(),
+            {'hits': 3, 'misses': 0, 'evictions': 1, 'size': 2, 'bytes': 0})
+
+    def test_maxbytes(self):
+        from lu_dj_utils.lru import LRUCache
+
+        cache = LRUCache(maxsize=None, maxbytes=10)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 4)
+        cache.set('a', 'x' * 2)
+        self.assertEqual(cache.stats()['bytes'], 6)
+
+        cache.set('c', 'x' * 5)  # evicts 'b'
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.stats()['bytes'], 7)
+
+        cache.set('d', 'x' * 11)  # too big to be kept
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+        cache.set('e', 'x')
+        cache.pop('e')
+        self.assertEqual(cache.stats()['bytes'], 0)
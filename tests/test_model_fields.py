@@ -0,0 +1,100 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals
+
+import uuid
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import TestCase
+
+from tests.models import CompactKeys
+
+
+class BinaryHex32FieldTest(TestCase):
+
+    def test_save_and_lookups(self):
+        objs = [CompactKeys.objects.create() for _ in range(3)]
+        CompactKeys.objects.bulk_create(
+            [CompactKeys(key='%032x' % i, code='%06x' % i) for i in range(3)])
+
+        obj = CompactKeys.objects.get(pk=objs[0].pk)
+        self.assertEqual(obj.key, objs[0].key)
+        self.assertEqual(CompactKeys.objects.get(key=objs[1].key).pk, objs[1].pk)
+        self.assertEqual(CompactKeys.objects.get(key=objs[1].key.upper()).pk, objs[1].pk)
+        self.assertEqual(
+            set(CompactKeys.objects.filter(key__in=['%032x' % 1, objs[2].key])
+                .values_list('key', flat=True)),
+            set(['%032x' % 1, objs[2].key]))
+
+    def test_db_value(self):
+        CompactKeys.objects.create(key='%032x' % 255, code='0000ff')
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT key, code FROM tests_compactkeys')
+            key, code = cursor.fetchone()
+        self.assertEqual(bytes(key), b'\x00' * 15 + b'\xff')
+        self.assertEqual(code, 255)
+
+    def test_to_python(self):
+        field = CompactKeys._meta.get_field('key')
+        value = uuid.uuid4()
+        self.assertEqual(field.to_python(value), value.hex)
+        self.assertEqual(field.to_python(str(value)), value.hex)
+        self.assertEqual(field.to_python(value.bytes), value.hex)
+        self.assertEqual(field.to_python(value.hex.encode('ascii')), value.hex)
+        self.assertIsNone(field.to_python(None))
+        self.assertRaises(ValidationError, field.to_python, 'abc')
+
+
+class IntegerHex6FieldTest(TestCase):
+
+    def test_save_and_lookups(self):
+        obj = CompactKeys.objects.create()
+        CompactKeys.objects.create(code='00000a')
+
+        self.assertEqual(CompactKeys.objects.get(pk=obj.pk).code, obj.code)
+        self.assertEqual(CompactKeys.objects.get(code='00000A').code, '00000a')
+        self.assertEqual(
+            CompactKeys.objects.filter(code__in=['00000a', obj.code]).count(), 2)
+
+    def test_to_python(self):
+        field = CompactKeys._meta.get_field('code')
+        self.assertEqual(field.to_python(255), '0000ff')
+        self.assertEqual(field.to_python('0000FF'), '0000ff')
+        self.assertIsNone(field.to_python(None))
+        self.assertRaises(ValidationError, field.to_python, 'abcdefg')
+        self.assertRaises(ValidationError, field.to_python, 16 ** 6)
+
+
+class Hex32FieldTest(TestCase):
+
+    def test_deconstruct(self):
+        from lu_dj_utils.hex import random_hex_32, time_hex_32
+        from lu_dj_utils.model_fields import BinaryHex32Field, Hex32Field
+
+        for cls in (Hex32Field, BinaryHex32Field):
+            for ordered in (False, True):
+                field = cls(ordered=ordered)
+                name, path, args, kwargs = field.deconstruct()
+                self.assertEqual(kwargs.get('ordered', False), ordered)
+                self.assertNotIn('default', kwargs)
+                rebuilt = cls(*args, **kwargs)
+                self.assertEqual(rebuilt.deconstruct(), (name, path, args, kwargs))
+                self.assertIs(rebuilt.default, time_hex_32 if ordered else random_hex_32)
+
+
+class Hex6FieldTest(TestCase):
+
+    def test_deconstruct(self):
+        from lu_dj_utils.hex import random_hex_6
+        from lu_dj_utils.model_fields import Hex6Field, IntegerHex6Field
+
+        for cls in (Hex6Field, IntegerHex6Field):
+            for allocate in (False, True):
+                field = cls(allocate=allocate)
+                name, path, args, kwargs = field.deconstruct()
+                self.assertEqual(kwargs.get('allocate', False), allocate)
+                self.assertNotIn('default', kwargs)
+                rebuilt = cls(*args, **kwargs)
+                self.assertEqual(rebuilt.deconstruct(), (name, path, args, kwargs))
+                self.assertEqual(rebuilt.allocate, allocate)
+                self.assertIs(rebuilt.default, random_hex_6)
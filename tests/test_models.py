@@ -0,0 +1,298 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals
+
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError
+from django.test import TestCase
+from mock import Mock, patch
+
+from tests.models import Document, Subscriber, Tag
+
+
+class BulkFullCleanTest(TestCase):
+
+    def get_subscribers(self, n, start=0):
+        return [Subscriber(email='%s@a.cl' % i, list_name='news', position=i)
+                for i in range(start, start + n)]
+
+    def test_valid(self):
+        from lu_dj_utils.models import bulk_full_clean
+
+        Subscriber.objects.create(email='old@a.cl', list_name='news', position=1000)
+        subscribers = self.get_subscribers(20)
+        # 1 query for 'email' per chunk, 1 per instance for 'unique_together'
+        with self.assertNumQueries(2 + 20):
+            bulk_full_clean(subscribers, chunk_size=10)
+
+    def test_errors(self):
+        from lu_dj_utils.models import BulkValidationError, bulk_full_clean
+
+        Subscriber.objects.create(email='0@a.cl', list_name='news', position=100)
+        subscribers = self.get_subscribers(5)
+        subscribers[1].email = 'invalid'
+        subscribers[2].list_name = 'closed'
+        subscribers[3].position = 100
+        subscribers[4].email = '3@a.cl'
+
+        with self.assertRaises(BulkValidationError) as cm:
+            bulk_full_clean(subscribers, chunk_size=2)
+        errors = dict((index, e.message_dict) for index, e in cm.exception.instance_errors.items())
+
+        self.assertEqual(sorted(errors), [0, 1, 2, 3, 4])
+        self.assertEqual(list(errors[0]), ['email'])  # in the database
+        self.assertEqual(list(errors[1]), ['email'])  # invalid
+        self.assertEqual(errors[2], {NON_FIELD_ERRORS: ["The list is closed."]})
+        self.assertEqual(list(errors[3]), [NON_FIELD_ERRORS])  # unique together
+        self.assertEqual(list(errors[4]), ['email'])  # repeated in another chunk
+
+    def test_existing_instances(self):
+        from lu_dj_utils.models import bulk_full_clean
+
+        Subscriber.objects.bulk_create(self.get_subscribers(3), validate=False)
+        subscribers = list(Subscriber.objects.all())
+        subscribers[0].position = 10
+        bulk_full_clean(subscribers)
+
+    def test_collation(self):
+        from lu_dj_utils.models import BulkValidationError, bulk_full_clean
+
+        Tag.objects.create(name='Foo')
+        tags = [Tag(name='bar'), Tag(name='foo'), Tag(name='baz')]
+        # 1 query for 'name', then 1 per value not found as it is
+        with self.assertNumQueries(1 + 3):
+            with self.assertRaises(BulkValidationError) as cm:
+                bulk_full_clean(tags)
+        self.assertEqual(list(cm.exception.instance_errors), [1])
+
+    def test_bulk_create(self):
+        from lu_dj_utils.models import BulkValidationError
+
+        Subscriber.objects.bulk_create(self.get_subscribers(3))
+        self.assertEqual(Subscriber.objects.count(), 3)
+
+        subscribers = self.get_subscribers(3, start=2)
+        self.assertRaises(BulkValidationError, Subscriber.objects.bulk_create, subscribers)
+        self.assertEqual(Subscriber.objects.count(), 3)
+
+
+class ValidateModelMixinTest(TestCase):
+
+    def setUp(self):
+        Subscriber.objects.create(email='a@a.cl', list_name='news', position=1)
+
+    def test_changed_fields(self):
+        self.assertIsNone(Subscriber(email='b@a.cl').get_changed_fields())
+        subscriber = Subscriber.objects.get()
+        self.assertEqual(subscriber.get_changed_fields(), [])
+        subscriber.visits += 1
+        subscriber.email = 'b@a.cl'
+        self.assertEqual(subscriber.get_changed_fields(), ['email', 'visits'])
+        subscriber.save()
+        self.assertEqual(subscriber.get_changed_fields(), [])
+
+    def test_save_changed(self):
+        subscriber = Subscriber.objects.get()
+        subscriber.visits += 1
+        with self.assertNumQueries(1):  # UPDATE
+            subscriber.save()
+
+        subscriber.email = 'b@a.cl'
+        with self.assertNumQueries(2):  # email uniqueness, UPDATE
+            subscriber.save()
+        subscriber.position = 2
+        with self.assertNumQueries(2):  # unique together, UPDATE
+            subscriber.save()
+        with self.assertNumQueries(1):
+            subscriber.save()
+
+        subscriber.email = 'invalid'
+        with self.assertNumQueries(0):
+            self.assertRaises(ValidationError, subscriber.save)
+        with self.assertNumQueries(1):
+            subscriber.save(update_fields=['visits'])
+
+        subscriber.list_name = 'closed'
+        self.assertRaises(ValidationError, subscriber.save, update_fields=['visits'])
+
+    def test_save_deferred(self):
+        subscriber = Subscriber.objects.only('visits', 'list_name').get()
+        subscriber.visits += 1
+        with self.assertNumQueries(1):  # UPDATE, deferred fields are not loaded
+            subscriber.save(update_fields=['visits'])
+        self.assertEqual(subscriber.get_changed_fields(), [])
+        self.assertNotIn('email', subscriber.__dict__)
+
+    def test_save_deferred_assigned(self):
+        subscriber = Subscriber.objects.only('id', 'list_name').get()
+        subscriber.email = 'invalid'
+        self.assertEqual(subscriber.get_changed_fields(), ['email'])
+        self.assertRaises(ValidationError, subscriber.save)
+        self.assertEqual(Subscriber.objects.get().email, 'a@a.cl')
+
+        # loading a deferred field doesn't change it
+        subscriber = Subscriber.objects.only('id', 'list_name').get()
+        self.assertEqual(subscriber.visits, 0)
+        self.assertEqual(subscriber.get_changed_fields(), [])
+
+    def test_refresh_from_db(self):
+        subscriber = Subscriber.objects.get()
+        Subscriber.objects.update(email='b@a.cl', visits=5)
+        subscriber.refresh_from_db(fields=['visits'])
+        self.assertEqual(subscriber.get_changed_fields(), [])
+        subscriber.refresh_from_db()
+        self.assertEqual(subscriber.email, 'b@a.cl')
+        self.assertEqual(subscriber.get_changed_fields(), [])
+        subscriber.visits += 1
+        with self.assertNumQueries(1):  # UPDATE, the email is not validated
+            subscriber.save()
+
+    def test_save_update_fields(self):
+        subscriber = Subscriber.objects.get()
+        subscriber.visits += 1
+        subscriber.position = 2
+        subscriber.save(update_fields=['visits'])
+        # the change of 'position' was not saved
+        self.assertEqual(subscriber.get_changed_fields(), ['position'])
+
+    def test_unique_changed(self):
+        Subscriber.objects.create(email='b@a.cl', list_name='news', position=2)
+        subscriber = Subscriber.objects.get(email='a@a.cl')
+        subscriber.email = 'b@a.cl'
+        subscriber.position = 2
+        with self.assertRaises(ValidationError) as cm:
+            subscriber.save()
+        self.assertEqual(sorted(cm.exception.message_dict), [NON_FIELD_ERRORS, 'email'])
+
+    def test_full_validation(self):
+        subscriber = Subscriber.objects.get()
+        with self.assertNumQueries(3):  # email, unique together, UPDATE
+            subscriber.save(full_validation=True)
+        with self.assertNumQueries(3):  # new object
+            Subscriber.objects.create(email='b@a.cl', list_name='news', position=2)
+
+
+class ValidationPlanTest(TestCase):
+
+    def test_unique_checks(self):
+        from django.db.models import Model
+        from lu_dj_utils.models import get_validation_plan
+
+        subscriber = Subscriber(email='a@a.cl', list_name='news', position=1)
+        plan = get_validation_plan(subscriber)
+        self.assertIs(get_validation_plan(Subscriber()), plan)
+        for exclude in (None, ['email'], ['position'], ['id', 'list_name']):
+            self.assertEqual(
+                subscriber._get_unique_checks(exclude=exclude),
+                Model._get_unique_checks(subscriber, exclude=exclude))
+        self.assertEqual(
+            plan.get_unique_checks(involving=['position'])[0],
+            [(Subscriber, ('list_name', 'position'))])
+
+    def test_class_prepared(self):
+        from django.db.models import signals
+        from lu_dj_utils.models import get_validation_plan
+
+        plan = get_validation_plan(Subscriber())
+        signals.class_prepared.send(sender=Subscriber)
+        self.assertIsNot(get_validation_plan(Subscriber()), plan)
+
+    def test_clean_fields(self):
+        subscriber = Subscriber(email='invalid', list_name='x' * 11, position=1)
+        with self.assertRaises(ValidationError) as cm:
+            subscriber.clean_fields(exclude=['list_name'])
+        self.assertEqual(list(cm.exception.message_dict), ['email'])
+
+
+class HexKeyCacheManagerTest(TestCase):
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        Document.cached.clear_local_cache()
+        self.documents = [Document.objects.create(title='d%s' % i) for i in range(5)]
+        self.stats = Document.cached.stats()
+
+    def get_stats(self):
+        stats = Document.cached.stats()
+        return dict((name, stats[name] - self.stats[name])
+                    for name in ('local_hits', 'cache_hits', 'misses', 'queries'))
+
+    def test_get_by_hex(self):
+        token = self.documents[0].token
+        with self.assertNumQueries(1):
+            self.assertEqual(Document.cached.get_by_hex(token).title, 'd0')
+        with self.assertNumQueries(0):
+            document = Document.cached.get_by_hex(token)
+            self.assertEqual(document.pk, self.documents[0].pk)
+        self.assertEqual(
+            self.get_stats(), {'local_hits': 1, 'cache_hits': 0, 'misses': 1, 'queries': 1})
+
+        # cached objects are not shared
+        document.title = 'changed'
+        self.assertEqual(Document.cached.get_by_hex(token).title, 'd0')
+
+        self.assertRaises(Document.DoesNotExist, Document.cached.get_by_hex, '0' * 32)
+        with self.assertNumQueries(0):
+            self.assertRaises(Document.DoesNotExist, Document.cached.get_by_hex, 'invalid')
+
+    def test_get_many_by_hex(self):
+        tokens = [document.token for document in self.documents]
+        Document.cached.get_many_by_hex(tokens[:2])
+        Document.cached.clear_local_cache()  # as in another process
+        Document.cached.get_by_hex(tokens[0])
+        with self.assertNumQueries(1):
+            documents = Document.cached.get_many_by_hex(tokens + ['0' * 32])
+
+        self.assertEqual(sorted(documents), sorted(tokens))
+        self.assertEqual(documents[tokens[3]].title, 'd3')
+        self.assertEqual(
+            self.get_stats(), {'local_hits': 1, 'cache_hits': 2, 'misses': 6, 'queries': 2})
+
+    def test_local_timeout(self):
+        token = self.documents[0].token
+        with patch('lu_dj_utils.models._now', return_value=1000):
+            Document.cached.get_by_hex(token)
+        with patch('lu_dj_utils.models._now', return_value=1011):
+            Document.cached.get_by_hex(token)
+        self.assertEqual(self.get_stats()['cache_hits'], 1)
+
+    def test_invalidation(self):
+        document = self.documents[0]
+        Document.cached.get_by_hex(document.token)
+        document.title = 'changed'
+        document.save()
+        self.assertEqual(Document.cached.get_by_hex(document.token).title, 'changed')
+
+        document.delete()
+        self.assertRaises(Document.DoesNotExist, Document.cached.get_by_hex, document.token)
+        self.assertEqual(Document.cached.stats()['invalidations'] - self.stats['invalidations'], 2)
+
+    def test_manager_copies(self):
+        import copy
+
+        # since Django 1.10, managers are copied when accessed through the model
+        manager = copy.copy(Document.cached)
+        manager.get_by_hex(self.documents[0].token)
+        self.documents[0].save()
+        self.assertEqual(Document.cached.stats()['misses'] - self.stats['misses'], 1)
+        self.assertEqual(
+            manager.stats()['invalidations'] - self.stats['invalidations'], 1)
+
+    def test_invalidation_race(self):
+        from lu_dj_utils.models import HexKeyCacheManager
+
+        document = self.documents[0]
+        stale = list(Document.objects.filter(pk=document.pk))
+
+        def get_queryset(manager):
+            # the object changes after it was read from the database
+            document.title = 'changed'
+            document.save()
+            return Mock(filter=Mock(return_value=stale))
+
+        with patch.object(HexKeyCacheManager, 'get_queryset', get_queryset):
+            self.assertEqual(Document.cached.get_by_hex(document.token).title, 'd0')
+        # the stale object was not cached, in any tier
+        self.assertEqual(Document.cached.get_by_hex(document.token).title, 'changed')
+        Document.cached.clear_local_cache()
+        self.assertEqual(Document.cached.get_by_hex(document.token).title, 'changed')
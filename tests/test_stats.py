@@ -0,0 +1,39 @@
+# coding: utf-8
+from __future__ import absolute_import, print_function, unicode_literals
+
+import unittest
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_stats(self):
+        from lu_dj_utils.stats import Histogram
+
+        histogram = Histogram()
+        self.assertEqual(histogram.stats()['count'], 0)
+        self.assertIsNone(histogram.percentile(50))
+
+        for value in range(1, 1001):
+            histogram.add(value / 1000.0)
+        stats = histogram.stats()
+        self.assertEqual(stats['count'], 1000)
+        self.assertEqual((stats['min'], stats['max']), (0.001, 1))
+        self.assertAlmostEqual(stats['mean'], 0.5005)
+        for percent in (50, 90, 99):
+            # within the relative error of the buckets
+            self.assertTrue(
+                percent / 100.0 <= stats['p%s' % percent] <= percent / 100.0 * 2 ** 0.25,
+                stats)
+        self.assertEqual(histogram.percentile(100), 1)
+
+        histogram.clear()
+        self.assertEqual(histogram.count, 0)
+
+    def test_non_positive(self):
+        from lu_dj_utils.stats import Histogram
+
+        histogram = Histogram()
+        for value in (0, 0, 0, 5):
+            histogram.add(value)
+        self.assertEqual(histogram.percentile(50), 0)
+        self.assertEqual(histogram.percentile(99), 5)
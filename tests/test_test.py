@@ -28,3 +28,46 @@ class FunctionsTest(TestCase):  # TODO: change to SimpleTestCase or unittest.Tes
             self,
             req.POST.items(),
             [('x', 'y'), ('a', '1')])
+
+
+class SMTPSinkTest(SimpleTestCase):
+
+    def test_receive(self):
+        import smtplib
+        from lu_dj_utils.test import SMTPSink
+
+        with SMTPSink() as sink:
+            client = smtplib.SMTP(sink.host, sink.port)
+            client.login('user', 'password')
+            client.sendmail('a@a.cl', ['b@b.cl', 'c@c.cl'], 'Subject: x\r\n\r\n.dot\r\n')
+            client.quit()
+
+        self.assertEqual(sink.connections, 1)
+        self.assertEqual(
+            sink.messages, [('a@a.cl', ['b@b.cl', 'c@c.cl'], b'Subject: x\r\n\r\n.dot\r\n')])
+
+    def test_max_messages_per_connection(self):
+        import smtplib
+        from lu_dj_utils.test import SMTPSink
+
+        with SMTPSink(max_messages_per_connection=1) as sink:
+            client = smtplib.SMTP(sink.host, sink.port)
+            client.sendmail('a@a.cl', ['b@b.cl'], 'Subject: x\r\n\r\n')
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                client.sendmail('a@a.cl', ['b@b.cl'], 'Subject: x\r\n\r\n')
+
+        self.assertEqual(len(sink.messages), 1)
+
+    def test_keep_messages(self):
+        import smtplib
+        from lu_dj_utils.test import SMTPSink
+
+        with SMTPSink(keep_messages=False) as sink:
+            client = smtplib.SMTP(sink.host, sink.port)
+            for _ in range(3):
+                client.sendmail('a@a.cl', ['b@b.cl'], 'Subject: x\r\n\r\n')
+            client.quit()
+
+        self.assertEqual(sink.messages, [])
+        self.assertEqual(sink.received, 3)
+        self.assertEqual(sink.received_bytes, 3 * len(b'Subject: x\r\n\r\n'))